@@ -0,0 +1,559 @@
+'''
+Created on 16/10/2026
+
+Fused calculation of the IndexStacker indices for one block of NBAR data
+'''
+import sys
+import logging
+import numpy
+from osgeo import gdalconst
+
+INDEX_ENGINE_VERSION = '2' # Change whenever a kernel changes so that existing outputs are rebuilt
+SCALE_FACTOR = 10000
+INT16_MIN = -32768
+INT16_MAX = 32767
+NBAR_NO_DATA_VALUE = -999
+WATER_DRY = 0
+WATER_WET = 1
+WATER_NO_DATA = 3 # Largest value of a 2 bit band
+CHUNK_PIXELS = 65536 # Pixels calculated at a time within a block
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+class IndexEngine(object):
+    """
+    Calculates any number of indices for one block of NBAR band data in a single pass.
+
+    Band sums and differences shared between indices (e.g. B4 - B3 for NDVI and EVI) are
+    calculated once per block, and every array used is a view into a pool of scratch buffers
+    which is kept between calls. Repeated calls for blocks no larger than the first one
+    therefore make no full-size allocations. Int16 indices are scaled, rounded and
+    saturated straight into their output buffer instead of being handed to GDAL as float32.
+
+    N.B: Arrays returned by calc_indices() are overwritten by the next call.
+    """
+    _scratch_bytes_dict = {} # get_scratch_bytes() results keyed by (output tags, cols)
+
+    def __init__(self):
+        self._buffer_dict = {} # Flat scratch arrays keyed by (name, dtype)
+        self._term_dict = {} # Shared band sums and differences for the current chunk
+        self._band_array = None # View of the current chunk of the block being calculated
+        self._band_position_dict = None # Position in the current block of each NBAR band index
+        self._block_shape = None
+        self._chunk_slice = None
+
+    def get_buffer(self, name, shape, dtype=numpy.float32):
+        """
+        Returns a C-contiguous array of the specified shape backed by the named scratch buffer.
+        The buffer is only reallocated when a larger array is requested.
+        """
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape))
+        flat_array = self._buffer_dict.get((name, dtype.str))
+        if flat_array is None or flat_array.size < size:
+            flat_array = numpy.empty((size,), dtype=dtype)
+            self._buffer_dict[(name, dtype.str)] = flat_array
+        return flat_array[:size].reshape(shape)
+
+    def get_band_buffer(self, band_count, rows, cols):
+        """
+        Returns a float32 (band, row, col) buffer into which a block of NBAR data can be read
+        """
+        return self.get_buffer('band_array', (band_count, rows, cols), numpy.float32)
+
+    @property
+    def nbytes(self):
+        """Total size in bytes of all scratch buffers currently held"""
+        return sum([flat_array.nbytes for flat_array in self._buffer_dict.values()])
+
+    @staticmethod
+    def bytes_per_pixel(output_tags):
+        """
+        Returns the memory per pixel of a block needed for the outputs of output_tags.
+        Shared terms and work arrays are only the size of one chunk and are not included.
+        """
+        return sum([numpy.dtype(INDEX_REGISTRY[output_tag]['dtype']).itemsize for output_tag in output_tags])
+
+    @classmethod
+    def get_scratch_bytes(cls, output_tags, cols):
+        """
+        Returns the size of the shared terms and work arrays used by calc_indices() for output_tags
+        in blocks cols wide, i.e. everything except the band and output arrays. This is found once
+        for each output_tags and cols by calculating a chunk of constant data.
+        """
+        key = (tuple(output_tags), cols)
+        if key not in cls._scratch_bytes_dict:
+            engine = cls()
+            band_indices = get_index_bands(output_tags)
+            chunk_rows = max(CHUNK_PIXELS // cols, 1)
+            band_array = engine.get_band_buffer(len(band_indices), chunk_rows, cols)
+            band_array.fill(1)
+            engine.calc_indices(band_array, output_tags, band_indices)
+            cls._scratch_bytes_dict[key] = engine.nbytes - band_array.nbytes - chunk_rows * cols * cls.bytes_per_pixel(output_tags)
+        return cls._scratch_bytes_dict[key]
+
+    def band(self, band_index):
+        """Returns the zero-based NBAR band from the current chunk"""
+        if self._band_position_dict is None:
+            return self._band_array[band_index]
+        return self._band_array[self._band_position_dict[band_index]]
+
+    def band_sum(self, band_index1, band_index2):
+        """Returns band_index1 + band_index2 for the current block, calculating it at most once"""
+        key = ('sum', min(band_index1, band_index2), max(band_index1, band_index2))
+        term_array = self._term_dict.get(key)
+        if term_array is None:
+            term_array = self.get_buffer('sum_%d_%d' % key[1:], self._band_array.shape[1:])
+            numpy.add(self.band(band_index1), self.band(band_index2), out=term_array)
+            self._term_dict[key] = term_array
+        return term_array
+
+    def band_difference(self, band_index1, band_index2):
+        """Returns band_index1 - band_index2 for the current block, calculating it at most once"""
+        key = ('difference', band_index1, band_index2)
+        term_array = self._term_dict.get(key)
+        if term_array is None:
+            term_array = self.get_buffer('difference_%d_%d' % key[1:], self._band_array.shape[1:])
+            numpy.subtract(self.band(band_index1), self.band(band_index2), out=term_array)
+            self._term_dict[key] = term_array
+        return term_array
+
+    def work_buffer(self, name='work'):
+        """Returns a float32 work array the size of one band of the current chunk"""
+        return self.get_buffer(name, self._band_array.shape[1:])
+
+    def output_buffer(self, output_tag):
+        """Returns the part of the output array for output_tag covering the current chunk"""
+        return self.get_buffer(output_tag, self._block_shape, INDEX_REGISTRY[output_tag]['dtype'])[self._chunk_slice]
+
+    def to_int16(self, work_array, output_tag):
+        """
+        Copies float32 work_array into the Int16 output buffer for output_tag and returns it.
+        Values are rounded half away from zero and saturated to the Int16 range, with NaN
+        written as zero, which is how GDAL converts Float32 data written to an Int16 band.
+        work_array is overwritten.
+        """
+        half_array = self.work_buffer('half')
+        numpy.copysign(0.5, work_array, out=half_array)
+        numpy.add(work_array, half_array, out=work_array)
+        numpy.trunc(work_array, out=work_array)
+        numpy.clip(work_array, INT16_MIN, INT16_MAX, out=work_array)
+
+        nan_mask = self.get_buffer('nan_mask', work_array.shape, numpy.bool_)
+        numpy.isnan(work_array, out=nan_mask)
+        numpy.copyto(work_array, 0, where=nan_mask)
+
+        output_array = self.output_buffer(output_tag)
+        numpy.copyto(output_array, work_array, casting='unsafe')
+        return output_array
+
+    def calc_indices(self, band_array, output_tags, band_indices=None):
+        """
+        Calculates every index in output_tags for band_array, a (band, row, col) float32 array.
+        band_indices is an optional list of the zero-based NBAR band held in each layer of
+        band_array, for when only the bands returned by get_index_bands() have been read.
+        Returns a dict of output arrays keyed by output tag. The arrays remain valid until
+        the next call.
+        """
+        if band_indices is None:
+            self._band_position_dict = None
+        else:
+            self._band_position_dict = dict([(band_index, band_position) for band_position, band_index in enumerate(band_indices)])
+
+        self._block_shape = band_array.shape[1:]
+        chunk_rows = max(CHUNK_PIXELS // band_array.shape[2], 1)
+        try:
+            # Work through the block in chunks of rows small enough for all the shared terms
+            # and work arrays of one chunk to stay in the CPU cache
+            for chunk_start in range(0, band_array.shape[1], chunk_rows):
+                self._chunk_slice = slice(chunk_start, min(chunk_start + chunk_rows, band_array.shape[1]))
+                self._band_array = band_array[:, self._chunk_slice]
+                self._term_dict = {}
+                for output_tag in output_tags:
+                    INDEX_REGISTRY[output_tag]['kernel'](self, output_tag)
+
+            index_array_dict = {}
+            for output_tag in output_tags:
+                index_array_dict[output_tag] = self.get_buffer(output_tag, self._block_shape, INDEX_REGISTRY[output_tag]['dtype'])
+            return index_array_dict
+        finally:
+            self._band_array = None
+            self._term_dict = {}
+
+
+# Index kernels. Each one evaluates the original whole-array expression in the same order
+# of float32 operations, using the shared terms and scratch buffers of an IndexEngine.
+# Remember band indices are zero-based
+
+def calc_normalised_difference(engine, output_tag):
+    # (Bx - By) / (Bx + By) * scale
+    band_index1, band_index2 = INDEX_REGISTRY[output_tag]['bands']
+    work_array = engine.work_buffer()
+    numpy.true_divide(engine.band_difference(band_index1, band_index2), engine.band_sum(band_index1, band_index2), out=work_array)
+    numpy.multiply(work_array, INDEX_REGISTRY[output_tag]['scale'], out=work_array)
+    return engine.to_int16(work_array, output_tag)
+
+def calc_evi(engine, output_tag):
+    # 25000 * ((B4 - B3) / (B4 + (60000 * B3) - (75000 * B1) + 10000))
+    work_array = engine.work_buffer()
+    half_array = engine.work_buffer('half')
+    numpy.multiply(engine.band(2), 60000, out=work_array)
+    numpy.add(engine.band(3), work_array, out=work_array)
+    numpy.multiply(engine.band(0), 75000, out=half_array)
+    numpy.subtract(work_array, half_array, out=work_array)
+    numpy.add(work_array, 10000, out=work_array)
+    numpy.true_divide(engine.band_difference(3, 2), work_array, out=work_array)
+    numpy.multiply(work_array, 2.5 * INDEX_REGISTRY[output_tag]['scale'], out=work_array)
+    return engine.to_int16(work_array, output_tag)
+
+def calc_slavi(engine, output_tag):
+    # B4 / (B3 + B5)
+    output_array = engine.output_buffer(output_tag)
+    numpy.true_divide(engine.band(3), engine.band_sum(2, 4), out=output_array)
+    return output_array
+
+def calc_satvi(engine, output_tag):
+    # ((B5 - B3) / (B5 + B3 + 5000)) * 15000 - (B7 / 2)
+    work_array = engine.work_buffer()
+    half_array = engine.work_buffer('half')
+    numpy.add(engine.band_sum(2, 4), 5000, out=work_array)
+    numpy.true_divide(engine.band_difference(4, 2), work_array, out=work_array)
+    numpy.multiply(work_array, 1.5 * INDEX_REGISTRY[output_tag]['scale'], out=work_array)
+    numpy.true_divide(engine.band(5), 2, out=half_array)
+    numpy.subtract(work_array, half_array, out=work_array)
+    return engine.to_int16(work_array, output_tag)
+
+def calc_water(engine, output_tag):
+    # WATER_TREE evaluated for every pixel at once: each node's test is applied to the whole
+    # chunk, and the mask of pixels reaching it is split between its two children
+    tree_arrays = WATER_TREE_ARRAYS
+    feature_array_list = []
+    for feature_name in WATER_FEATURE_NAMES:
+        feature_type, band_index1, band_index2 = WATER_FEATURES[feature_name]
+        if feature_type == 'band':
+            feature_array_list.append(engine.band(band_index1))
+        else:
+            feature_array = engine.work_buffer(feature_name)
+            numpy.true_divide(engine.band_difference(band_index1, band_index2), engine.band_sum(band_index1, band_index2), out=feature_array)
+            feature_array_list.append(feature_array)
+
+    reach_array = engine.get_buffer('water_reach', (len(tree_arrays['value']),) + engine.band(0).shape, numpy.bool_)
+    work_mask = engine.get_buffer('work_mask', engine.band(0).shape, numpy.bool_)
+    reach_array.fill(False)
+    reach_array[0] = True
+    for node_number in range(len(tree_arrays['feature'])):
+        numpy.less_equal(feature_array_list[tree_arrays['feature'][node_number]], tree_arrays['threshold'][node_number], out=work_mask)
+        numpy.logical_and(reach_array[node_number], work_mask, out=work_mask)
+        numpy.logical_or(reach_array[tree_arrays['left'][node_number]], work_mask, out=reach_array[tree_arrays['left'][node_number]])
+        numpy.logical_xor(reach_array[node_number], work_mask, out=work_mask) # Reached but not <= threshold
+        numpy.logical_or(reach_array[tree_arrays['right'][node_number]], work_mask, out=reach_array[tree_arrays['right'][node_number]])
+
+    # Every pixel reaches exactly one leaf, so the leaf values can be combined without masked
+    # (and so branching) copies
+    output_array = engine.output_buffer(output_tag)
+    leaf_array = engine.get_buffer('water_leaf', output_array.shape, numpy.uint8)
+    output_array.fill(0)
+    for node_number in range(len(tree_arrays['feature']), len(tree_arrays['value'])):
+        numpy.multiply(reach_array[node_number].view(numpy.uint8), tree_arrays['value'][node_number], out=leaf_array)
+        numpy.bitwise_or(output_array, leaf_array, out=output_array)
+
+    # No classification where any band is NBAR no data
+    no_data_mask = engine.get_buffer('nan_mask', output_array.shape, numpy.bool_)
+    no_data_mask.fill(False)
+    for band_index in INDEX_REGISTRY[output_tag]['bands']:
+        numpy.equal(engine.band(band_index), NBAR_NO_DATA_VALUE, out=work_mask)
+        numpy.logical_or(no_data_mask, work_mask, out=no_data_mask)
+    numpy.copyto(output_array, INDEX_REGISTRY[output_tag]['no_data_value'], where=no_data_mask)
+    return output_array
+
+# Features used by WATER_TREE as (type, band index 1, band index 2) tuples keyed by name.
+# 'ndi' is the normalised difference of the two bands, 'band' is the reflectance of the first.
+# Each NDI shares its band sum and difference with any other index using the same bands
+WATER_FEATURES = {'B1': ('band', 0, None),
+                  'B3': ('band', 2, None),
+                  'B7': ('band', 5, None),
+                  'NDI_43': ('ndi', 3, 2),
+                  'NDI_52': ('ndi', 4, 1),
+                  'NDI_72': ('ndi', 5, 1)}
+WATER_FEATURE_NAMES = sorted(WATER_FEATURES.keys())
+
+# Water decision tree as a list of (node, feature, threshold, node if <= threshold, node otherwise)
+# tuples, with the root first and 'WET' and 'DRY' as leaves. This is the whole WOfS regression
+# tree (Mueller et al. 2016), with nodes numbered as there
+WATER_TREE = [('node1', 'NDI_52', -0.01, 'node2', 'node21'),
+              ('node2', 'B1', 2083.5, 'node4', 'DRY'),
+              ('node4', 'B7', 323.5, 'node5', 'node8'),
+              ('node5', 'NDI_43', 0.61, 'WET', 'DRY'),
+              ('node8', 'B1', 1400.5, 'node12', 'node9'),
+              ('node9', 'NDI_43', -0.01, 'WET', 'DRY'),
+              ('node12', 'NDI_72', -0.23, 'node16', 'node13'),
+              ('node13', 'B1', 379, 'WET', 'DRY'),
+              ('node16', 'NDI_43', 0.22, 'WET', 'node18'),
+              ('node18', 'B1', 473, 'WET', 'DRY'),
+              ('node21', 'NDI_52', 0.23, 'node22', 'node35'),
+              ('node22', 'B1', 334.5, 'node24', 'DRY'),
+              ('node24', 'NDI_43', 0.54, 'node26', 'DRY'),
+              ('node26', 'NDI_52', 0.12, 'WET', 'node28'),
+              ('node28', 'B3', 364.5, 'node29', 'node32'),
+              ('node29', 'B1', 129.5, 'WET', 'DRY'),
+              ('node32', 'B1', 300.5, 'WET', 'DRY'),
+              ('node35', 'NDI_52', 0.34, 'node37', 'DRY'),
+              ('node37', 'B1', 249.5, 'node39', 'DRY'),
+              ('node39', 'NDI_43', 0.45, 'node41', 'DRY'),
+              ('node41', 'B3', 364.5, 'node43', 'DRY'),
+              ('node43', 'B1', 129.5, 'WET', 'DRY')]
+
+def get_tree_arrays(tree, feature_names, leaf_value_dict):
+    """
+    Returns a dict of node arrays indexed by node number, with the nodes of tree numbered
+    in order followed by the leaves: 'feature', 'threshold', 'left' and 'right' for the nodes
+    of tree and 'value' for all nodes. Every node must come after its parent in tree.
+    """
+    node_names = [node_info[0] for node_info in tree] + sorted(leaf_value_dict.keys())
+    node_number_dict = dict([(node_name, node_number) for node_number, node_name in enumerate(node_names)])
+    tree_arrays = {'feature': numpy.zeros((len(tree),), dtype=numpy.intp),
+                   'threshold': numpy.zeros((len(tree),), dtype=numpy.float32),
+                   'left': numpy.zeros((len(tree),), dtype=numpy.intp),
+                   'right': numpy.zeros((len(tree),), dtype=numpy.intp),
+                   'value': numpy.zeros((len(node_names),), dtype=numpy.uint8)}
+    for node_number, (node_name, feature_name, threshold, left_name, right_name) in enumerate(tree):
+        tree_arrays['feature'][node_number] = feature_names.index(feature_name)
+        tree_arrays['threshold'][node_number] = threshold
+        tree_arrays['left'][node_number] = node_number_dict[left_name]
+        tree_arrays['right'][node_number] = node_number_dict[right_name]
+        assert min(tree_arrays['left'][node_number], tree_arrays['right'][node_number]) > node_number, \
+            'Node %s comes after one of its children' % node_name
+    for leaf_name, leaf_value in leaf_value_dict.items():
+        tree_arrays['value'][node_number_dict[leaf_name]] = leaf_value
+    return tree_arrays
+
+WATER_TREE_ARRAYS = get_tree_arrays(WATER_TREE, WATER_FEATURE_NAMES, {'WET': WATER_WET, 'DRY': WATER_DRY})
+
+# Index registry. Each index declares everything needed to calculate and write it:
+#     expression: Formula evaluated by kernel, in terms of one-based NBAR band numbers
+#     bands: Zero-based NBAR band indices read by kernel
+#     scale: Factor applied to the index before it is written
+#     dtype, gdal_dtype: numpy and GDAL data types of the output
+#     no_data_value: Value written for masked pixels
+#     value_range: (min, max) of valid output values, or None if unbounded
+#     creation_options: Extra GDAL creation options for the output tiles keyed by GDAL format
+#     summary: Temporal summary of the stack - 'stats' (with percentiles) or 'frequency'
+#     kernel: Function taking (engine, output_tag) which fills the output buffer for output_tag
+INDEX_REGISTRY = {'NDVI' : {'expression': '(B4 - B3) / (B4 + B3)',
+                            'bands': (3, 2),
+                            'scale': SCALE_FACTOR,
+                            'dtype': numpy.int16,
+                            'gdal_dtype': gdalconst.GDT_Int16,
+                            'no_data_value': -32768,
+                            'value_range': (-SCALE_FACTOR, SCALE_FACTOR),
+                            'creation_options': {},
+                            'summary': 'stats',
+                            'kernel': calc_normalised_difference},
+                  'EVI' : {'expression': '2.5 * (B4 - B3) / (B4 + 60000 * B3 - 75000 * B1 + 10000)',
+                           'bands': (0, 2, 3),
+                           'scale': SCALE_FACTOR,
+                           'dtype': numpy.int16,
+                           'gdal_dtype': gdalconst.GDT_Int16,
+                           'no_data_value': -32768,
+                           'value_range': None,
+                           'creation_options': {},
+                           'summary': 'stats',
+                           'kernel': calc_evi},
+                  'NDSI' : {'expression': '(B3 - B5) / (B3 + B5)',
+                            'bands': (2, 4),
+                            'scale': SCALE_FACTOR,
+                            'dtype': numpy.int16,
+                            'gdal_dtype': gdalconst.GDT_Int16,
+                            'no_data_value': -32768,
+                            'value_range': (-SCALE_FACTOR, SCALE_FACTOR),
+                            'creation_options': {},
+                            'summary': 'stats',
+                            'kernel': calc_normalised_difference},
+                  'NDMI' : {'expression': '(B4 - B5) / (B4 + B5)',
+                            'bands': (3, 4),
+                            'scale': SCALE_FACTOR,
+                            'dtype': numpy.int16,
+                            'gdal_dtype': gdalconst.GDT_Int16,
+                            'no_data_value': -32768,
+                            'value_range': (-SCALE_FACTOR, SCALE_FACTOR),
+                            'creation_options': {},
+                            'summary': 'stats',
+                            'kernel': calc_normalised_difference},
+                  'SLAVI' : {'expression': 'B4 / (B3 + B5)',
+                             'bands': (2, 3, 4),
+                             'scale': 1,
+                             'dtype': numpy.float32,
+                             'gdal_dtype': gdalconst.GDT_Float32,
+                             'no_data_value': numpy.nan,
+                             'value_range': None,
+                             'creation_options': {},
+                             'summary': 'stats',
+                             'kernel': calc_slavi},
+                  'SATVI' : {'expression': '1.5 * (B5 - B3) / (B5 + B3 + 5000) - B7 / 2 / SCALE_FACTOR',
+                             'bands': (2, 4, 5),
+                             'scale': SCALE_FACTOR,
+                             'dtype': numpy.int16,
+                             'gdal_dtype': gdalconst.GDT_Int16,
+                             'no_data_value': -32768,
+                             'value_range': None,
+                             'creation_options': {},
+                             'summary': 'stats',
+                             'kernel': calc_satvi},
+                  'WATER' : {'expression': 'WOfS WATER_TREE of %d nodes over %s' % (len(WATER_TREE), ', '.join(WATER_FEATURE_NAMES)),
+                             'bands': (0, 1, 2, 3, 4, 5),
+                             'scale': 1,
+                             'dtype': numpy.uint8,
+                             'gdal_dtype': gdalconst.GDT_Byte,
+                             'no_data_value': WATER_NO_DATA,
+                             'value_range': (WATER_DRY, WATER_WET),
+                             'creation_options': {'GTiff': ['NBITS=2']},
+                             'summary': 'frequency',
+                             'kernel': calc_water}}
+
+# Default list of outputs to generate from each file, in processing order
+INDEX_TAGS = ['NDVI', 'EVI', 'NDSI', 'NDMI', 'SLAVI', 'SATVI', 'WATER']
+
+def get_index_definition(output_tag):
+    """Returns a string identifying everything in the registry which determines the output for output_tag"""
+    index_info = INDEX_REGISTRY[output_tag]
+    return '%s %s: %s, bands %r, scale %r, %s (GDAL type %d), no data %r, creation options %r' % (INDEX_ENGINE_VERSION,
+                                                                                                  output_tag,
+                                                                                                  index_info['expression'],
+                                                                                                  index_info['bands'],
+                                                                                                  index_info['scale'],
+                                                                                                  numpy.dtype(index_info['dtype']).name,
+                                                                                                  index_info['gdal_dtype'],
+                                                                                                  index_info['no_data_value'],
+                                                                                                  sorted(index_info['creation_options'].items()))
+
+def get_index_bands(output_tags):
+    """Returns a sorted list of the zero-based NBAR band indices needed to calculate output_tags"""
+    band_index_set = set()
+    for output_tag in output_tags:
+        band_index_set.update(INDEX_REGISTRY[output_tag]['bands'])
+    return sorted(band_index_set)
+
+
+if __name__ == '__main__':
+    import argparse
+    from timeit import default_timer
+
+    def calc_indices_per_expression(band_array, output_tags):
+        """
+        Reference implementation using the original per-index whole-array expressions from
+        IndexStacker.derive_datasets. Returns float arrays as they were passed to GDAL.
+        """
+        index_array_dict = {}
+        for output_tag in output_tags:
+            if output_tag == 'NDVI':
+                data_array = numpy.true_divide(band_array[3] - band_array[2], band_array[3] + band_array[2]) * SCALE_FACTOR
+            elif output_tag == 'EVI':
+                data_array = 25000 * ((band_array[3] - band_array[2]) / (band_array[3] + (60000 * band_array[2]) - (75000 * band_array[0]) + 10000))
+            elif output_tag == 'NDSI':
+                data_array = numpy.true_divide(band_array[2] - band_array[4], band_array[2] + band_array[4]) * SCALE_FACTOR
+            elif output_tag == 'NDMI':
+                data_array = numpy.true_divide(band_array[3] - band_array[4], band_array[3] + band_array[4]) * SCALE_FACTOR
+            elif output_tag == 'SLAVI':
+                data_array = numpy.true_divide(band_array[3], (band_array[2] + band_array[4]))
+            elif output_tag == 'SATVI':
+                data_array = ((band_array[4] - band_array[2]) / (band_array[4] + band_array[2] + 5000)) *15000 - (band_array[5]/2)
+            elif output_tag == 'WATER':
+                data_array = classify_water_per_node(band_array)
+            index_array_dict[output_tag] = data_array
+        return index_array_dict
+
+    def classify_water_per_node(band_array):
+        """Reference implementation of the WOfS tree as masks of the pixels reaching each node"""
+        b1 = band_array[0]
+        b3 = band_array[2]
+        b7 = band_array[5]
+        ndi_43 = numpy.true_divide(band_array[3] - band_array[2], band_array[3] + band_array[2])
+        ndi_52 = numpy.true_divide(band_array[4] - band_array[1], band_array[4] + band_array[1])
+        ndi_72 = numpy.true_divide(band_array[5] - band_array[1], band_array[5] + band_array[1])
+        wet_mask = numpy.zeros(b1.shape, dtype=numpy.bool_)
+
+        node1 = ndi_52 <= -0.01
+        node2 = node1 & (b1 <= 2083.5)
+        node4 = node2 & (b7 <= 323.5)
+        wet_mask |= node4 & (ndi_43 <= 0.61) # Node 5
+        node8 = node2 & ~(b7 <= 323.5)
+        wet_mask |= node8 & ~(b1 <= 1400.5) & (ndi_43 <= -0.01) # Node 9
+        node12 = node8 & (b1 <= 1400.5)
+        wet_mask |= node12 & ~(ndi_72 <= -0.23) & (b1 <= 379) # Node 13
+        node16 = node12 & (ndi_72 <= -0.23)
+        wet_mask |= node16 & ((ndi_43 <= 0.22) | (b1 <= 473)) # Nodes 16 and 18
+
+        node21 = ~node1
+        node22 = node21 & (ndi_52 <= 0.23)
+        node26 = node22 & (b1 <= 334.5) & (ndi_43 <= 0.54) # Through nodes 22 and 24
+        wet_mask |= node26 & (ndi_52 <= 0.12)
+        node28 = node26 & ~(ndi_52 <= 0.12)
+        wet_mask |= node28 & (b3 <= 364.5) & (b1 <= 129.5) # Node 29
+        wet_mask |= node28 & ~(b3 <= 364.5) & (b1 <= 300.5) # Node 32
+        node35 = node21 & ~(ndi_52 <= 0.23)
+        wet_mask |= node35 & (ndi_52 <= 0.34) & (b1 <= 249.5) & (ndi_43 <= 0.45) & (b3 <= 364.5) & (b1 <= 129.5) # Nodes 35 to 43
+
+        data_array = numpy.where(wet_mask, WATER_WET, WATER_DRY).astype(numpy.uint8)
+        data_array[(band_array == NBAR_NO_DATA_VALUE).any(axis=0)] = WATER_NO_DATA
+        return data_array
+
+    def gdal_int16(data_array):
+        """Converts float data to Int16 the way GDAL does on write"""
+        data_array = numpy.where(numpy.isnan(data_array), 0, data_array)
+        data_array = numpy.trunc(data_array + numpy.copysign(numpy.float32(0.5), data_array))
+        return numpy.clip(data_array, INT16_MIN, INT16_MAX).astype(numpy.int16)
+
+    def time_calls(function, repeat):
+        start_time = default_timer()
+        for _ in range(repeat):
+            function()
+        return (default_timer() - start_time) / repeat
+
+    arg_parser = argparse.ArgumentParser(description='Micro-benchmark of IndexEngine against the per-index expressions')
+    arg_parser.add_argument('--rows', type=int, default=4000, help='Rows per block (default: 4000)')
+    arg_parser.add_argument('--cols', type=int, default=4000, help='Columns per block (default: 4000)')
+    arg_parser.add_argument('--repeat', type=int, default=10, help='Number of blocks (dates) to time (default: 10)')
+    args = arg_parser.parse_args()
+
+    output_tags = INDEX_TAGS
+
+    # Synthetic six band NBAR block with plausible reflectances and a few zero (no data) pixels
+    random_state = numpy.random.RandomState(0)
+    band_array = random_state.randint(0, 10000, size=(6, args.rows, args.cols)).astype(numpy.float32)
+    band_array[:, ::97, ::89] = 0
+    band_array[:, :args.rows // 2, :args.cols // 2] //= 10 # Dark enough for some water
+    band_array[:, 1::101, 1::83] = NBAR_NO_DATA_VALUE
+
+    engine = IndexEngine()
+
+    # Check that the fused kernels give the same result as the original expressions
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        reference_dict = calc_indices_per_expression(band_array, output_tags)
+        index_array_dict = engine.calc_indices(band_array, output_tags)
+        for output_tag in output_tags:
+            if index_array_dict[output_tag].dtype == numpy.int16:
+                reference_array = gdal_int16(reference_dict[output_tag])
+            else:
+                reference_array = reference_dict[output_tag]
+            assert numpy.allclose(index_array_dict[output_tag], reference_array, rtol=0, atol=0, equal_nan=True), \
+                '%s differs from per-index expression' % output_tag
+
+        per_expression_seconds = time_calls(lambda: calc_indices_per_expression(band_array, output_tags), args.repeat)
+        engine_seconds = time_calls(lambda: engine.calc_indices(band_array, output_tags), args.repeat)
+
+    logger.info('Block of %d x %d pixels, %d blocks, all of %s', args.rows, args.cols, args.repeat, ', '.join(output_tags))
+    # N.B: The per-index figure excludes the Float32 to Int16 conversion which GDAL performs on write
+    logger.info('Per-index expressions: %.4fs per block', per_expression_seconds)
+    logger.info('IndexEngine:           %.4fs per block (%.2fx), %.1fMB scratch',
+                engine_seconds, per_expression_seconds / engine_seconds, engine.nbytes / 1048576.0)
+
@@ -0,0 +1,504 @@
+'''
+Created on 16/10/2026
+
+Offline benchmark of IndexStacker on synthetic NBAR and PQA tiles
+'''
+import os
+import sys
+import json
+import hashlib
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import multiprocessing
+import tempfile
+import numpy
+from datetime import datetime, timedelta
+from timeit import default_timer
+from osgeo import gdal, osr
+
+from index_stacker_copy import IndexStacker, temporal_stats_numexpr_module
+from index_engine import INDEX_REGISTRY, INDEX_TAGS
+from vrt2bin import vrt2bin
+from stage_profiler import StageProfiler, get_cpu_seconds, get_peak_rss_mb, get_children_peak_rss_mb, reset_peak_rss
+
+NBAR_BANDS = 6
+NBAR_NO_DATA_VALUE = -999
+PQA_GOOD_VALUE = 16383 # All PQA tests passed
+PQA_CLOUD_BITS = (1 << 10) | (1 << 11) # ACCA and Fmask cloud tests
+PATCH_SIZE = 40 # Size in pixels of uniform patches in synthetic tiles
+TILE_TYPE_INFO = {'crs': 'EPSG:4326',
+                  'file_extension': '.tif',
+                  'file_format': 'GTiff',
+                  'format_options': 'COMPRESS=LZW,BIGTIFF=YES',
+                  'x_pixel_size': 0.00025,
+                  'y_pixel_size': 0.00025,
+                  'x_size': 1.0,
+                  'y_size': 1.0}
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+class BenchmarkStacker(IndexStacker):
+    """
+    IndexStacker which runs without the database, for derive_datasets() calls on synthetic tiles.
+    Every lock succeeds because nothing else writes to the benchmark directory.
+    """
+    def __init__(self, output_dir):
+        # Stacker.__init__() is not called because it parses the command line and connects to the database
+        self.output_dir = output_dir
+        self.refresh = True
+        self.debug = False
+
+    def lock_object(self, lock_object, *args, **kwargs):
+        return True
+
+    def unlock_object(self, lock_object, *args, **kwargs):
+        return True
+
+
+def get_patch_array(random_state, tile_size, low, high, dtype):
+    """Returns a (tile_size, tile_size) array of random values from low to high in square patches
+    of PATCH_SIZE pixels, so that tiles compress roughly as real imagery does"""
+    patch_count = tile_size // PATCH_SIZE + 1
+    patch_array = random_state.randint(low, high, (patch_count, patch_count)).astype(dtype)
+    return numpy.repeat(numpy.repeat(patch_array, PATCH_SIZE, axis=0), PATCH_SIZE, axis=1)[:tile_size, :tile_size]
+
+
+def create_synthetic_tile(tile_path, band_array_list, no_data_value, x_index, y_index):
+    """Creates an Int16 GTiff tile with one band for each array in band_array_list"""
+    tile_size = band_array_list[0].shape[0]
+    gdal_driver = gdal.GetDriverByName(TILE_TYPE_INFO['file_format'])
+    tile_dataset = gdal_driver.Create(tile_path, tile_size, tile_size, len(band_array_list), gdal.GDT_Int16,
+                                      TILE_TYPE_INFO['format_options'].split(','))
+    assert tile_dataset, 'Unable to create tile %s' % tile_path
+    tile_dataset.SetGeoTransform((x_index, TILE_TYPE_INFO['x_size'] / tile_size, 0.0,
+                                  y_index + TILE_TYPE_INFO['y_size'], 0.0, -TILE_TYPE_INFO['y_size'] / tile_size))
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.SetWellKnownGeogCS('WGS84')
+    tile_dataset.SetProjection(spatial_reference.ExportToWkt())
+
+    for band_index, band_array in enumerate(band_array_list):
+        tile_band = tile_dataset.GetRasterBand(band_index + 1)
+        tile_band.WriteArray(band_array)
+        if no_data_value is not None:
+            tile_band.SetNoDataValue(no_data_value)
+    tile_dataset.FlushCache()
+
+
+def get_tile_info(level_name, tile_path, start_datetime, x_index, y_index):
+    """Returns a tile info dict for derive_datasets() as the Stacker would find in the database"""
+    return {'band_name': level_name,
+            'band_tag': level_name,
+            'end_datetime': start_datetime + timedelta(seconds=24),
+            'end_row': 77,
+            'level_name': level_name,
+            'nodata_value': NBAR_NO_DATA_VALUE if level_name == 'NBAR' else None,
+            'path': 91,
+            'satellite_tag': 'LS7',
+            'sensor_name': 'ETM+',
+            'start_datetime': start_datetime,
+            'start_row': 77,
+            'tile_layer': 1,
+            'tile_pathname': tile_path,
+            'x_index': x_index,
+            'y_index': y_index}
+
+
+def create_synthetic_tiles(input_dir, date_count, tile_size=4000, x_index=150, y_index=-25, cloud_fraction=0.2, seed=0):
+    """
+    Creates date_count six-band Int16 NBAR tiles and matching PQA tiles in input_dir, 16 days apart,
+    named as in the datacube. Tiles already in input_dir are reused if they were made with the same
+    parameters, which are recorded in synthetic_tiles.json.
+    returns list of input_dataset_dict arguments for derive_datasets(), one per date
+    """
+    parameters = {'date_count': date_count, 'tile_size': tile_size, 'x_index': x_index, 'y_index': y_index,
+                  'cloud_fraction': cloud_fraction, 'seed': seed}
+    parameter_path = os.path.join(input_dir, 'synthetic_tiles.json')
+    reuse_tiles = False
+    if os.path.exists(parameter_path):
+        with open(parameter_path) as parameter_file:
+            reuse_tiles = json.load(parameter_file) == parameters
+    if not reuse_tiles and os.path.exists(parameter_path):
+        os.remove(parameter_path)
+
+    random_state = numpy.random.RandomState(seed)
+    input_dataset_dict_list = []
+    for date_index in range(date_count):
+        start_datetime = datetime(2000, 1, 1, 23, 46, 12, 722217) + timedelta(days=16 * date_index)
+        tile_name = 'LS7_ETM_%%s_%d_%04d_%s.tif' % (x_index, y_index, start_datetime.strftime('%Y-%m-%dT%H-%M-%S.%f'))
+        nbar_path = os.path.join(input_dir, tile_name % 'NBAR')
+        pqa_path = os.path.join(input_dir, tile_name % 'PQA')
+        input_dataset_dict_list.append({'NBAR': get_tile_info('NBAR', nbar_path, start_datetime, x_index, y_index),
+                                        'PQA': get_tile_info('PQA', pqa_path, start_datetime, x_index, y_index)})
+        if reuse_tiles:
+            continue
+
+        logger.info('Creating synthetic tiles for %s', start_datetime.isoformat())
+        band_array_list = []
+        for band_index in range(NBAR_BANDS):
+            # Reflectance patches with pixel noise. Longer wavelengths are brighter
+            band_array = get_patch_array(random_state, tile_size, 200 + band_index * 300, 2000 + band_index * 800, numpy.int16)
+            band_array += random_state.randint(-50, 50, band_array.shape).astype(numpy.int16)
+            band_array[:, :tile_size // 20] = NBAR_NO_DATA_VALUE # Strip outside the scene edge
+            band_array_list.append(band_array)
+        create_synthetic_tile(nbar_path, band_array_list, NBAR_NO_DATA_VALUE, x_index, y_index)
+
+        pqa_array = numpy.empty((tile_size, tile_size), dtype=numpy.int16)
+        pqa_array[:] = PQA_GOOD_VALUE
+        cloud_array = get_patch_array(random_state, tile_size, 0, 1000, numpy.int16) < cloud_fraction * 1000
+        pqa_array[cloud_array] &= ~PQA_CLOUD_BITS
+        create_synthetic_tile(pqa_path, [pqa_array], None, x_index, y_index)
+
+    if not reuse_tiles:
+        with open(parameter_path, 'w') as parameter_file:
+            json.dump(parameters, parameter_file, indent=1, sort_keys=True)
+    return input_dataset_dict_list
+
+
+def get_stack_output_info(output_dir, input_dataset_dict_list):
+    nbar_dataset_info = input_dataset_dict_list[0]['NBAR']
+    return {'x_index': nbar_dataset_info['x_index'],
+            'y_index': nbar_dataset_info['y_index'],
+            'stack_output_dir': output_dir,
+            'start_datetime': None,
+            'end_datetime': None,
+            'satellite': None,
+            'sensor': None}
+
+
+def derive_stacks(index_stacker, input_dataset_dict_list):
+    """
+    Calls index_stacker.derive_datasets() for every date as Stacker.stack_derived() does, planning
+    the jobs and running them with run_derive_jobs() first if workers or pipeline_depth are set.
+    returns stack_info_dict - a dict keyed by stack file name containing a list of tile_info dicts
+    """
+    stack_output_info = get_stack_output_info(index_stacker.output_dir, input_dataset_dict_list)
+
+    if (index_stacker.workers and index_stacker.workers > 1) or index_stacker.pipeline_depth:
+        index_stacker.derive_job_list = []
+        try:
+            for input_dataset_dict in input_dataset_dict_list:
+                index_stacker.derive_datasets(input_dataset_dict, stack_output_info, TILE_TYPE_INFO)
+            derive_job_list = index_stacker.derive_job_list
+        finally:
+            index_stacker.derive_job_list = None
+        index_stacker.run_derive_jobs(derive_job_list)
+        index_stacker.refresh = False # Second pass only collects the outputs just written
+
+    stack_info_dict = {}
+    try:
+        for input_dataset_dict in input_dataset_dict_list:
+            output_dataset_dict = index_stacker.derive_datasets(input_dataset_dict, stack_output_info, TILE_TYPE_INFO)
+            for output_stack_path, output_dataset_info in output_dataset_dict.items():
+                stack_info_dict.setdefault(output_stack_path, []).append(output_dataset_info)
+    finally:
+        index_stacker.refresh = True
+    return stack_info_dict
+
+
+def translate_stacks(index_stacker, stack_info_dict):
+    """
+    Builds the VRT stack file for each list of tiles in stack_info_dict and translates it to Envi
+    returns dict of Envi stack file paths keyed by stack file name
+    """
+    envi_dataset_path_dict = {}
+    for vrt_file in sorted(stack_info_dict.keys()):
+        stack_list = stack_info_dict[vrt_file]
+        vrt_dataset = gdal.BuildVRT(vrt_file, [tile_info['tile_pathname'] for tile_info in stack_list], separate=True)
+        assert vrt_dataset, 'Unable to create stack file %s' % vrt_file
+        vrt_dataset = None # Close dataset to write VRT file
+        envi_dataset_path_dict[vrt_file] = vrt2bin(vrt_file, output_dataset_path=None,
+                                                   file_format='ENVI', file_extension='_envi', format_options=None,
+                                                   layer_name_list=index_stacker.get_layer_name_list(stack_list),
+                                                   no_data_value=stack_list[0]['nodata_value'],
+                                                   overwrite=True, debug=False)
+    return envi_dataset_path_dict
+
+
+def calc_stack_stats(stack_info_dict, envi_dataset_path_dict):
+    for vrt_file in sorted(stack_info_dict.keys()):
+        envi_dataset_path = envi_dataset_path_dict[vrt_file]
+        temporal_stats_numexpr_module.main(envi_dataset_path, envi_dataset_path.replace('_envi', '_stats_envi'),
+                                           noData=stack_info_dict[vrt_file][0]['nodata_value'],
+                                           provenance=True)
+
+
+def get_file_digest(file_path):
+    with open(file_path, 'rb') as input_file:
+        return hashlib.md5(input_file.read()).hexdigest()
+
+
+def check_windowed_output(work_dir, input_dataset_dict_list, index_tags, max_block_mb):
+    """
+    Derives index_tags for every date once reading whole tiles and once in windows within
+    max_block_mb, which must give more than one window per tile.
+    returns sorted list of the output tile names which are not byte-identical
+    """
+    file_digest_dict_list = [] # Dicts of output file digests keyed by file name
+    for check_name, check_max_block_mb in [('whole', None), ('windowed', max_block_mb)]:
+        output_dir = os.path.join(work_dir, 'check_%s' % check_name)
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+
+        index_stacker = BenchmarkStacker(output_dir)
+        index_stacker.index_tags = index_tags
+        index_stacker.max_block_mb = check_max_block_mb
+        if check_max_block_mb:
+            nbar_dataset = gdal.Open(input_dataset_dict_list[0]['NBAR']['tile_pathname'])
+            window_rows = index_stacker.get_window_rows(nbar_dataset, index_tags)
+            assert window_rows < nbar_dataset.RasterYSize, 'A budget of %gMB reads whole tiles' % check_max_block_mb
+            logger.info('Checking windows of %d rows against whole tiles', window_rows)
+
+        stack_info_dict = derive_stacks(index_stacker, input_dataset_dict_list)
+        file_digest_dict_list.append(dict([(os.path.basename(tile_info['tile_pathname']), get_file_digest(tile_info['tile_pathname']))
+                                           for stack_list in stack_info_dict.values()
+                                           for tile_info in stack_list]))
+
+    whole_digest_dict, windowed_digest_dict = file_digest_dict_list
+    assert sorted(whole_digest_dict.keys()) == sorted(windowed_digest_dict.keys()), 'Windowed outputs are not the same files'
+    return sorted([file_name for file_name in whole_digest_dict if whole_digest_dict[file_name] != windowed_digest_dict[file_name]])
+
+
+class IndexStackerBenchmark(object):
+    """
+    Times the stages of IndexStacker on synthetic tiles. Each benchmark is run repeat times in a
+    clean output directory and the wall time, CPU time and peak RSS of every run are recorded.
+
+    Benchmarks:
+        pqa_mask: Stacker.get_pqa_mask() for every date, without the PQA mask cache
+        derive_<index>: derive_datasets() for every date creating only that index
+        derive_all: derive_datasets() for every date creating all the benchmarked indices in one pass
+        translate: building the VRT stack of every index and translating it to Envi
+        stats: temporal_stats_numexpr_module for every Envi stack
+    """
+    def __init__(self, work_dir, index_tags=None, repeat=3, stacker_kwargs=None):
+        self.work_dir = work_dir
+        self.input_dir = os.path.join(work_dir, 'input')
+        self.output_dir = os.path.join(work_dir, 'output')
+        self.index_tags = index_tags or INDEX_TAGS
+        self.repeat = repeat
+        self.stacker_kwargs = stacker_kwargs or {}
+        self.result_dict = {}
+        self.profile = None
+
+    def get_stacker(self, index_tags):
+        """Returns a BenchmarkStacker for index_tags writing to an empty output directory"""
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+
+        index_stacker = BenchmarkStacker(self.output_dir)
+        index_stacker.index_tags = index_tags
+        for attribute_name, value in self.stacker_kwargs.items():
+            setattr(index_stacker, attribute_name, value)
+        return index_stacker
+
+    def time_benchmark(self, benchmark_name, function, pixel_count, setup_function=None):
+        """
+        Runs function(setup_function()) self.repeat times, timing function only, and records
+        the results under benchmark_name. pixel_count is the number of pixels processed by one run.
+        CPU time includes that of worker processes which finish within the run. Peak RSS of this
+        process is recorded for each run as peak_rss_mb where it can be reset (Linux), or otherwise
+        as lifetime_peak_rss_mb. largest_child_peak_rss_mb is the largest peak of any worker process
+        finished so far, not only in this run.
+        returns the result of the last run
+        """
+        run_list = []
+        for _repeat_index in range(self.repeat):
+            setup_result = setup_function() if setup_function else None
+            peak_rss_reset = reset_peak_rss()
+            start_seconds = default_timer()
+            start_cpu_seconds = get_cpu_seconds(include_children=True)
+            result = function(setup_result)
+            wall_seconds = default_timer() - start_seconds
+            run_list.append({'wall_seconds': wall_seconds,
+                             'cpu_seconds': get_cpu_seconds(include_children=True) - start_cpu_seconds,
+                             'peak_rss_mb' if peak_rss_reset else 'lifetime_peak_rss_mb': get_peak_rss_mb(),
+                             'largest_child_peak_rss_mb': get_children_peak_rss_mb()})
+
+        wall_seconds_list = sorted([run['wall_seconds'] for run in run_list])
+        self.result_dict[benchmark_name] = {'runs': run_list,
+                                            'min_seconds': wall_seconds_list[0],
+                                            'median_seconds': wall_seconds_list[len(wall_seconds_list) // 2],
+                                            'mpixels_per_second': pixel_count / wall_seconds_list[0] / 1e6 if wall_seconds_list[0] else None}
+        logger.info('%-16s min %8.2fs median %8.2fs %8.1f Mpixels/s', benchmark_name,
+                    self.result_dict[benchmark_name]['min_seconds'], self.result_dict[benchmark_name]['median_seconds'],
+                    self.result_dict[benchmark_name]['mpixels_per_second'] or 0.0)
+        return result
+
+    def run(self, input_dataset_dict_list):
+        """Runs every benchmark on the tiles of input_dataset_dict_list from create_synthetic_tiles()"""
+        nbar_dataset = gdal.Open(input_dataset_dict_list[0]['NBAR']['tile_pathname'])
+        pixel_count = nbar_dataset.RasterXSize * nbar_dataset.RasterYSize * len(input_dataset_dict_list)
+        nbar_dataset = None
+
+        def get_pqa_masks(index_stacker):
+            for input_dataset_dict in input_dataset_dict_list:
+                index_stacker.get_pqa_mask(input_dataset_dict['PQA']['tile_pathname'], **index_stacker.get_pqa_mask_kwargs())
+
+        self.time_benchmark('pqa_mask', get_pqa_masks, pixel_count,
+                            lambda: self.get_stacker(self.index_tags))
+
+        for output_tag in self.index_tags:
+            self.time_benchmark('derive_%s' % output_tag,
+                                lambda index_stacker: derive_stacks(index_stacker, input_dataset_dict_list),
+                                pixel_count, lambda: self.get_stacker([output_tag]))
+
+        # Profile the stages of the last full derivation, including PQA masking of each index
+        def get_profiled_stacker():
+            index_stacker = self.get_stacker(self.index_tags)
+            index_stacker.profiler = StageProfiler()
+            return index_stacker
+
+        def derive_all(new_index_stacker):
+            stack_info_dict = derive_stacks(new_index_stacker, input_dataset_dict_list)
+            self.profile = new_index_stacker.profiler.get_profile()
+            return new_index_stacker, stack_info_dict
+
+        index_stacker, stack_info_dict = self.time_benchmark('derive_all', derive_all, pixel_count * len(self.index_tags),
+                                                             get_profiled_stacker)
+
+        envi_dataset_path_dict = self.time_benchmark('translate',
+                                                     lambda _setup_result: translate_stacks(index_stacker, stack_info_dict),
+                                                     pixel_count * len(stack_info_dict))
+
+        # Water frequency is accumulated while deriving, as in index_stacker
+        stats_stack_info_dict = dict([(vrt_file, stack_list) for vrt_file, stack_list in stack_info_dict.items()
+                                      if INDEX_REGISTRY[stack_list[0]['band_tag'].split('-')[0]]['summary'] == 'stats'])
+        self.time_benchmark('stats', lambda _setup_result: calc_stack_stats(stats_stack_info_dict, envi_dataset_path_dict),
+                            pixel_count * len(stats_stack_info_dict))
+
+    def get_results(self, parameters):
+        """Returns a dict of the benchmark results with the host and parameters they were run with"""
+        return {'created': datetime.now().isoformat(),
+                'host': {'hostname': socket.gethostname(),
+                         'platform': platform.platform(),
+                         'cpu_count': multiprocessing.cpu_count(),
+                         'python': platform.python_version(),
+                         'numpy': numpy.__version__,
+                         'gdal': gdal.__version__},
+                'parameters': parameters,
+                'results': self.result_dict,
+                'profile': self.profile}
+
+
+def compare_results(results, baseline_results, tolerance):
+    """
+    Logs the ratio of the minimum time of each benchmark in results to that in baseline_results
+    returns list of names of benchmarks more than tolerance (a fraction) slower than the baseline
+    """
+    if results['parameters'] != baseline_results['parameters']:
+        logger.warning('Benchmark parameters differ from the baseline: %s and %s',
+                       results['parameters'], baseline_results['parameters'])
+
+    regression_list = []
+    for benchmark_name in sorted(results['results'].keys()):
+        baseline_result = baseline_results['results'].get(benchmark_name)
+        if not baseline_result or not baseline_result['min_seconds']:
+            logger.info('%-16s not in baseline', benchmark_name)
+            continue
+
+        ratio = results['results'][benchmark_name]['min_seconds'] / baseline_result['min_seconds']
+        if ratio > 1.0 + tolerance:
+            regression_list.append(benchmark_name)
+        logger.info('%-16s %6.2f times baseline%s', benchmark_name, ratio,
+                    ' - REGRESSION' if ratio > 1.0 + tolerance else '')
+    return regression_list
+
+
+if __name__ == '__main__':
+    def parse_args():
+        arg_parser = argparse.ArgumentParser(description='Benchmarks IndexStacker on synthetic NBAR and PQA tiles without the datacube')
+        arg_parser.add_argument('-o', '--output', dest='result_path', required=True,
+                                help='JSON file for the benchmark results')
+        arg_parser.add_argument('--dates', dest='date_count', type=int, default=10,
+                                help='Number of acquisition dates (default: 10)')
+        arg_parser.add_argument('--tile-size', dest='tile_size', type=int, default=4000,
+                                help='Tile width and height in pixels (default: 4000)')
+        arg_parser.add_argument('--cloud-fraction', dest='cloud_fraction', type=float, default=0.2,
+                                help='Fraction of each PQA tile flagged as cloud (default: 0.2)')
+        arg_parser.add_argument('--seed', dest='seed', type=int, default=0,
+                                help='Random seed for the synthetic tiles (default: 0)')
+        arg_parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                                help='Number of times each benchmark is run (default: 3)')
+        arg_parser.add_argument('--indices', dest='index_tags', default=None,
+                                help='Comma-separated list of indices to benchmark (default: %s)' % ','.join(INDEX_TAGS))
+        arg_parser.add_argument('--work-dir', dest='work_dir', default=None,
+                                help='Directory for synthetic tiles and outputs, kept after the benchmark so tiles can be ' +
+                                     'reused (default: a temporary directory which is removed)')
+        arg_parser.add_argument('--max-block-mb', dest='max_block_mb', type=float, default=None,
+                                help='IndexStacker memory budget in MB for each NBAR read window (default: read whole tiles)')
+        arg_parser.add_argument('--workers', dest='workers', type=int, default=None,
+                                help='IndexStacker worker processes (default: derive in this process)')
+        arg_parser.add_argument('--pipeline-depth', dest='pipeline_depth', type=int, default=None,
+                                help='IndexStacker NBAR windows read ahead (default: no pipeline)')
+        arg_parser.add_argument('--check-windows', dest='check_max_block_mb', type=float, default=None,
+                                help='Before benchmarking, check that outputs derived in windows within this memory budget ' +
+                                     'in MB are byte-identical to those from whole tiles. Exits with status 1 if not')
+        arg_parser.add_argument('--compare', dest='baseline_path', default=None,
+                                help='Results file of an earlier run to compare with. Exits with status 1 on a regression')
+        arg_parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.1,
+                                help='Fraction by which a benchmark may be slower than the baseline (default: 0.1)')
+        args = arg_parser.parse_args()
+
+        if args.index_tags:
+            args.index_tags = [output_tag.strip().upper() for output_tag in args.index_tags.split(',')]
+            for output_tag in args.index_tags:
+                assert output_tag in INDEX_REGISTRY, 'Unknown index %s (--indices)' % output_tag
+        return args
+
+    # Main function starts here
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='index_stacker_benchmark_')
+    stacker_kwargs = {'max_block_mb': args.max_block_mb,
+                      'workers': args.workers,
+                      'pipeline_depth': args.pipeline_depth}
+    parameters = {'date_count': args.date_count,
+                  'tile_size': args.tile_size,
+                  'cloud_fraction': args.cloud_fraction,
+                  'seed': args.seed,
+                  'repeat': args.repeat,
+                  'index_tags': args.index_tags or INDEX_TAGS,
+                  'stacker': stacker_kwargs}
+
+    try:
+        benchmark = IndexStackerBenchmark(work_dir, args.index_tags, args.repeat, stacker_kwargs)
+        if not os.path.isdir(benchmark.input_dir):
+            os.makedirs(benchmark.input_dir)
+        input_dataset_dict_list = create_synthetic_tiles(benchmark.input_dir, args.date_count, args.tile_size,
+                                                         cloud_fraction=args.cloud_fraction, seed=args.seed)
+        if args.check_max_block_mb:
+            mismatch_list = check_windowed_output(work_dir, input_dataset_dict_list, benchmark.index_tags, args.check_max_block_mb)
+            if mismatch_list:
+                logger.error('%d windowed outputs differ from whole tile outputs: %s', len(mismatch_list), ', '.join(mismatch_list))
+                sys.exit(1)
+            logger.info('Windowed outputs are byte-identical to whole tile outputs')
+        benchmark.run(input_dataset_dict_list)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = benchmark.get_results(parameters)
+    with open(args.result_path, 'w') as result_file:
+        json.dump(results, result_file, indent=1, sort_keys=True)
+    logger.info('Benchmark results written to %s', args.result_path)
+
+    if args.baseline_path:
+        with open(args.baseline_path) as baseline_file:
+            regression_list = compare_results(results, json.load(baseline_file), args.tolerance)
+        if regression_list:
+            logger.error('%d benchmarks slower than baseline: %s', len(regression_list), ', '.join(regression_list))
+            sys.exit(1)
@@ -7,15 +7,27 @@ import os
 import sys
 import logging
 import re
+import argparse
+import threading
+import json
 import numpy
 from datetime import datetime, time
-from osgeo import gdal, gdalconst
-from time import sleep
+from osgeo import gdal, gdalconst, gdal_array
+from timeit import default_timer
+from collections import deque
+from Queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from stacker import Stacker
 from vrt2bin import vrt2bin
 from log_multiline import log_multiline
 from edit_envi_hdr import edit_envi_hdr
+from index_engine import IndexEngine, INDEX_REGISTRY, INDEX_TAGS, WATER_WET, get_index_bands, get_index_definition
+from stack_manifest import StackManifest
+from pqa_mask_cache import PQAMaskCache, PackedMask
+from temporal_stats_accumulator import TemporalStatsAccumulator, WaterFrequencyAccumulator, BlockBuffer
+from temporal_percentiles import TemporalPercentiles, PERCENTILE_LIST
+from stage_profiler import StageProfiler
 
 
 # Add stats path for Joshua Sixsmith's statistical analysis code
@@ -24,6 +36,7 @@ import temporal_stats_numexpr_module
 
 SCALE_FACTOR = 10000
 NaN = numpy.float32(numpy.NaN)
+CHECKPOINT_FILENAME = 'index_stacker_checkpoint.json' # Default checkpoint file for batches of tiles
 
 # Set top level standard output 
 console_handler = logging.StreamHandler(sys.stdout)
@@ -40,6 +53,168 @@ class IndexStacker(Stacker):
     """ Subclass of Stacker
     Used to implement specific functionality to create stacks of derived datasets.
     """
+    max_block_mb = None # Memory budget in MB for each NBAR read window. None reads whole tiles
+    index_engine = None # IndexEngine holding scratch buffers for reuse across calls to derive_datasets
+    index_tags = None # List of output tags to generate from each file. None generates all of INDEX_TAGS
+    workers = None # Number of worker processes for derive_datasets. None or 1 derives in this process
+    derive_job_list = None # List of write_index_datasets() argument tuples collected while planning
+    _manifest = None # StackManifest for self.output_dir
+    adopt_existing = False # Record tiles without a manifest record as current if GDAL can open them, for migrating old output directories
+    direct_stack = None # Interleave ('bsq' or 'bip') for writing Envi stack files directly. None writes tiles and VRT stacks
+    acquisition_list = None # List of derive_datasets() argument tuples collected while planning direct stacks
+    pqa_cache_mb = 0 # Memory budget in MB for PQA masks kept between calls to derive_datasets
+    pqa_cache_dir = None # Directory for PQA masks shared between processes and stackers. None keeps them in memory only
+    pqa_mask_cache = None # PQAMaskCache created on first use
+    pqa_good_pixel_masks = [32767, 16383, 2457] # PQA values of good pixels passed to Stacker.get_pqa_mask()
+    pqa_dilation = 3 # Cloud and cloud shadow dilation in pixels passed to Stacker.get_pqa_mask()
+    streaming_stats = False # Accumulate temporal statistics as outputs are written instead of from the Envi stack files
+    stats_accumulator_dict = None # TemporalStatsAccumulator objects keyed by stack file path
+    stats_target_dict = None # Lists of (output_stack_path, nbar_dataset_info) tuples for the outputs of planned derive jobs, keyed by id of derive job
+    percentile_method = None # TemporalPercentiles method for median and percentile files. None doesn't create them
+    percentile_memory_mb = 256 # Memory budget in MB for calculating percentiles
+    pipeline_depth = None # Number of NBAR windows read ahead of calculation. None reads, calculates and writes in turn
+    pipeline_writers = 2 # Number of writer threads when pipeline_depth is set
+    profiler = StageProfiler(enabled=False) # Replace with an enabled StageProfiler to profile stages
+    pixel_probe = None # Function called for each of probe_pixel_list by probe_window(). None disables probing
+    probe_pixel_list = [] # List of (row, col) tuples passed to pixel_probe
+
+    def stack_derived(self, *args, **kwargs):
+        """ Overrides Stacker.stack_derived() to derive datasets in a pool of self.workers
+        processes or, if self.pipeline_depth is set, in a pipeline which overlaps reading,
+        calculation and writing. Arguments and return value are the same as for
+        Stacker.stack_derived().
+
+        The first pass through Stacker.stack_derived() only collects the outputs still to be
+        written, locking each one so that this process is the single owner of every output tile.
+        The outputs are then written by run_derive_jobs() and the second pass, which finds all
+        outputs in place, creates the stack files.
+        """
+        if (not self.workers or self.workers < 2) and not self.pipeline_depth:
+            return Stacker.stack_derived(self, *args, **kwargs)
+
+        self.run_derive_jobs(self.plan_derive_jobs(*args, **kwargs))
+        return self.stack_planned(*args, **kwargs)
+
+    def plan_derive_jobs(self, *args, **kwargs):
+        """ First pass of stack_derived(). Locks every output still to be written and returns the
+        list of write_index_datasets() argument tuples to write them. Arguments are the same as
+        for Stacker.stack_derived(). If planning fails, the outputs locked so far are unlocked.
+        """
+        self.derive_job_list = []
+        try:
+            Stacker.stack_derived(self, *args, **kwargs)
+            return self.derive_job_list
+        except Exception:
+            for derive_job in self.derive_job_list:
+                self.get_job_stats_feed_list(derive_job, begin=False) # Not added to the statistics
+                for _output_tag, output_tile_path in derive_job[2]:
+                    self.unlock_object(output_tile_path)
+            raise
+        finally:
+            self.derive_job_list = None
+
+    def stack_planned(self, *args, **kwargs):
+        """ Second pass of stack_derived(), once the jobs from plan_derive_jobs() have been run.
+        Arguments and return value are the same as for Stacker.stack_derived().
+        """
+        # Don't rewrite outputs which have just been written when refreshing
+        refresh = self.refresh
+        self.refresh = False
+        try:
+            return Stacker.stack_derived(self, *args, **kwargs)
+        finally:
+            self.refresh = refresh
+
+    def run_derive_jobs(self, derive_job_list):
+        """ Runs write_index_datasets() for every job in derive_job_list in a pool of self.workers
+        processes using iter_derive_jobs() and raises the first error once all jobs are finished.
+        Without a pool, runs all jobs through write_index_datasets_pipelined() in this process.
+        """
+        if not derive_job_list:
+            return
+
+        if not self.workers or self.workers < 2:
+            unfinished_job_list = list(derive_job_list)
+            try:
+                for derive_job in self.write_index_datasets_pipelined(derive_job_list, self.get_job_stats_feed_list):
+                    unfinished_job_list.remove(derive_job)
+                    if derive_job[4] is None: # Stack files are unlocked by stack_direct()
+                        for _output_tag, output_tile_path in derive_job[2]:
+                            self.unlock_object(output_tile_path)
+                        self.record_outputs(derive_job)
+            finally:
+                for derive_job in unfinished_job_list:
+                    self.get_job_stats_feed_list(derive_job, begin=False) # Not added to the statistics
+                    if derive_job[4] is None:
+                        for _output_tag, output_tile_path in derive_job[2]:
+                            self.unlock_object(output_tile_path)
+            return
+
+        error = None
+        for _derive_job, job_error in self.iter_derive_jobs(derive_job_list):
+            error = error or job_error
+
+        if error:
+            raise error
+
+    def iter_derive_jobs(self, derive_job_list):
+        """ Generator which runs write_index_datasets() for every job in derive_job_list in a pool of
+        self.workers processes, unlocking and recording the output tiles of each job as it finishes
+        and adding the BlockBuffer objects returned by the worker to the temporal statistics.
+        Jobs are started in list order and each idle worker takes the next job from the shared queue
+        so no worker waits while jobs remain. Yields (derive_job, error) for each job as it finishes,
+        where error is the exception raised by the job or None.
+        Logs the throughput of each worker once all jobs are finished.
+        """
+        global _pool_stacker
+
+        logger.info('Deriving datasets for %d acquisitions with %d workers', len(derive_job_list), self.workers)
+        worker_stats_dict = {} # Dict keyed by worker process id containing [job_count, output_count, busy_seconds]
+        start_time = default_timer()
+
+        # Worker processes are forked from this one and so inherit this object
+        _pool_stacker = self
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                future_dict = {}
+                for derive_job in derive_job_list:
+                    future_dict[executor.submit(_run_derive_job, derive_job)] = derive_job
+
+                for future in as_completed(future_dict):
+                    derive_job = future_dict[future]
+                    if derive_job[4] is None: # Stack files are unlocked by stack_direct()
+                        for _output_tag, output_tile_path in derive_job[2]:
+                            self.unlock_object(output_tile_path)
+
+                    if future.exception():
+                        logger.error('Unable to derive datasets from %s: %s', derive_job[0], future.exception())
+                        self.get_job_stats_feed_list(derive_job, begin=False) # Not added to the statistics
+                        yield derive_job, future.exception()
+                        continue
+
+                    if derive_job[4] is None:
+                        self.record_outputs(derive_job)
+                    worker_pid, output_count, busy_seconds, profiler_state, block_buffer_list = future.result()
+                    for stats_feed, block_buffer in zip(self.get_job_stats_feed_list(derive_job), block_buffer_list):
+                        if stats_feed and block_buffer:
+                            block_buffer.merge_into(*stats_feed)
+                    self.profiler.merge_state(profiler_state)
+                    worker_stats = worker_stats_dict.setdefault(worker_pid, [0, 0, 0.0])
+                    worker_stats[0] += 1
+                    worker_stats[1] += output_count
+                    worker_stats[2] += busy_seconds
+                    yield derive_job, None
+        finally:
+            _pool_stacker = None
+
+        elapsed_seconds = default_timer() - start_time
+        for worker_pid in sorted(worker_stats_dict.keys()):
+            job_count, output_count, busy_seconds = worker_stats_dict[worker_pid]
+            logger.info('Worker %d: %d acquisitions, %d datasets in %.1fs busy (%.2f datasets/s)',
+                        worker_pid, job_count, output_count, busy_seconds,
+                        output_count / busy_seconds if busy_seconds else 0.0)
+        logger.info('Derived %d acquisitions in %.1fs', len(derive_job_list), elapsed_seconds)
+
     def derive_datasets(self, input_dataset_dict, stack_output_info, tile_type_info):
         """ Overrides abstract function in stacker class. Called in Stacker.stack_derived() function. 
         Creates PQA-masked NDVI stack
@@ -160,24 +335,12 @@ stack_output_info = {'x_index': 144,
 }
         """
         assert type(input_dataset_dict) == dict, 'nbar_dataset_dict must be a dict'
+        
+        if self.acquisition_list is not None:
+            # Planning pass for stack_direct() - nothing is written until all acquisitions are known
+            self.acquisition_list.append((input_dataset_dict, stack_output_info, tile_type_info))
+            return {}
                 
-        # Define lookup dicts
-        dtype = {'NDVI' : gdalconst.GDT_Int16,
-                 'EVI' : gdalconst.GDT_Int16,
-                 'NDSI' : gdalconst.GDT_Int16,
-                 'NDMI' : gdalconst.GDT_Int16,
-                 'SLAVI' : gdalconst.GDT_Float32,
-                 'SATVI' : gdalconst.GDT_Int16,
-                 'WATER' : gdalconst.GDT_Byte}
-
-        no_data_value = {'NDVI' : -32768,
-                 'EVI' : -32768,
-                 'NDSI' : -32768,
-                 'NDMI' : -32768,
-                 'SLAVI' : numpy.nan,
-                 'SATVI' : -32768,
-                 'WATER' : -1}
-    
         log_multiline(logger.debug, input_dataset_dict, 'nbar_dataset_dict', '\t')    
        
         # Test function to copy ORTHO & NBAR band datasets with pixel quality mask applied
@@ -189,26 +352,17 @@ stack_output_info = {'x_index': 144,
         
         nbar_dataset_path = nbar_dataset_info['tile_pathname']
         
-        # Get a boolean mask from the PQA dataset (use default parameters for mask and dilation)
-        pqa_mask = self.get_pqa_mask(input_dataset_dict['PQA']['tile_pathname']) 
-        
-        nbar_dataset = gdal.Open(nbar_dataset_path)
-        assert nbar_dataset, 'Unable to open dataset %s' % nbar_dataset
-        
-        band_array = None;
-        for output_tag in ['NDVI', 'EVI', 'NDSI', 'NDMI', 'SLAVI', 'SATVI', 'WATER']: # List of outputs to generate from each file
-            # TODO: Make the stack file name reflect the date range                    
-            output_stack_path = os.path.join(self.output_dir, 
-                                             re.sub('\+', '', '%s_%+04d_%+04d' % (output_tag,
-                                                                                   stack_output_info['x_index'],
-                                                                                    stack_output_info['y_index'])))
-                                                                                    
-            if stack_output_info['start_datetime']:
-                output_stack_path += '_%s' % stack_output_info['start_datetime'].strftime('%Y%m%d')
-            if stack_output_info['end_datetime']:
-                output_stack_path += '_%s' % stack_output_info['end_datetime'].strftime('%Y%m%d')
-                
-            output_stack_path += '_pqa.vrt'
+        output_tile_path_list = [] # List of (output_tag, output_tile_path) tuples still to be written
+        stats_feed_list = [] # List of get_stats_feed() results for output_tile_path_list
+        stats_target_list = [] # List of (output_stack_path, nbar_dataset_info) tuples for output_tile_path_list
+        derive_job = (nbar_dataset_path,
+                      input_dataset_dict['PQA']['tile_pathname'],
+                      output_tile_path_list,
+                      tile_type_info,
+                      None) # Tiles are written, not stack layers
+
+        for output_tag in self.index_tags or INDEX_TAGS: # List of outputs to generate from each file
+            output_stack_path = self.get_stack_path(output_tag, stack_output_info)
             
             output_tile_path = os.path.join(self.output_dir, re.sub('\.\w+$', tile_type_info['file_extension'],
                                                                     re.sub('NBAR', 
@@ -218,123 +372,906 @@ stack_output_info = {'x_index': 144,
                                                                    )
                                            )
                 
-            # Copy metadata for eventual inclusion in stack file output
-            # This could also be written to the output tile if required
-            output_dataset_info = dict(nbar_dataset_info)
-            output_dataset_info['tile_pathname'] = output_tile_path # This is the most important modification - used to find tiles to stack
-            output_dataset_info['band_name'] = '%s with PQA mask applied' % output_tag
-            output_dataset_info['band_tag'] = '%s-PQA' % output_tag
-            output_dataset_info['tile_layer'] = 1
-            
-            #TODO: Check this with Josh
-            #if no_data_value[output_tag] is NaN:
-            #    output_dataset_info['nodata_value'] = None # Can't SetNoDataValue using NaN
-            #else:
-            output_dataset_info['nodata_value'] = no_data_value[output_tag]
-
-            # Check for existing, valid file
-            if self.refresh or not os.path.exists(output_tile_path) or not gdal.Open(output_tile_path):
+            output_dataset_info = self.get_output_dataset_info(output_tag, nbar_dataset_info, output_tile_path)
+
+            # Check for existing file made from the current inputs and index definition
+            if self.refresh or not self.is_output_current(output_tile_path,
+                                                          self.get_output_fingerprint(derive_job, output_tag)):
 
                 if self.lock_object(output_tile_path): # Test for concurrent writes to the same file
-                    # Read whole nbar_dataset into one array. 
-                    # 62MB for float32 data should be OK for memory depending on what else happens downstream
-                    if band_array is None:
-                        # Convert to float32 for arithmetic
-                        band_array = nbar_dataset.ReadAsArray().astype(numpy.float32)
-                
-                    gdal_driver = gdal.GetDriverByName(tile_type_info['file_format'])
-                    #output_dataset = gdal_driver.Create(output_tile_path, 
-                    #                                    nbar_dataset.RasterXSize, nbar_dataset.RasterYSize,
-                    #                                    1, nbar_dataset.GetRasterBand(1).DataType,
-                    #                                    tile_type_info['format_options'].split(','))
-                    output_dataset = gdal_driver.Create(output_tile_path, 
-                                                        nbar_dataset.RasterXSize, nbar_dataset.RasterYSize,
-                                                        1, dtype[output_tag],
-                                                        tile_type_info['format_options'].split(','))
-                    assert output_dataset, 'Unable to open output dataset %s'% output_dataset                                   
-                    output_dataset.SetGeoTransform(nbar_dataset.GetGeoTransform())
-                    output_dataset.SetProjection(nbar_dataset.GetProjection()) 
-        
-                    output_band = output_dataset.GetRasterBand(1)
-        
-                    # Calculate each output here
-                    # Remember band_array indices are zero-based
-                    if output_tag == 'NDVI':
-                        data_array = numpy.true_divide(band_array[3] - band_array[2], band_array[3] + band_array[2]) * SCALE_FACTOR
-                    elif output_tag == 'EVI':
-                        data_array = 25000 * ((band_array[3] - band_array[2]) / (band_array[3] + (60000 * band_array[2]) - (75000 * band_array[0]) + 10000))
-                    elif output_tag == 'NDSI':   
-                        data_array = numpy.true_divide(band_array[2] - band_array[4], band_array[2] + band_array[4]) * SCALE_FACTOR
-                    elif output_tag == 'NDMI':
-                        data_array = numpy.true_divide(band_array[3] - band_array[4], band_array[3] + band_array[4]) * SCALE_FACTOR
-                    elif output_tag == 'SLAVI':
-                        data_array = numpy.true_divide(band_array[3], (band_array[2] + band_array[4]))
-                    elif output_tag == 'SATVI':
-                        print 'nbar_dataset_path: ', nbar_dataset_path
-                        print 'band_array[:,1747,775]: ', band_array[:,1747,775]
-                        data_array = ((band_array[4] - band_array[2]) / (band_array[4] + band_array[2] + 5000)) *15000 - (band_array[5]/2)
-                    elif output_tag == 'WATER':
-                        data_array = numpy.zeros(band_array[0].shape, dtype=numpy.byte)
-                        #TODO: Call water analysis code here
-                    else:
-                        raise Exception('Invalid operation')
-                                        
-                    if no_data_value[output_tag]:
-                        if output_tag == 'SATVI':
-                            print 'before pq application'
-                            print 'nbar_dataset_path: ', nbar_dataset_path
-                            print 'data_array[1747,775]: ', data_array[1747,775]
-                        self.apply_pqa_mask(data_array, pqa_mask, no_data_value[output_tag])
-                        if output_tag == 'SATVI':
-                            print 'after pq application'
-                            print 'nbar_dataset_path: ', nbar_dataset_path
-                            print 'data_array[1747,775]: ', data_array[1747,775]
-                    
-                    output_band.WriteArray(data_array)
-                    output_band.SetNoDataValue(output_dataset_info['nodata_value'])
-                    output_band.FlushCache()
-                    
-                    # This is not strictly necessary - copy metadata to output dataset
-                    output_dataset_metadata = nbar_dataset.GetMetadata()
-                    if output_dataset_metadata:
-                        output_dataset.SetMetadata(output_dataset_metadata) 
-                        log_multiline(logger.debug, output_dataset_metadata, 'output_dataset_metadata', '\t')    
-                    
-                    output_dataset.FlushCache()
-                    self.unlock_object(output_tile_path)
-                    logger.info('Finished writing dataset %s', output_tile_path)
-                else:
+                    self.manifest.forget(output_tile_path) # Not current until it has been rewritten
+                    self.profiler.count('tiles_to_write')
+                    output_tile_path_list.append((output_tag, output_tile_path))
+                    # Jobs planned for run_derive_jobs() are added to the statistics when they finish
+                    stats_feed_list.append(self.get_stats_feed(output_tag, output_stack_path, nbar_dataset_info,
+                                                               begin=self.derive_job_list is None))
+                    stats_target_list.append((output_stack_path, nbar_dataset_info))
+                else: # Another process owns this tile and records it when written - no need to wait for it
+                    self.profiler.count('tiles_locked')
                     logger.info('Skipped locked dataset %s', output_tile_path)
-                    sleep(5) #TODO: Find a nicer way of dealing with contention for the same output tile
                     
             else:
+                self.profiler.count('tiles_skipped')
                 logger.info('Skipped existing dataset %s', output_tile_path)
         
             output_dataset_dict[output_stack_path] = output_dataset_info
 #                    log_multiline(logger.debug, output_dataset_info, 'output_dataset_info', '\t')    
 
+        if self.derive_job_list is not None:
+            # Planning pass for run_derive_jobs() - outputs are written later by the process pool
+            # and no stack files are to be created yet
+            if output_tile_path_list:
+                self.derive_job_list.append(derive_job)
+                self.set_job_stats_targets(derive_job, stats_target_list)
+            return {}
+
+        if output_tile_path_list:
+            try:
+                self.write_index_datasets(*derive_job, stats_feed_list=stats_feed_list)
+                self.record_outputs(derive_job)
+            finally:
+                for _output_tag, output_tile_path in output_tile_path_list:
+                    self.unlock_object(output_tile_path)
+
         log_multiline(logger.debug, output_dataset_dict, 'output_dataset_dict', '\t')    
         # NDVI dataset processed - return info
         return output_dataset_dict
     
+    def stack_direct(self, *args, **kwargs):
+        """ Alternative to stack_derived() which writes each output straight into its layer of
+        an Envi stack file held open as a numpy.memmap, instead of writing a tile per acquisition,
+        stacking the tiles in a VRT file and translating that to Envi. Arguments are the same as
+        for Stacker.stack_derived().
+        
+        Returns:
+            stack_info_dict: Dict keyed by the stack file names which stack_derived() would use,
+                containing a list of tile info dicts with 'tile_pathname' set to the Envi file and
+                'tile_layer' to the one-based layer in it
+            envi_dataset_path_dict: Dict of Envi stack file paths keyed by the same stack file names
+        """
+        self.acquisition_list = []
+        try:
+            Stacker.stack_derived(self, *args, **kwargs)
+            acquisition_list = self.acquisition_list
+        finally:
+            self.acquisition_list = None
+        
+        stack_info_dict = {}
+        envi_dataset_path_dict = {}
+        if not acquisition_list:
+            return stack_info_dict, envi_dataset_path_dict
+        
+        acquisition_list.sort(key=lambda acquisition: acquisition[0]['NBAR']['start_datetime'])
+        input_path_list = []
+        for input_dataset_dict, _stack_output_info, _tile_type_info in acquisition_list:
+            input_path_list += [input_dataset_dict['NBAR']['tile_pathname'], input_dataset_dict['PQA']['tile_pathname']]
+        
+        stack_file_path_list = [] # List of (output_tag, stack_file_path) tuples still to be written
+        stack_fingerprint_dict = {} # Manifest fingerprints keyed by stack file path
+        output_stack_path_dict = {} # Stack file names used by stack_derived() keyed by stack file path
+        for output_tag in self.index_tags or INDEX_TAGS:
+            output_stack_path = self.get_stack_path(output_tag, acquisition_list[0][1])
+            stack_file_path = os.path.splitext(output_stack_path)[0] + '_envi'
+            
+            stack_list = [self.get_output_dataset_info(output_tag, acquisition_list[layer_index][0]['NBAR'],
+                                                       stack_file_path, layer_index + 1)
+                          for layer_index in range(len(acquisition_list))]
+            stack_info_dict[output_stack_path] = stack_list
+            envi_dataset_path_dict[output_stack_path] = stack_file_path
+            output_stack_path_dict[stack_file_path] = output_stack_path
+            
+            stack_fingerprint_dict[stack_file_path] = self.manifest.fingerprint(input_path_list,
+                                                                                '%s Envi %s' % (get_index_definition(output_tag),
+                                                                                                self.direct_stack))
+            if not self.refresh and self.manifest.is_current(stack_file_path, stack_fingerprint_dict[stack_file_path]):
+                logger.info('Skipped existing stack %s', stack_file_path)
+            elif self.lock_object(stack_file_path):
+                self.manifest.forget(stack_file_path) # Not current until every layer is rewritten
+                self.create_stack_file(stack_file_path, output_tag, acquisition_list[0][0]['NBAR']['tile_pathname'], stack_list)
+                stack_file_path_list.append((output_tag, stack_file_path))
+                if self.is_streaming_summary(output_tag): # Every layer is rewritten
+                    self.get_stats_accumulator(output_stack_path, output_tag, acquisition_list[0][0]['NBAR']['tile_pathname']).reset()
+            else:
+                logger.info('Skipped locked stack %s', stack_file_path)
+        
+        if stack_file_path_list:
+            derive_job_list = [(input_dataset_dict['NBAR']['tile_pathname'],
+                                input_dataset_dict['PQA']['tile_pathname'],
+                                stack_file_path_list,
+                                tile_type_info,
+                                layer_index)
+                               for layer_index, (input_dataset_dict, _stack_output_info, tile_type_info) in enumerate(acquisition_list)]
+            try:
+                if (self.workers and self.workers > 1) or self.pipeline_depth:
+                    for derive_job in derive_job_list:
+                        self.set_job_stats_targets(derive_job, [(output_stack_path_dict[stack_file_path], acquisition_list[derive_job[4]][0]['NBAR'])
+                                                                for _output_tag, stack_file_path in stack_file_path_list])
+                    self.run_derive_jobs(derive_job_list)
+                else:
+                    for derive_job in derive_job_list:
+                        nbar_dataset_info = acquisition_list[derive_job[4]][0]['NBAR']
+                        self.write_index_datasets(*derive_job,
+                                                  stats_feed_list=[self.get_stats_feed(output_tag, output_stack_path_dict[stack_file_path], nbar_dataset_info)
+                                                                   for output_tag, stack_file_path in stack_file_path_list])
+                
+                for _output_tag, stack_file_path in stack_file_path_list:
+                    self.manifest.record(stack_file_path, stack_fingerprint_dict[stack_file_path])
+            finally:
+                for _output_tag, stack_file_path in stack_file_path_list:
+                    self.unlock_object(stack_file_path)
+        
+        logger.info('Finished creating %d Envi stack files in %s.', len(envi_dataset_path_dict), self.output_dir)
+        return stack_info_dict, envi_dataset_path_dict
+
+    def get_layer_name_list(self, stack_list):
+        """ Returns the list of Envi layer names for the tile info dicts in stack_list
+        """
+        return ['Band_%d %s-%s %s' % (tile_index + 1, 
+                                      stack_list[tile_index]['satellite_tag'],
+                                      stack_list[tile_index]['sensor_name'],
+                                      stack_list[tile_index]['start_datetime'].isoformat()
+                                      ) for tile_index in range(len(stack_list))]
+
+    def create_stack_file(self, stack_file_path, output_tag, nbar_dataset_path, stack_list):
+        """ Creates an empty Envi stack file for output_tag with one layer per tile info dict in
+        stack_list and the georeferencing of nbar_dataset_path. The header, including layer names
+        and no-data value, is written once here. Layers are filled by write_index_datasets().
+        """
+        nbar_dataset = gdal.Open(nbar_dataset_path)
+        assert nbar_dataset, 'Unable to open dataset %s' % nbar_dataset_path
+        
+        gdal_driver = gdal.GetDriverByName('ENVI')
+        stack_dataset = gdal_driver.Create(stack_file_path,
+                                           nbar_dataset.RasterXSize, nbar_dataset.RasterYSize,
+                                           len(stack_list), INDEX_REGISTRY[output_tag]['gdal_dtype'],
+                                           ['INTERLEAVE=%s' % self.direct_stack.upper()])
+        assert stack_dataset, 'Unable to create stack file %s' % stack_file_path
+        stack_dataset.SetGeoTransform(nbar_dataset.GetGeoTransform())
+        stack_dataset.SetProjection(nbar_dataset.GetProjection())
+        
+        for layer_index, layer_name in enumerate(self.get_layer_name_list(stack_list)):
+            stack_band = stack_dataset.GetRasterBand(layer_index + 1)
+            stack_band.SetDescription(layer_name)
+            stack_band.SetNoDataValue(INDEX_REGISTRY[output_tag]['no_data_value'])
+        
+        stack_dataset.FlushCache()
+        stack_dataset = None # Close dataset to write header
+        
+        # Make sure the whole file exists for memory mapping. Unwritten space is left sparse
+        with open(stack_file_path, 'r+b') as stack_file:
+            stack_file.truncate(nbar_dataset.RasterXSize * nbar_dataset.RasterYSize * len(stack_list) *
+                                gdal.GetDataTypeSize(INDEX_REGISTRY[output_tag]['gdal_dtype']) // 8)
+        logger.info('Created stack file %s with %d layers', stack_file_path, len(stack_list))
+
+    def open_stack_layer(self, stack_file_path, stack_layer):
+        """ Returns (stack_array, layer_array) for zero-based layer stack_layer of an Envi stack file,
+        where stack_array is a numpy.memmap of the whole file and layer_array the (row, col) view
+        of the layer.
+        """
+        stack_dataset = gdal.Open(stack_file_path)
+        assert stack_dataset, 'Unable to open stack file %s' % stack_file_path
+        
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(stack_dataset.GetRasterBand(1).DataType)
+        if stack_dataset.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE') == 'PIXEL': # BIP
+            stack_array = numpy.memmap(stack_file_path, dtype=dtype, mode='r+',
+                                       shape=(stack_dataset.RasterYSize, stack_dataset.RasterXSize, stack_dataset.RasterCount))
+            return stack_array, stack_array[:, :, stack_layer]
+        else: # BSQ
+            stack_array = numpy.memmap(stack_file_path, dtype=dtype, mode='r+',
+                                       shape=(stack_dataset.RasterCount, stack_dataset.RasterYSize, stack_dataset.RasterXSize))
+            return stack_array, stack_array[stack_layer]
+
+    def write_stack_layer(self, layer_array, data_array, window_start):
+        """ Copies data_array into layer_array starting at row window_start, saturating integer
+        values to the range of the layer data type as GDAL does on write (e.g. -1 into Byte)
+        """
+        if data_array.dtype != layer_array.dtype and data_array.dtype.kind in 'iu' and layer_array.dtype.kind in 'iu':
+            data_info = numpy.iinfo(data_array.dtype)
+            layer_info = numpy.iinfo(layer_array.dtype)
+            data_array = numpy.clip(data_array, max(data_info.min, layer_info.min), min(data_info.max, layer_info.max))
+        
+        layer_array[window_start:window_start + data_array.shape[0]] = data_array
+
+    def get_acquisition_key(self, dataset_info):
+        """ Returns the string identifying the acquisition of a tile info dict in temporal statistics
+        """
+        return '%s %s' % (dataset_info['satellite_tag'], dataset_info['start_datetime'].isoformat())
+
+    def is_streaming_summary(self, output_tag):
+        """ Returns True if the temporal summary of output_tag is accumulated as its outputs are
+        written. Frequency summaries always are, statistics only if streaming_stats is set.
+        """
+        return self.streaming_stats or INDEX_REGISTRY[output_tag]['summary'] == 'frequency'
+
+    def get_stats_accumulator(self, output_stack_path, output_tag, dataset_path):
+        """ Returns the TemporalStatsAccumulator (WaterFrequencyAccumulator for frequency summaries)
+        for the stack file output_stack_path, opening its state (kept next to the stack file) on
+        first use and holding its lock until update_streaming_stats() closes it. dataset_path may be
+        any dataset with the dimensions of the tiles. Existing state is discarded on first use if
+        refresh is set.
+        """
+        if self.stats_accumulator_dict is None:
+            self.stats_accumulator_dict = {}
+        
+        accumulator = self.stats_accumulator_dict.get(output_stack_path)
+        if accumulator is None:
+            dataset = gdal.Open(dataset_path)
+            assert dataset, 'Unable to open dataset %s' % dataset_path
+            if INDEX_REGISTRY[output_tag]['summary'] == 'frequency':
+                accumulator = WaterFrequencyAccumulator(os.path.splitext(output_stack_path)[0] + '_frequency_state',
+                                                        (dataset.RasterYSize, dataset.RasterXSize),
+                                                        INDEX_REGISTRY[output_tag]['no_data_value'],
+                                                        get_index_definition(output_tag),
+                                                        wet_value=WATER_WET)
+            else:
+                accumulator = TemporalStatsAccumulator(os.path.splitext(output_stack_path)[0] + '_stats_state',
+                                                       (dataset.RasterYSize, dataset.RasterXSize),
+                                                       INDEX_REGISTRY[output_tag]['no_data_value'],
+                                                       get_index_definition(output_tag))
+            if self.refresh:
+                accumulator.reset()
+            self.stats_accumulator_dict[output_stack_path] = accumulator
+        return accumulator
+
+    def get_stats_feed(self, output_tag, output_stack_path, nbar_dataset_info, begin=True):
+        """ Returns (accumulator, acquisition_index) for write_index_datasets() to add output_tag
+        data for the acquisition of nbar_dataset_info to as it is written, or None if the summary of
+        output_tag is not streamed (see is_streaming_summary()) or begin is False. An acquisition
+        which is already in the statistics is being rebuilt, so the statistics are discarded and
+        rebuilt by update_streaming_stats().
+        """
+        if not self.is_streaming_summary(output_tag):
+            return None
+        
+        accumulator = self.get_stats_accumulator(output_stack_path, output_tag, nbar_dataset_info['tile_pathname'])
+        acquisition_key = self.get_acquisition_key(nbar_dataset_info)
+        if accumulator.has_acquisition(acquisition_key):
+            logger.info('Rebuilding statistics in %s for %s', accumulator.state_dir, acquisition_key)
+            accumulator.reset()
+        
+        if not begin:
+            return None
+        return accumulator, accumulator.begin_acquisition(acquisition_key,
+                                                          nbar_dataset_info['start_datetime'],
+                                                          nbar_dataset_info['satellite_tag'])
+
+    def update_streaming_stats(self, output_stack_path, stack_list, stats_dataset_path):
+        """ Adds any layers of the stack not already in the temporal statistics for output_stack_path
+        (e.g. tiles written by another run or before streaming_stats was set), saves the
+        statistics state and writes the statistics to stats_dataset_path with the datetime and
+        satellite provenance bands of the max.
+        """
+        output_tag = stack_list[0]['band_tag'].split('-')[0]
+        accumulator = self.get_stats_accumulator(output_stack_path, output_tag, stack_list[0]['tile_pathname'])
+        try:
+            acquisition_key_list = [self.get_acquisition_key(tile_info) for tile_info in stack_list]
+            if [acquisition for acquisition in accumulator.acquisition_list if acquisition['key'] not in acquisition_key_list]:
+                logger.info('Acquisitions have been removed from %s - rebuilding statistics', output_stack_path)
+                accumulator.reset()
+            
+            for acquisition_key, tile_info in zip(acquisition_key_list, stack_list):
+                if not accumulator.has_acquisition(acquisition_key):
+                    accumulator.add_dataset(acquisition_key, tile_info['start_datetime'], tile_info['satellite_tag'],
+                                            tile_info['tile_pathname'], tile_info['tile_layer'])
+            accumulator.save()
+            
+            dataset = gdal.Open(stack_list[0]['tile_pathname'])
+            assert dataset, 'Unable to open dataset %s' % stack_list[0]['tile_pathname']
+            accumulator.write_stats(stats_dataset_path, dataset.GetGeoTransform(), dataset.GetProjection(), provenance=True)
+        finally:
+            # Release the state to other processes
+            del self.stats_accumulator_dict[output_stack_path]
+            accumulator.close()
+
+    def set_job_stats_targets(self, derive_job, stats_target_list):
+        """ Keeps the (output_stack_path, nbar_dataset_info) tuple for each output of derive_job, a
+        tuple of write_index_datasets() arguments planned for run_derive_jobs(), until
+        get_job_stats_feed_list() is called for it
+        """
+        if self.stats_target_dict is None:
+            self.stats_target_dict = {}
+        self.stats_target_dict[id(derive_job)] = stats_target_list
+
+    def get_job_stats_feed_list(self, derive_job, begin=True):
+        """ Returns the stats_feed_list for write_index_datasets() to write derive_job, a job passed
+        to set_job_stats_targets(), beginning its acquisition in the statistics of each output with
+        a streamed summary, and forgets its targets. Returns None if begin is False (e.g. when the
+        job has failed) or the job has no targets.
+        """
+        stats_target_list = (self.stats_target_dict or {}).pop(id(derive_job), None)
+        if not begin or not stats_target_list:
+            return None
+        return [self.get_stats_feed(output_tag, output_stack_path, nbar_dataset_info)
+                for (output_tag, _output_tile_path), (output_stack_path, nbar_dataset_info) in zip(derive_job[2], stats_target_list)]
+
+    def get_block_buffer_list(self, derive_job):
+        """ Returns a BlockBuffer for each output of derive_job with a streamed summary (see
+        is_streaming_summary()), or None for the others, for a pool worker to collect and return
+        """
+        return [BlockBuffer() if self.is_streaming_summary(output_tag) else None
+                for output_tag, _output_tile_path in derive_job[2]]
+
+    @property
+    def manifest(self):
+        """StackManifest for the current output directory"""
+        if self._manifest is None or self._manifest.output_dir != self.output_dir:
+            self._manifest = StackManifest(self.output_dir)
+        return self._manifest
+
+    def get_output_fingerprint(self, derive_job, output_tag):
+        """ Returns the manifest fingerprint for output_tag derived by derive_job, a tuple of
+        write_index_datasets() arguments. This covers the NBAR and PQA input tiles, the index
+        definition and the output format.
+        """
+        nbar_dataset_path, pqa_dataset_path, _output_tile_path_list, tile_type_info, _stack_layer = derive_job
+        return self.manifest.fingerprint([nbar_dataset_path, pqa_dataset_path],
+                                         '%s %s %s' % (get_index_definition(output_tag),
+                                                       tile_type_info['file_format'],
+                                                       tile_type_info['format_options']))
+
+    def is_output_current(self, output_tile_path, fingerprint):
+        """ Returns True if output_tile_path does not need to be rebuilt.
+        Outputs without a manifest record are rebuilt, unless adopt_existing is set for a one-off
+        migration of outputs made before the manifest existed, in which case they are accepted
+        (and recorded with the current fingerprint) if GDAL can open them.
+        """
+        recorded_fingerprint = self.manifest.get_fingerprint(output_tile_path)
+        if recorded_fingerprint is None:
+            if self.adopt_existing and os.path.exists(output_tile_path) and gdal.Open(output_tile_path):
+                logger.info('Adopted existing dataset %s', output_tile_path)
+                self.manifest.record(output_tile_path, fingerprint)
+                return True
+            return False
+
+        return recorded_fingerprint == fingerprint and os.path.exists(output_tile_path)
+
+    def record_outputs(self, derive_job):
+        """ Records every output written by derive_job in the manifest
+        """
+        for output_tag, output_tile_path in derive_job[2]:
+            self.manifest.record(output_tile_path, self.get_output_fingerprint(derive_job, output_tag))
+
+    def apply_pqa_mask(self, data_array, pqa_mask, no_data_value):
+        """ Overrides Stacker.apply_pqa_mask() to also accept a PackedMask from the PQA mask cache,
+        which is applied without unpacking more than a few rows at a time.
+        """
+        if isinstance(pqa_mask, PackedMask):
+            pqa_mask.apply(data_array, no_data_value)
+        else:
+            Stacker.apply_pqa_mask(self, data_array, pqa_mask, no_data_value)
+
+    def get_stack_path(self, output_tag, stack_output_info):
+        """ Returns the path of the temporal stack file for output_tag
+        """
+        # TODO: Make the stack file name reflect the date range                    
+        output_stack_path = os.path.join(self.output_dir, 
+                                         re.sub('\+', '', '%s_%+04d_%+04d' % (output_tag,
+                                                                               stack_output_info['x_index'],
+                                                                                stack_output_info['y_index'])))
+                                                                                
+        if stack_output_info['start_datetime']:
+            output_stack_path += '_%s' % stack_output_info['start_datetime'].strftime('%Y%m%d')
+        if stack_output_info['end_datetime']:
+            output_stack_path += '_%s' % stack_output_info['end_datetime'].strftime('%Y%m%d')
+            
+        output_stack_path += '_pqa.vrt'
+        return output_stack_path
+
+    def get_output_dataset_info(self, output_tag, nbar_dataset_info, output_tile_path, tile_layer=1):
+        """ Returns the tile info dict for output_tag derived from the NBAR tile described by
+        nbar_dataset_info and written to layer tile_layer of output_tile_path
+        """
+        # Copy metadata for eventual inclusion in stack file output
+        # This could also be written to the output tile if required
+        output_dataset_info = dict(nbar_dataset_info)
+        output_dataset_info['tile_pathname'] = output_tile_path # This is the most important modification - used to find tiles to stack
+        output_dataset_info['band_name'] = '%s with PQA mask applied' % output_tag
+        output_dataset_info['band_tag'] = '%s-PQA' % output_tag
+        output_dataset_info['tile_layer'] = tile_layer
+        
+        #TODO: Check this with Josh
+        #if INDEX_REGISTRY[output_tag]['no_data_value'] is NaN:
+        #    output_dataset_info['nodata_value'] = None # Can't SetNoDataValue using NaN
+        #else:
+        output_dataset_info['nodata_value'] = INDEX_REGISTRY[output_tag]['no_data_value']
+        return output_dataset_info
+
+    def get_window_rows(self, nbar_dataset, output_tags):
+        """ Returns the number of rows to read from nbar_dataset per window so that the arrays
+        used to derive one tile stay within self.max_block_mb. These are the float32 bands and
+        the outputs of one window, the bit-packed PQA mask of the whole tile and the IndexEngine
+        scratch buffers. With pipeline_depth, it also covers the pipeline_depth + 1 band windows
+        of write_index_datasets_pipelined() and the copies of the outputs of up to pipeline_depth + 1
+        windows waiting to be written. The budget does not cover making a PQA mask which isn't
+        cached, GDAL's block cache or statistics state.
+        Returns the full tile height if no memory budget has been set.
+        Windows are aligned to the NBAR block height so that no GDAL block is read twice, and
+        are at least one block high however small the budget.
+        """
+        if not self.max_block_mb:
+            return nbar_dataset.RasterYSize
+
+        block_rows = nbar_dataset.GetRasterBand(1).GetBlockSize()[1]
+
+        # float32 copy of every band read plus the outputs for every index, for each window in flight
+        window_count = self.pipeline_depth + 1 if self.pipeline_depth else 1
+        row_bytes = nbar_dataset.RasterXSize * (len(get_index_bands(output_tags)) * 4 * window_count +
+                                                IndexEngine.bytes_per_pixel(output_tags) * (window_count + 1 if self.pipeline_depth else 1))
+        fixed_bytes = (nbar_dataset.RasterYSize * ((nbar_dataset.RasterXSize + 7) // 8) + # PackedMask
+                       IndexEngine.get_scratch_bytes(output_tags, nbar_dataset.RasterXSize))
+
+        window_rows = int((self.max_block_mb * 1024 * 1024 - fixed_bytes) / row_bytes)
+        window_rows = max(window_rows // block_rows, 1) * block_rows
+        return min(window_rows, nbar_dataset.RasterYSize)
+
+    def get_pqa_mask_kwargs(self):
+        """ Returns the keyword arguments for Stacker.get_pqa_mask(). They are all passed explicitly
+        so that they are part of the key of masks shared through pqa_cache_dir
+        """
+        return {'good_pixel_masks': list(self.pqa_good_pixel_masks),
+                'dilation': self.pqa_dilation}
+
+    def get_cached_pqa_mask(self, pqa_dataset_path, mask_shape):
+        """ Returns a bit-packed boolean (row, col) mask_shape mask for the PQA dataset from
+        self.pqa_mask_cache, made with the parameters from get_pqa_mask_kwargs()
+        N.B: The mask is made for the whole tile because dilation needs neighbouring rows
+        """
+        if self.pqa_mask_cache is None:
+            self.pqa_mask_cache = PQAMaskCache(max_bytes=int(self.pqa_cache_mb * 1024 * 1024),
+                                               cache_dir=self.pqa_cache_dir)
+        
+        with self.profiler.stage('pqa_mask'):
+            misses = self.pqa_mask_cache.misses
+            pqa_mask = self.pqa_mask_cache.get_mask(pqa_dataset_path, mask_shape, self.get_pqa_mask,
+                                                    **self.get_pqa_mask_kwargs())
+            if self.pqa_mask_cache.misses > misses: # PQA band was read as 16-bit integers
+                self.profiler.add_bytes('pqa_mask', bytes_read=pqa_mask.shape[0] * pqa_mask.shape[1] * 2)
+        return pqa_mask
+
+    def open_output_bands(self, nbar_dataset, output_tile_path_list, tile_type_info, stack_layer=None):
+        """ Creates an output dataset matching nbar_dataset for each (output_tag, output_tile_path)
+        tuple in output_tile_path_list, or opens the layer stack_layer of each stack file if
+        stack_layer is specified.
+        Returns list of (output_tag, output_tile_path, output_dataset, output_band) tuples, where
+        output_dataset and output_band are the stack array and layer array for stack files
+        """
+        gdal_driver = gdal.GetDriverByName(tile_type_info['file_format'])
+        output_band_list = [] # List of (output_tag, output_tile_path, output_dataset, output_band) tuples
+        for output_tag, output_tile_path in output_tile_path_list:
+            if stack_layer is not None:
+                output_band_list.append((output_tag, output_tile_path) + self.open_stack_layer(output_tile_path, stack_layer))
+                continue
+            
+            #output_dataset = gdal_driver.Create(output_tile_path,
+            #                                    nbar_dataset.RasterXSize, nbar_dataset.RasterYSize,
+            #                                    1, nbar_dataset.GetRasterBand(1).DataType,
+            #                                    tile_type_info['format_options'].split(','))
+            output_dataset = gdal_driver.Create(output_tile_path,
+                                                nbar_dataset.RasterXSize, nbar_dataset.RasterYSize,
+                                                1, INDEX_REGISTRY[output_tag]['gdal_dtype'],
+                                                tile_type_info['format_options'].split(',') +
+                                                INDEX_REGISTRY[output_tag]['creation_options'].get(tile_type_info['file_format'], []))
+            assert output_dataset, 'Unable to open output dataset %s'% output_dataset
+            output_dataset.SetGeoTransform(nbar_dataset.GetGeoTransform())
+            output_dataset.SetProjection(nbar_dataset.GetProjection())
+
+            output_band_list.append((output_tag, output_tile_path, output_dataset, output_dataset.GetRasterBand(1)))
+        return output_band_list
+
+    def read_nbar_window(self, nbar_dataset, band_indices, window_start, window_end, band_array):
+        """ Reads only the bands in band_indices for rows window_start to window_end straight into the
+        float32 (band, row, col) band_array for arithmetic
+        """
+        with self.profiler.stage('read'):
+            for band_position, band_index in enumerate(band_indices):
+                nbar_dataset.GetRasterBand(band_index + 1).ReadAsArray(0, window_start,
+                                                                       nbar_dataset.RasterXSize, window_end - window_start,
+                                                                       buf_obj=band_array[band_position])
+        self.profiler.add_bytes('read', bytes_read=band_array[:len(band_indices)].nbytes)
+
+    def calc_window(self, nbar_dataset_path, band_array, pqa_mask, window_start, window_end, output_tags, band_indices):
+        """ Calculates all outputs for one window of NBAR data in one pass and applies the PQA mask.
+        Returns dict of output arrays keyed by output tag.
+        N.B: Arrays are overwritten by the next call so must be written before then
+        """
+        if self.index_engine is None:
+            self.index_engine = IndexEngine()
+
+        with self.profiler.stage('compute'):
+            index_array_dict = self.index_engine.calc_indices(band_array, output_tags, band_indices)
+
+        for output_tag in output_tags:
+            data_array = index_array_dict[output_tag]
+
+            if INDEX_REGISTRY[output_tag]['no_data_value']:
+                if self.pixel_probe:
+                    self.probe_window('before pqa', nbar_dataset_path, output_tag, band_array, data_array, window_start, window_end)
+                with self.profiler.stage('pqa_mask', output_tag):
+                    self.apply_pqa_mask(data_array, pqa_mask[window_start:window_end],
+                                        INDEX_REGISTRY[output_tag]['no_data_value'])
+                if self.pixel_probe:
+                    self.probe_window('after pqa', nbar_dataset_path, output_tag, band_array, data_array, window_start, window_end)
+
+        return index_array_dict
+
+    def probe_window(self, probe_stage, nbar_dataset_path, output_tag, band_array, data_array, window_start, window_end):
+        """ Calls self.pixel_probe(probe_stage, nbar_dataset_path, output_tag, row, col, band_values, value)
+        for each (row, col) tuple of self.probe_pixel_list in the window from window_start to window_end,
+        where band_values are the NBAR values read for the output and value is the output value.
+        """
+        for row, col in self.probe_pixel_list:
+            if window_start <= row < window_end:
+                self.pixel_probe(probe_stage, nbar_dataset_path, output_tag, row, col,
+                                 band_array[:, row - window_start, col], data_array[row - window_start, col])
+
+    def write_window(self, output_tag, output_band, data_array, window_start, stack_layer=None):
+        """ Writes data_array to output_band from open_output_bands() starting at row window_start
+        """
+        with self.profiler.stage('write', output_tag):
+            if stack_layer is None:
+                output_band.WriteArray(data_array, 0, window_start)
+            else:
+                self.write_stack_layer(output_band, data_array, window_start)
+        self.profiler.add_bytes('write', output_tag, bytes_written=data_array.nbytes)
+
+    def close_output_band(self, nbar_dataset, output_tag, output_tile_path, output_dataset, output_band, stack_layer=None):
+        """ Finishes writing one output from open_output_bands() once all windows have been written
+        """
+        with self.profiler.stage('write', output_tag):
+            if stack_layer is not None:
+                output_dataset.flush()
+                logger.info('Finished writing layer %d of %s', stack_layer + 1, output_tile_path)
+                return
+            
+            output_band.SetNoDataValue(INDEX_REGISTRY[output_tag]['no_data_value'])
+            output_band.FlushCache()
+
+            # This is not strictly necessary - copy metadata to output dataset
+            output_dataset_metadata = nbar_dataset.GetMetadata()
+            if output_dataset_metadata:
+                output_dataset.SetMetadata(output_dataset_metadata)
+                log_multiline(logger.debug, output_dataset_metadata, 'output_dataset_metadata', '\t')
+
+            output_dataset.FlushCache()
+            logger.info('Finished writing dataset %s', output_tile_path)
+
+    def write_index_datasets(self, nbar_dataset_path, pqa_dataset_path, output_tile_path_list,
+                             tile_type_info, stack_layer=None, stats_feed_list=None):
+        """ Creates a PQA-masked output dataset for each (output_tag, output_tile_path) tuple
+        in output_tile_path_list. If stack_layer is specified, each output_tile_path is instead an
+        Envi stack file made by create_stack_file() and the output is written to its zero-based
+        layer stack_layer. If stats_feed_list is specified, each output written is also added
+        to the (accumulator, acquisition_index) tuple from get_stats_feed() at the same position
+        in the list, if there is one. The NBAR dataset is read in windows of whole rows sized by
+        get_window_rows() and every index is calculated and written for one window before the
+        next window is read. Output tiles must be locked and unlocked by the caller.
+        N.B: This function must not use the database because it is run in worker processes
+        by run_derive_jobs().
+
+        Window boundaries do not affect the output - every index is a per-pixel calculation
+        and windows are written in row order, so a single window covering the whole tile
+        produces the same file as any number of smaller ones.
+        """
+        with self.profiler.stage('derive'):
+            nbar_dataset = gdal.Open(nbar_dataset_path)
+            assert nbar_dataset, 'Unable to open dataset %s' % nbar_dataset
+            pqa_mask = self.get_cached_pqa_mask(pqa_dataset_path, (nbar_dataset.RasterYSize, nbar_dataset.RasterXSize))
+
+            output_band_list = self.open_output_bands(nbar_dataset, output_tile_path_list, tile_type_info, stack_layer)
+
+            if self.index_engine is None:
+                self.index_engine = IndexEngine()
+
+            output_tags = [output_tag for output_tag, _output_tile_path in output_tile_path_list]
+            band_indices = get_index_bands(output_tags)
+            window_rows = self.get_window_rows(nbar_dataset, output_tags)
+            logger.debug('Reading %s in windows of %d rows', nbar_dataset_path, window_rows)
+
+            for window_start in range(0, nbar_dataset.RasterYSize, window_rows):
+                window_end = min(window_start + window_rows, nbar_dataset.RasterYSize)
+
+                # Read into a reused float32 buffer
+                band_array = self.index_engine.get_band_buffer(len(band_indices),
+                                                               window_end - window_start,
+                                                               nbar_dataset.RasterXSize)
+                self.read_nbar_window(nbar_dataset, band_indices, window_start, window_end, band_array)
+
+                index_array_dict = self.calc_window(nbar_dataset_path, band_array, pqa_mask, window_start, window_end,
+                                                    output_tags, band_indices)
+
+                for output_index, (output_tag, output_tile_path, output_dataset, output_band) in enumerate(output_band_list):
+                    self.write_window(output_tag, output_band, index_array_dict[output_tag], window_start, stack_layer)
+
+                    if stats_feed_list and stats_feed_list[output_index]:
+                        accumulator, acquisition_index = stats_feed_list[output_index]
+                        accumulator.add_block(acquisition_index, index_array_dict[output_tag], window_start)
+
+            for output_tag, output_tile_path, output_dataset, output_band in output_band_list:
+                self.close_output_band(nbar_dataset, output_tag, output_tile_path, output_dataset, output_band, stack_layer)
+
+    def write_index_datasets_pipelined(self, derive_job_list, get_stats_feed_list=None):
+        """ Generator which does the same as write_index_datasets() for every job in derive_job_list
+        but overlaps reading, calculation and writing. A reader thread reads NBAR windows and PQA
+        masks into a queue up to self.pipeline_depth windows ahead, this thread calculates the
+        outputs for each window, and self.pipeline_writers writer threads write, compress and flush
+        them, each output being written by one thread only. GDAL releases the GIL while reading and
+        writing so the three stages run concurrently. Yields each job once all its outputs are
+        finished. Logs the busy and stalled time of each stage and the mean read queue depth.
+        The reader reuses self.pipeline_depth + 1 window buffers, which this thread returns once
+        each window is calculated, so memory stays within the budget of get_window_rows().
+        If get_stats_feed_list is specified, it is called with each job as its first window is
+        calculated and returns the stats_feed_list for the job, as for write_index_datasets().
+        N.B: Like write_index_datasets(), this function must not use the database.
+        """
+        read_queue = Queue(maxsize=self.pipeline_depth)
+        free_buffer_queue = Queue() # IndexEngine objects whose band buffers are free for the reader
+        for _buffer_index in range(self.pipeline_depth + 1):
+            free_buffer_queue.put(IndexEngine())
+        stage_seconds_dict = {'read': 0.0, 'read stall': 0.0,
+                              'calculate': 0.0, 'read wait': 0.0, 'write wait': 0.0,
+                              'write': 0.0}
+        stage_lock = threading.Lock()
+        queue_depth_list = []
+
+        def add_seconds(stage, start_time):
+            with stage_lock:
+                stage_seconds_dict[stage] += default_timer() - start_time
+
+        def read_jobs():
+            """ Puts (derive_job, window_start, window_end, band_array, pqa_mask, buffer_engine) tuples on
+            read_queue, where band_array is the band buffer of buffer_engine, followed by None when all
+            jobs have been read or by the exception if reading fails
+            """
+            try:
+                for derive_job in derive_job_list:
+                    start_time = default_timer()
+                    nbar_dataset_path, pqa_dataset_path, output_tile_path_list, _tile_type_info, _stack_layer = derive_job
+                    nbar_dataset = gdal.Open(nbar_dataset_path)
+                    assert nbar_dataset, 'Unable to open dataset %s' % nbar_dataset_path
+                    pqa_mask = self.get_cached_pqa_mask(pqa_dataset_path, (nbar_dataset.RasterYSize, nbar_dataset.RasterXSize))
+                    output_tags = [output_tag for output_tag, _output_tile_path in output_tile_path_list]
+                    band_indices = get_index_bands(output_tags)
+                    window_rows = self.get_window_rows(nbar_dataset, output_tags)
+
+                    for window_start in range(0, nbar_dataset.RasterYSize, window_rows):
+                        window_end = min(window_start + window_rows, nbar_dataset.RasterYSize)
+                        add_seconds('read', start_time)
+
+                        start_time = default_timer()
+                        buffer_engine = free_buffer_queue.get() # Wait for a window to be calculated
+                        add_seconds('read stall', start_time)
+
+                        start_time = default_timer()
+                        band_array = buffer_engine.get_band_buffer(len(band_indices),
+                                                                   window_end - window_start,
+                                                                   nbar_dataset.RasterXSize)
+                        self.read_nbar_window(nbar_dataset, band_indices, window_start, window_end, band_array)
+                        add_seconds('read', start_time)
+
+                        start_time = default_timer()
+                        read_queue.put((derive_job, window_start, window_end, band_array, pqa_mask, buffer_engine))
+                        add_seconds('read stall', start_time)
+                        start_time = default_timer()
+                read_queue.put(None)
+            except Exception as error:
+                read_queue.put(error)
+
+        def write_timed(function, *args):
+            start_time = default_timer()
+            function(*args)
+            add_seconds('write', start_time)
+
+        reader_thread = threading.Thread(target=read_jobs, name='NBAR reader')
+        reader_thread.daemon = True # Don't wait for a blocked reader if calculation fails
+        writer_list = [ThreadPoolExecutor(max_workers=1) for _writer_index in range(self.pipeline_writers)]
+        open_job_list = deque() # List of (derive_job, close_future_list) tuples for jobs not yet yielded
+        write_future_list = deque() # Futures for window writes still in progress
+        start_time = default_timer()
+        reader_thread.start()
+        try:
+            current_job = None
+            while True:
+                wait_start_time = default_timer()
+                queue_depth_list.append(read_queue.qsize())
+                read_item = read_queue.get()
+                add_seconds('read wait', wait_start_time)
+                if isinstance(read_item, Exception):
+                    raise read_item
+
+                if read_item is None or read_item[0] is not current_job:
+                    if current_job is not None: # Finish previous job once its windows are written
+                        open_job_list.append((current_job,
+                                              [writer_list[output_index % len(writer_list)].submit(write_timed, self.close_output_band,
+                                                                                                    nbar_dataset, *output_band_info + (current_job[4],))
+                                               for output_index, output_band_info in enumerate(output_band_list)]))
+                    if read_item is None:
+                        break
+
+                    current_job = read_item[0]
+                    nbar_dataset_path, _pqa_dataset_path, output_tile_path_list, tile_type_info, stack_layer = current_job
+                    nbar_dataset = gdal.Open(nbar_dataset_path) # Not shared with the reader thread
+                    assert nbar_dataset, 'Unable to open dataset %s' % nbar_dataset_path
+                    output_band_list = self.open_output_bands(nbar_dataset, output_tile_path_list, tile_type_info, stack_layer)
+                    output_tags = [output_tag for output_tag, _output_tile_path in output_tile_path_list]
+                    band_indices = get_index_bands(output_tags)
+                    stats_feed_list = get_stats_feed_list(current_job) if get_stats_feed_list else None
+
+                calc_start_time = default_timer()
+                _derive_job, window_start, window_end, band_array, pqa_mask, buffer_engine = read_item
+                index_array_dict = self.calc_window(nbar_dataset_path, band_array, pqa_mask, window_start, window_end,
+                                                    output_tags, band_indices)
+                free_buffer_queue.put(buffer_engine) # The outputs are calculated, so the reader can reuse it
+                for output_index, (output_tag, _output_tile_path, _output_dataset, output_band) in enumerate(output_band_list):
+                    # Copy because the calculated arrays are reused for the next window
+                    write_future_list.append(writer_list[output_index % len(writer_list)].submit(write_timed, self.write_window,
+                                                                                                 output_tag, output_band, index_array_dict[output_tag].copy(),
+                                                                                                 window_start, stack_layer))
+                    if stats_feed_list and stats_feed_list[output_index]:
+                        accumulator, acquisition_index = stats_feed_list[output_index]
+                        accumulator.add_block(acquisition_index, index_array_dict[output_tag], window_start)
+                add_seconds('calculate', calc_start_time)
+
+                # Limit memory held by windows waiting to be written
+                wait_start_time = default_timer()
+                while len(write_future_list) > self.pipeline_depth * len(output_band_list):
+                    write_future_list.popleft().result()
+                add_seconds('write wait', wait_start_time)
+
+                while open_job_list and all([close_future.done() for close_future in open_job_list[0][1]]):
+                    finished_job, close_future_list = open_job_list.popleft()
+                    for close_future in close_future_list:
+                        close_future.result()
+                    yield finished_job
+
+            wait_start_time = default_timer()
+            for write_future in write_future_list:
+                write_future.result()
+            while open_job_list:
+                finished_job, close_future_list = open_job_list.popleft()
+                for close_future in close_future_list:
+                    close_future.result()
+                yield finished_job
+            add_seconds('write wait', wait_start_time)
+        finally:
+            for writer in writer_list:
+                writer.shutdown(wait=True)
+
+        elapsed_seconds = default_timer() - start_time
+        self.profiler.add_time('derive', None, elapsed_seconds, 0.0) # CPU time is recorded by the stages within
+        logger.info('Pipeline for %d acquisitions finished in %.1fs', len(derive_job_list), elapsed_seconds)
+        logger.info('Read: %.1fs busy, %.1fs stalled on full queue', stage_seconds_dict['read'], stage_seconds_dict['read stall'])
+        logger.info('Calculate: %.1fs busy, %.1fs waiting for reads, %.1fs waiting for writes',
+                    stage_seconds_dict['calculate'], stage_seconds_dict['read wait'], stage_seconds_dict['write wait'])
+        logger.info('Write: %.1fs busy over %d threads', stage_seconds_dict['write'], len(writer_list))
+        logger.info('Read queue depth: mean %.1f, max %d of %d',
+                    float(sum(queue_depth_list)) / max(len(queue_depth_list), 1),
+                    max(queue_depth_list or [0]), self.pipeline_depth)
+
+
+_pool_stacker = None # IndexStacker inherited by worker processes of IndexStacker.run_derive_jobs()
+
+def _run_derive_job(derive_job):
+    """ Process pool entry point for IndexStacker.iter_derive_jobs()
+    Returns (worker process id, number of datasets written, seconds taken, profiler state for this job,
+    list of BlockBuffer objects or None for each output from IndexStacker.get_block_buffer_list())
+    """
+    start_time = default_timer()
+    _pool_stacker.profiler.reset() # Don't return anything inherited from the parent or previous jobs
+    block_buffer_list = _pool_stacker.get_block_buffer_list(derive_job)
+    stats_feed_list = [(block_buffer, None) if block_buffer else None for block_buffer in block_buffer_list]
+    if _pool_stacker.pipeline_depth:
+        for _derive_job in _pool_stacker.write_index_datasets_pipelined([derive_job], lambda _derive_job: stats_feed_list):
+            pass
+    else:
+        _pool_stacker.write_index_datasets(*derive_job, stats_feed_list=stats_feed_list)
+    return (os.getpid(), len(derive_job[2]), default_timer() - start_time, _pool_stacker.profiler.get_state(),
+            block_buffer_list)
+
 
 if __name__ == '__main__':
-    def assemble_stack(index_stacker):    
+    def parse_index_args():
         """
-        returns stack_info_dict - a dict keyed by stack file name containing a list of tile_info dicts
+        Parses the IndexStacker-specific command line options and removes them from sys.argv
+        so that the Stacker class can parse the remaining options as before.
+        returns argparse namespace object
+        """
+        arg_parser = argparse.ArgumentParser(add_help=False)
+        arg_parser.add_argument('--max-block-mb', dest='max_block_mb', type=float, default=None,
+                                help='Memory budget in MB for the NBAR window, outputs, PQA mask and scratch buffers ' +
+                                     'used to derive each tile, including windows in flight with --pipeline-depth and excluding PQA ' +
+                                     'mask creation (default: read whole tiles)')
+        arg_parser.add_argument('--workers', dest='workers', type=int, default=None,
+                                help='Number of worker processes for deriving datasets (default: derive in this process)')
+        arg_parser.add_argument('--pqa-cache-mb', dest='pqa_cache_mb', type=float, default=0,
+                                help='Memory budget in MB for bit-packed PQA masks kept between acquisitions (default: 0)')
+        arg_parser.add_argument('--pqa-cache-dir', dest='pqa_cache_dir', default=None,
+                                help='Directory for memory-mapped PQA masks shared between runs and stackers')
+        arg_parser.add_argument('--direct-stack', dest='direct_stack', choices=['bsq', 'bip'], default=None,
+                                help='Write outputs straight into Envi stack files with the specified interleave ' +
+                                     'instead of creating tiles and VRT stacks')
+        arg_parser.add_argument('--streaming-stats', dest='streaming_stats', action='store_true', default=False,
+                                help='Accumulate temporal statistics as datasets are derived and keep them for ' +
+                                     'adding new acquisitions, instead of recalculating them from each Envi stack file. ' +
+                                     'They are written to *_streaming_stats_envi without the median, quantile and geometric ' +
+                                     'mean bands of *_stats_envi. The state kept next to each stack file takes %d bytes per ' %
+                                     TemporalStatsAccumulator.get_state_bytes_per_pixel() +
+                                     'pixel (%.0fMB for a 4000 x 4000 tile) on disk and in the page cache' %
+                                     (TemporalStatsAccumulator.get_state_bytes_per_pixel() * 4000 * 4000 / 1048576.0))
+        arg_parser.add_argument('--percentiles', dest='percentile_method', choices=['auto', 'exact', 'histogram'], default=None,
+                                help='Also create median, %s percentile files from each Envi stack file ' % ' & '.join(['%d' % percentile for percentile in PERCENTILE_LIST[1:]]) +
+                                     'using the specified method (default: none)')
+        arg_parser.add_argument('--percentile-memory-mb', dest='percentile_memory_mb', type=float, default=256,
+                                help='Memory budget in MB for calculating percentiles (default: 256)')
+        arg_parser.add_argument('--pipeline-depth', dest='pipeline_depth', type=int, default=None,
+                                help='Number of NBAR windows to read ahead while calculating and writing in separate threads ' +
+                                     '(default: read, calculate and write in turn)')
+        arg_parser.add_argument('--pipeline-writers', dest='pipeline_writers', type=int, default=2,
+                                help='Number of writer threads when --pipeline-depth is set (default: 2)')
+        arg_parser.add_argument('--tile-list', dest='tile_list_file', default=None,
+                                help='File of tiles to process in one batch, one "x_index,y_index" per line, instead of -x and -y')
+        arg_parser.add_argument('--bbox', dest='bbox', default=None,
+                                help='Bounding box "min_lon,min_lat,max_lon,max_lat" of tiles to process in one batch, instead of -x and -y')
+        arg_parser.add_argument('--tile-size', dest='tile_size', type=float, default=1.0,
+                                help='Tile size in degrees for --bbox (default: 1.0)')
+        arg_parser.add_argument('--checkpoint', dest='checkpoint_path', default=None,
+                                help='Checkpoint file recording the tiles finished by a batch so that it can be resumed ' +
+                                     '(default: %s in the output directory)' % CHECKPOINT_FILENAME)
+        arg_parser.add_argument('--profile', dest='profile_path', default=None,
+                                help='Write time, I/O and memory used by each stage and index to the specified JSON file')
+        arg_parser.add_argument('--probe-pixel', dest='probe_pixel_list', action='append', default=[],
+                                help='Log NBAR and output values at "row,col" of every acquisition before and after ' +
+                                     'PQA masking. May be repeated')
+        arg_parser.add_argument('--adopt-existing', dest='adopt_existing', action='store_true', default=False,
+                                help='Record existing tiles which have no manifest record as current if GDAL can open them, ' +
+                                     'once only for output directories made before the manifest existed (default: rebuild them)')
+        arg_parser.add_argument('--indices', dest='index_tags', default=None,
+                                help='Comma-separated list of indices to generate (default: %s)' % ','.join(INDEX_TAGS))
+
+        index_args, sys.argv[1:] = arg_parser.parse_known_args()
+
+        index_args.probe_pixel_list = [tuple([int(value) for value in probe_pixel.split(',')]) 
+                                       for probe_pixel in index_args.probe_pixel_list]
+
+        if index_args.index_tags:
+            index_args.index_tags = [output_tag.strip().upper() for output_tag in index_args.index_tags.split(',')]
+            for output_tag in index_args.index_tags:
+                assert output_tag in INDEX_REGISTRY, 'Unknown index %s (--indices)' % output_tag
+
+        return index_args
+
+    def log_pixel_probe(probe_stage, nbar_dataset_path, output_tag, row, col, band_values, value):
+        """
+        Pixel probe for IndexStacker.pixel_probe which logs the values at each probe pixel
+        """
+        logger.info('%s %s [%d,%d] %s: NBAR %s, %s %s', nbar_dataset_path, output_tag, row, col, probe_stage,
+                    band_values, output_tag, value)
+        
+    def get_stack_kwargs(index_stacker):
+        """
+        returns dict of keyword arguments for stack_derived() or stack_direct()
         """
         def date2datetime(input_date, time_offset=time.min):
             if not input_date:
                 return None
             return datetime.combine(input_date, time_offset)
             
-        stack_info_dict = index_stacker.stack_derived(x_index=index_stacker.x_index, 
-                             y_index=index_stacker.y_index, 
-                             stack_output_dir=index_stacker.output_dir, 
-                             start_datetime=date2datetime(index_stacker.start_date, time.min), 
-                             end_datetime=date2datetime(index_stacker.end_date, time.max), 
-                             satellite=index_stacker.satellite, 
-                             sensor=index_stacker.sensor)
+        return {'x_index': index_stacker.x_index, 
+                'y_index': index_stacker.y_index, 
+                'stack_output_dir': index_stacker.output_dir, 
+                'start_datetime': date2datetime(index_stacker.start_date, time.min), 
+                'end_datetime': date2datetime(index_stacker.end_date, time.max), 
+                'satellite': index_stacker.satellite, 
+                'sensor': index_stacker.sensor}
+        
+    def assemble_stack(index_stacker, planned=False):    
+        """
+        returns stack_info_dict - a dict keyed by stack file name containing a list of tile_info dicts
+        planned - True if the jobs from IndexStacker.plan_derive_jobs() have already been run for this tile
+        """
+        if planned:
+            stack_info_dict = index_stacker.stack_planned(**get_stack_kwargs(index_stacker))
+        else:
+            stack_info_dict = index_stacker.stack_derived(**get_stack_kwargs(index_stacker))
         
         log_multiline(logger.debug, stack_info_dict, 'stack_info_dict', '\t')
         
@@ -345,19 +1282,26 @@ if __name__ == '__main__':
         envi_dataset_path_dict = {}
         for vrt_file in sorted(stack_info_dict.keys()):
             stack_list = stack_info_dict[vrt_file]
-            layer_name_list = ['Band_%d %s-%s %s' % (tile_index + 1, 
-                                                     stack_list[tile_index]['satellite_tag'],
-                                                     stack_list[tile_index]['sensor_name'],
-                                                     stack_list[tile_index]['start_datetime'].isoformat()
-                                                     ) for tile_index in range(len(stack_list))]
-            
-            envi_dataset_path = vrt2bin(vrt_file, output_dataset_path=None,
-                    file_format='ENVI', file_extension='_envi', format_options=None,
-                    layer_name_list=layer_name_list, 
-                    no_data_value=stack_list[0]['nodata_value'], # Will all be the same
-                    overwrite=index_stacker.refresh,
-                    debug=index_stacker.debug)
+            layer_name_list = index_stacker.get_layer_name_list(stack_list)
+            
+            # Only retranslate stacks whose tiles have changed since the last translation,
+            # which is recorded in the manifest against the stack file
+            envi_fingerprint = index_stacker.manifest.fingerprint([tile_info['tile_pathname'] for tile_info in stack_list],
+                                                                  'vrt2bin ENVI no data %r' % stack_list[0]['nodata_value'])
+            
+            overwrite = index_stacker.refresh or not index_stacker.manifest.is_current(vrt_file, envi_fingerprint)
+            if overwrite:
+                index_stacker.manifest.forget(vrt_file)
             
+            with index_stacker.profiler.stage('translate', stack_list[0]['band_tag'].split('-')[0]):
+                envi_dataset_path = vrt2bin(vrt_file, output_dataset_path=None,
+                        file_format='ENVI', file_extension='_envi', format_options=None,
+                        layer_name_list=layer_name_list, 
+                        no_data_value=stack_list[0]['nodata_value'], # Will all be the same
+                        overwrite=overwrite,
+                        debug=index_stacker.debug)
+            
+            index_stacker.manifest.record(vrt_file, envi_fingerprint)
             envi_dataset_path_dict[vrt_file] = envi_dataset_path
             
         logger.info('Finished translating %d temporal stack files to Envi in %s.', len(envi_dataset_path_dict), index_stacker.output_dir)
@@ -369,37 +1313,104 @@ if __name__ == '__main__':
             envi_dataset_path = envi_dataset_path_dict[vrt_file]
             stack_list = stack_info_dict[vrt_file]
             
-            if vrt_file.find('WATER') > -1: # Don't run stats on water analysis
-                continue
-            
-            stats_dataset_path = envi_dataset_path.replace('_envi', '_stats_envi')
+            output_tag = stack_list[0]['band_tag'].split('-')[0]
+            if INDEX_REGISTRY[output_tag]['summary'] == 'frequency': # Wet and clear observation counts of water analysis
+                stats_dataset_path = envi_dataset_path.replace('_envi', '_frequency_envi')
+                stats_module_name = 'WaterFrequencyAccumulator'
+            elif index_stacker.streaming_stats: # Fewer bands than temporal_stats_numexpr_module, so a different file
+                stats_dataset_path = envi_dataset_path.replace('_envi', '_streaming_stats_envi')
+                stats_module_name = 'TemporalStatsAccumulator'
+            else:
+                stats_dataset_path = envi_dataset_path.replace('_envi', '_stats_envi')
+                stats_module_name = 'temporal_stats_numexpr_module'
             stats_dataset_path_dict[vrt_file] = stats_dataset_path
             
-            if os.path.exists(stats_dataset_path) and not index_stacker.refresh:
+            # Stats are current if the Envi file has not been rewritten since they were calculated
+            stats_fingerprint = index_stacker.manifest.fingerprint([envi_dataset_path],
+                                                                   '%s no data %r provenance' % (stats_module_name,
+                                                                                                 stack_list[0]['nodata_value']))
+            
+            if index_stacker.manifest.is_current(stats_dataset_path, stats_fingerprint) and not index_stacker.refresh:
                 logger.info('Skipping existing stats file %s', stats_dataset_path)
                 continue
             
+            index_stacker.manifest.forget(stats_dataset_path)
             logger.info('Calculating temporal summary stats for %s', envi_dataset_path)
-            #TODO: fix temporal_stats_numexpr_module so it still edits hdr file properly
-            temporal_stats_numexpr_module.main(envi_dataset_path, stats_dataset_path, 
-                                               noData=stack_list[0]['nodata_value'],
-                                               provenance=True # Create two extra bands for datetime and satellite provenance
-                                               )
+            with index_stacker.profiler.stage('stats', output_tag):
+                if index_stacker.is_streaming_summary(output_tag):
+                    # Only acquisitions not added while deriving datasets are read
+                    index_stacker.update_streaming_stats(vrt_file, stack_list, stats_dataset_path)
+                else:
+                    #TODO: fix temporal_stats_numexpr_module so it still edits hdr file properly
+                    temporal_stats_numexpr_module.main(envi_dataset_path, stats_dataset_path, 
+                                                       noData=stack_list[0]['nodata_value'],
+                                                       provenance=True # Create two extra bands for datetime and satellite provenance
+                                                       )
+            index_stacker.manifest.record(stats_dataset_path, stats_fingerprint)
             
         logger.info('Finished calculating %d temporal summary stats files in %s.', len(stats_dataset_path_dict), index_stacker.output_dir)
         return stats_dataset_path_dict
         
+    def calc_percentiles(index_stacker, stack_info_dict, envi_dataset_path_dict):
+        percentile_dataset_path_dict = {}
+        temporal_percentiles = TemporalPercentiles(max_memory_mb=index_stacker.percentile_memory_mb,
+                                                   method=index_stacker.percentile_method)
+        for vrt_file in sorted(stack_info_dict.keys()):
+            envi_dataset_path = envi_dataset_path_dict[vrt_file]
+            stack_list = stack_info_dict[vrt_file]
+            
+            output_tag = stack_list[0]['band_tag'].split('-')[0]
+            if INDEX_REGISTRY[output_tag]['summary'] != 'stats': # Don't run percentiles on water analysis
+                continue
+            
+            percentile_dataset_path = envi_dataset_path.replace('_envi', '_percentiles_envi')
+            percentile_dataset_path_dict[vrt_file] = percentile_dataset_path
+            
+            percentile_fingerprint = index_stacker.manifest.fingerprint([envi_dataset_path],
+                                                                        'TemporalPercentiles %r %s %d no data %r' % (PERCENTILE_LIST,
+                                                                                                                    index_stacker.percentile_method,
+                                                                                                                    temporal_percentiles.bins,
+                                                                                                                    stack_list[0]['nodata_value']))
+            
+            if index_stacker.manifest.is_current(percentile_dataset_path, percentile_fingerprint) and not index_stacker.refresh:
+                logger.info('Skipping existing percentile file %s', percentile_dataset_path)
+                continue
+            
+            index_stacker.manifest.forget(percentile_dataset_path)
+            with index_stacker.profiler.stage('percentiles', output_tag):
+                temporal_percentiles.calc(envi_dataset_path, percentile_dataset_path, 
+                                          no_data_value=stack_list[0]['nodata_value'],
+                                          value_range=INDEX_REGISTRY[output_tag]['value_range'])
+            
+            percentile_dataset = gdal.Open(percentile_dataset_path, gdalconst.GA_Update)
+            metadata = percentile_dataset.GetMetadata()
+            metadata['start_datetime'] = stack_list[0]['start_datetime'].isoformat()
+            metadata['end_datetime'] = stack_list[-1]['end_datetime'].isoformat()
+            percentile_dataset.SetMetadata(metadata)
+            percentile_dataset.SetDescription('Temporal percentiles for %s' % stack_list[0]['band_name'])
+            percentile_dataset.FlushCache()
+            percentile_dataset = None
+            
+            index_stacker.manifest.record(percentile_dataset_path, percentile_fingerprint)
+            
+        logger.info('Finished calculating %d temporal percentile files in %s.', len(percentile_dataset_path_dict), index_stacker.output_dir)
+        return percentile_dataset_path_dict
+        
     def update_stats_metadata(index_stacker, stack_info_dict, envi_dataset_path_dict, stats_dataset_path_dict):
         for vrt_file in sorted(stack_info_dict.keys()):
             stats_dataset_path = stats_dataset_path_dict.get(vrt_file)
-            if not stats_dataset_path: # Don't proceed if no stats file (e.g. WATER)
+            if not stats_dataset_path: # Don't proceed if no stats file
                 continue
             
             stack_list = stack_info_dict[vrt_file]
             envi_dataset_path = envi_dataset_path_dict[vrt_file]
             start_datetime = stack_list[0]['start_datetime']
             end_datetime = stack_list[-1]['end_datetime']
-            description = 'Statistical summary for %s' % stack_list[0]['band_name']
+            index_info = INDEX_REGISTRY[stack_list[0]['band_tag'].split('-')[0]]
+            if index_info['summary'] == 'frequency':
+                description = 'Water observation frequency for %s' % stack_list[0]['band_name']
+            else:
+                description = 'Statistical summary for %s' % stack_list[0]['band_name']
 
             # Reopen output file and write source dataset to metadata
             stats_dataset = gdal.Open(stats_dataset_path, gdalconst.GA_Update)
@@ -415,22 +1426,180 @@ if __name__ == '__main__':
             
         
                      
+    def process_tile(index_stacker, planned=False):
+        """
+        Creates the stack, stats and percentile files for the tile index_stacker.x_index, index_stacker.y_index
+        planned - True if the jobs from IndexStacker.plan_derive_jobs() have already been run for this tile
+        """
+        if index_stacker.direct_stack:
+            with index_stacker.profiler.stage('direct_stack'):
+                stack_info_dict, envi_dataset_path_dict = index_stacker.stack_direct(**get_stack_kwargs(index_stacker))
+        else:
+            with index_stacker.profiler.stage('assemble'): # Includes deriving datasets unless already planned
+                stack_info_dict = assemble_stack(index_stacker, planned)
+            envi_dataset_path_dict = translate_stacks_to_envi(index_stacker, stack_info_dict)
+        stats_dataset_path_dict = calc_stats(index_stacker, stack_info_dict, envi_dataset_path_dict)
+        with index_stacker.profiler.stage('metadata'):
+            update_stats_metadata(index_stacker, stack_info_dict, envi_dataset_path_dict, stats_dataset_path_dict)
+        if index_stacker.percentile_method:
+            calc_percentiles(index_stacker, stack_info_dict, envi_dataset_path_dict)
+        
+    def get_batch_tile_list(index_args):
+        """
+        returns list of (x_index, y_index) tuples from the --tile-list file and --bbox
+        """
+        tile_list = []
+        if index_args.tile_list_file:
+            with open(index_args.tile_list_file) as tile_list_file:
+                for line in tile_list_file:
+                    line = line.split('#')[0].strip()
+                    if line:
+                        x_index, y_index = re.split('[,\s]+', line)[:2]
+                        tile_list.append((int(x_index), int(y_index)))
+        
+        if index_args.bbox:
+            min_lon, min_lat, max_lon, max_lat = [float(value) for value in index_args.bbox.split(',')]
+            for y_index in range(int(numpy.floor(min_lat / index_args.tile_size)), int(numpy.ceil(max_lat / index_args.tile_size))):
+                for x_index in range(int(numpy.floor(min_lon / index_args.tile_size)), int(numpy.ceil(max_lon / index_args.tile_size))):
+                    tile_list.append((x_index, y_index))
+        
+        # Remove duplicates, keeping the first
+        return [tile for tile_index, tile in enumerate(tile_list) if tile not in tile_list[:tile_index]]
+        
+    def load_checkpoint(checkpoint_path):
+        """
+        returns set of (x_index, y_index) tuples for the tiles already finished
+        """
+        if not os.path.exists(checkpoint_path):
+            return set()
+        with open(checkpoint_path) as checkpoint_file:
+            return set([tuple(tile) for tile in json.load(checkpoint_file)['finished_tiles']])
+        
+    def save_checkpoint(checkpoint_path, finished_tile_set):
+        # Replace the file in one step so that a killed job never leaves a partial checkpoint
+        temp_path = checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump({'finished_tiles': sorted([list(tile) for tile in finished_tile_set])}, checkpoint_file, indent=1)
+        os.rename(temp_path, checkpoint_path)
+        
+    def run_batch(index_stacker, tile_list, checkpoint_path):
+        """
+        Processes every tile in tile_list not already recorded as finished in checkpoint_path,
+        recording each tile there as it is finished. With a worker pool, every tile is planned
+        first and the acquisitions of all tiles are derived in one pool, starting with the tiles
+        with most acquisitions to derive. A tile which can't be planned fails on its own and the
+        batch carries on with the others. Each tile's stacks and stats are created as soon as its
+        own acquisitions are finished, while the pool carries on with other tiles.
+        returns list of tiles which failed
+        """
+        finished_tile_set = load_checkpoint(checkpoint_path)
+        tile_list = [tile for tile in tile_list if tile not in finished_tile_set]
+        logger.info('Processing %d tiles (%d already finished according to %s)',
+                    len(tile_list), len(finished_tile_set), checkpoint_path)
+        failed_tile_list = []
+        
+        def finish_tile(tile, planned=False):
+            index_stacker.x_index, index_stacker.y_index = tile
+            try:
+                process_tile(index_stacker, planned)
+            except Exception as error:
+                logger.error('Unable to process tile %d, %d: %s', tile[0], tile[1], error)
+                failed_tile_list.append(tile)
+                return
+            finished_tile_set.add(tile)
+            save_checkpoint(checkpoint_path, finished_tile_set)
+            logger.info('Finished tile %d, %d (%d of %d)', tile[0], tile[1], 
+                        len(tile_list) - len([tile for tile in tile_list if tile not in finished_tile_set]), len(tile_list))
+        
+        if not index_stacker.workers or index_stacker.workers < 2 or index_stacker.direct_stack:
+            for tile in tile_list:
+                finish_tile(tile)
+            return failed_tile_list
+        
+        tile_job_dict = {} # Lists of derive jobs keyed by tile
+        for tile in list(tile_list):
+            index_stacker.x_index, index_stacker.y_index = tile
+            try:
+                tile_job_dict[tile] = index_stacker.plan_derive_jobs(**get_stack_kwargs(index_stacker))
+            except Exception as error:
+                logger.error('Unable to plan tile %d, %d: %s', tile[0], tile[1], error)
+                failed_tile_list.append(tile)
+                tile_list.remove(tile)
+        
+        tile_list = sorted(tile_list, key=lambda tile: len(tile_job_dict[tile]), reverse=True)
+        derive_job_list = []
+        job_tile_dict = {} # Tiles keyed by id of derive job
+        for tile in tile_list:
+            for derive_job in tile_job_dict[tile]:
+                derive_job_list.append(derive_job)
+                job_tile_dict[id(derive_job)] = tile
+        
+        remaining_job_count_dict = dict([(tile, len(tile_job_dict[tile])) for tile in tile_list])
+        error_tile_set = set()
+        if derive_job_list:
+            for derive_job, error in index_stacker.iter_derive_jobs(derive_job_list):
+                tile = job_tile_dict[id(derive_job)]
+                if error:
+                    error_tile_set.add(tile)
+                remaining_job_count_dict[tile] -= 1
+                if remaining_job_count_dict[tile]:
+                    continue
+                
+                if tile in error_tile_set:
+                    failed_tile_list.append(tile)
+                else:
+                    finish_tile(tile, planned=True)
+        
+        # Tiles with nothing to derive
+        for tile in tile_list:
+            if not tile_job_dict[tile]:
+                finish_tile(tile, planned=True)
+        
+        return failed_tile_list
+        
     # Main function starts here
-    # Stacker class takes care of command line parameters
+    # Stacker class takes care of command line parameters not handled by parse_index_args()
+    index_args = parse_index_args()
     index_stacker = IndexStacker()
+    index_stacker.max_block_mb = index_args.max_block_mb
+    index_stacker.index_tags = index_args.index_tags
+    index_stacker.adopt_existing = index_args.adopt_existing
+    index_stacker.workers = index_args.workers
+    index_stacker.pqa_cache_mb = index_args.pqa_cache_mb
+    index_stacker.pqa_cache_dir = index_args.pqa_cache_dir
+    index_stacker.direct_stack = index_args.direct_stack
+    index_stacker.streaming_stats = index_args.streaming_stats
+    index_stacker.percentile_method = index_args.percentile_method
+    index_stacker.percentile_memory_mb = index_args.percentile_memory_mb
+    index_stacker.pipeline_depth = index_args.pipeline_depth
+    index_stacker.pipeline_writers = index_args.pipeline_writers
+    if index_args.profile_path:
+        index_stacker.profiler = StageProfiler()
+    if index_args.probe_pixel_list:
+        index_stacker.pixel_probe = log_pixel_probe
+        index_stacker.probe_pixel_list = index_args.probe_pixel_list
     
     if index_stacker.debug:
         console_handler.setLevel(logging.DEBUG)
     
     # Check for required command line parameters
-    assert index_stacker.x_index, 'Tile X-index not specified (-x or --x_index)'
-    assert index_stacker.y_index, 'Tile Y-index not specified (-y or --y_index)'
     assert index_stacker.output_dir, 'Output directory not specified (-o or --output)'
     
-    stack_info_dict = assemble_stack(index_stacker)
-    envi_dataset_path_dict = translate_stacks_to_envi(index_stacker, stack_info_dict)
-    stats_dataset_path_dict = calc_stats(index_stacker, stack_info_dict, envi_dataset_path_dict)
-    update_stats_metadata(index_stacker, stack_info_dict, envi_dataset_path_dict, stats_dataset_path_dict)
+    try:
+        if index_args.tile_list_file or index_args.bbox:
+            batch_tile_list = get_batch_tile_list(index_args)
+            failed_tile_list = run_batch(index_stacker, batch_tile_list,
+                                         index_args.checkpoint_path or os.path.join(index_stacker.output_dir, CHECKPOINT_FILENAME))
+        else:
+            assert index_stacker.x_index, 'Tile X-index not specified (-x or --x_index)'
+            assert index_stacker.y_index, 'Tile Y-index not specified (-y or --y_index)'
+            failed_tile_list = []
+            process_tile(index_stacker)
+    finally:
+        if index_args.profile_path:
+            index_stacker.profiler.write(index_args.profile_path)
     
-
-
+    if failed_tile_list:
+        logger.error('%d tiles failed: %s', len(failed_tile_list), 
+                     ', '.join(['%d,%d' % tile for tile in failed_tile_list]))
+        sys.exit(1)
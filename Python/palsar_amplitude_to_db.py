@@ -0,0 +1,322 @@
+'''
+Created on 16/10/2026
+
+Converts ALOS PALSAR amplitude scenes to decibels and applies a Lee filter.
+Port of IDL/palsar_amplitude_to_db.pro without ENVI.
+'''
+import os
+import re
+import sys
+import glob
+import logging
+import argparse
+import multiprocessing
+import numpy
+from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+POLARISATIONS = ['HH', 'HV']
+SCENE_PATTERN = 'IMG-%s*.5GUA' # Level 1.5 image file of one polarisation
+SUMMARY_FILE = 'summary.txt'
+KERNEL_SIZE = 3 # Lee filter parameters used with ENVI ADAPT_FILT_DOIT
+NOISE_SIGMA = 0.25
+MULT_MEAN = 1.0
+BLOCK_ROWS = 512 # Rows of each polarisation processed at a time
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+def amplitude_to_db(amplitude_array):
+    """
+    Returns 10 * log10(amplitude / 10000) as float32, as the ENVI MATH_DOIT expression
+    '10*alog10(float(b1)/10000)'. Zero amplitudes (no data) are NaN instead of -Infinity.
+    """
+    db_array = amplitude_array.astype(numpy.float32)
+    valid_mask = db_array > 0
+    db_array[~valid_mask] = numpy.nan
+    numpy.log10(db_array, out=db_array, where=valid_mask)
+    db_array -= 4.0 # log10(10000)
+    db_array *= 10.0
+    return db_array
+
+
+def get_box_sum(data_array, kernel_size):
+    """
+    Returns the sum of data_array over the kernel_size x kernel_size window centred on each
+    pixel, clipped at the edges of the array, from an integral image. The cost does not depend
+    on kernel_size.
+    """
+    rows, cols = data_array.shape
+    half_kernel = kernel_size // 2
+    integral_array = numpy.zeros((rows + 1, cols + 1), dtype=numpy.float64)
+    numpy.cumsum(data_array, axis=0, dtype=numpy.float64, out=integral_array[1:, 1:])
+    numpy.cumsum(integral_array[1:, 1:], axis=1, out=integral_array[1:, 1:])
+
+    row_start = numpy.clip(numpy.arange(rows) - half_kernel, 0, rows)[:, numpy.newaxis]
+    row_end = numpy.clip(numpy.arange(rows) + half_kernel + 1, 0, rows)[:, numpy.newaxis]
+    col_start = numpy.clip(numpy.arange(cols) - half_kernel, 0, cols)
+    col_end = numpy.clip(numpy.arange(cols) + half_kernel + 1, 0, cols)
+    return (integral_array[row_end, col_end] - integral_array[row_start, col_end] -
+            integral_array[row_end, col_start] + integral_array[row_start, col_start])
+
+
+def lee_filter(data_array, kernel_size=KERNEL_SIZE, noise_sigma=NOISE_SIGMA, mult_mean=MULT_MEAN):
+    """
+    Returns data_array with a Lee (1980) filter for multiplicative noise of mean mult_mean and
+    standard deviation noise_sigma applied, using the mean and variance of the valid (non-NaN)
+    pixels in the kernel_size x kernel_size window around each pixel, as ENVI ADAPT_FILT_DOIT
+    method 0 with noise_type 1. Windows are clipped at the edges of data_array. NaN pixels
+    stay NaN.
+    """
+    valid_mask = ~numpy.isnan(data_array)
+    valid_array = numpy.where(valid_mask, data_array, 0.0).astype(numpy.float64)
+
+    count_array = get_box_sum(valid_mask, kernel_size)
+    count_array[count_array == 0] = 1 # Only where the centre pixel is also NaN
+    mean_array = get_box_sum(valid_array, kernel_size) / count_array
+    variance_array = get_box_sum(valid_array * valid_array, kernel_size) / count_array - mean_array * mean_array
+    numpy.maximum(variance_array, 0.0, out=variance_array) # Rounding
+
+    # Variance of the noise-free signal, from var(z) = (var(x) + mean(x)^2)(sigma^2 + u^2) - mean(z)^2
+    signal_mean_array = mean_array / mult_mean
+    signal_variance_array = (variance_array + mean_array * mean_array) / (noise_sigma * noise_sigma + mult_mean * mult_mean) - signal_mean_array * signal_mean_array
+    numpy.maximum(signal_variance_array, 0.0, out=signal_variance_array)
+
+    # Weight of each pixel against its local mean
+    denominator_array = mult_mean * mult_mean * signal_variance_array + signal_mean_array * signal_mean_array * noise_sigma * noise_sigma
+    weight_array = numpy.zeros_like(signal_variance_array)
+    numpy.divide(mult_mean * signal_variance_array, denominator_array, out=weight_array, where=denominator_array > 0)
+
+    filtered_array = signal_mean_array + weight_array * (valid_array - mult_mean * signal_mean_array)
+    filtered_array[~valid_mask] = numpy.nan
+    return filtered_array.astype(numpy.float32)
+
+
+def filter_windows(read_window, write_window, rows, kernel_size=KERNEL_SIZE, noise_sigma=NOISE_SIGMA,
+                   mult_mean=MULT_MEAN, block_rows=BLOCK_ROWS):
+    """
+    Converts an image of rows rows to decibels and Lee filters it in windows of block_rows rows.
+    read_window(row_start, row_end) must return the amplitude array of those rows and
+    write_window(row_start, db_array, lee_array) is called for each window. Windows are read with
+    kernel_size // 2 extra rows on each side so the output does not depend on block_rows.
+    """
+    half_kernel = kernel_size // 2
+    for row_start in range(0, rows, block_rows):
+        row_end = min(row_start + block_rows, rows)
+        read_start = max(row_start - half_kernel, 0)
+        read_end = min(row_end + half_kernel, rows)
+
+        db_array = amplitude_to_db(read_window(read_start, read_end))
+        lee_array = lee_filter(db_array, kernel_size, noise_sigma, mult_mean)
+        write_window(row_start,
+                     db_array[row_start - read_start:row_end - read_start],
+                     lee_array[row_start - read_start:row_end - read_start])
+
+
+def read_obs_date(summary_path):
+    """Returns the scene observation date, the quoted value on the last line of summary.txt"""
+    with open(summary_path) as summary_file:
+        line_list = [line.strip() for line in summary_file if line.strip()]
+    obs_date = line_list[-1]
+    return obs_date[obs_date.find('"') + 1:obs_date.rfind('"')]
+
+
+def find_scenes(base_dir):
+    """
+    Returns a list of scene dicts, one for each directory under base_dir with a summary.txt file,
+    containing 'obs_date' and 'input_path_dict', a dict of image paths keyed by polarisation.
+    HH and HV images are paired by file name.
+    """
+    scene_dict = {} # Scene dicts keyed by image path without polarisation
+    for dir_path, _dir_names, _file_names in os.walk(base_dir):
+        for polarisation in POLARISATIONS:
+            for input_path in sorted(glob.glob(os.path.join(dir_path, SCENE_PATTERN % polarisation))):
+                summary_path = os.path.join(dir_path, SUMMARY_FILE)
+                if not os.path.exists(summary_path):
+                    logger.warning('Skipping %s without %s', input_path, SUMMARY_FILE)
+                    continue
+
+                scene_key = re.sub('IMG-%s' % polarisation, 'IMG', input_path)
+                scene = scene_dict.setdefault(scene_key, {'obs_date': read_obs_date(summary_path),
+                                                          'input_path_dict': {}})
+                scene['input_path_dict'][polarisation] = input_path
+    return [scene_dict[scene_key] for scene_key in sorted(scene_dict.keys())]
+
+
+def get_output_paths(input_path, obs_date, output_dir):
+    """Returns (dB output path, Lee filtered output path) as named by the IDL workflow"""
+    db_path = os.path.join(output_dir, '%s_%s' % (os.path.basename(input_path).replace('.5GUA', ''), obs_date))
+    return db_path, db_path + 'lee'
+
+
+def create_output_dataset(output_path, input_dataset):
+    gdal_driver = gdal.GetDriverByName('ENVI')
+    output_dataset = gdal_driver.Create(output_path, input_dataset.RasterXSize, input_dataset.RasterYSize,
+                                        input_dataset.RasterCount, gdal.GDT_Float32)
+    assert output_dataset, 'Unable to create output dataset %s' % output_path
+    output_dataset.SetGeoTransform(input_dataset.GetGeoTransform())
+    output_dataset.SetProjection(input_dataset.GetProjection())
+    return output_dataset
+
+
+def convert_scene(scene, output_dir, kernel_size=KERNEL_SIZE, noise_sigma=NOISE_SIGMA, mult_mean=MULT_MEAN,
+                  block_rows=BLOCK_ROWS):
+    """
+    Writes the decibel and Lee filtered Envi files for every polarisation of a scene from
+    find_scenes(), working through each band of each polarisation in windows of block_rows rows.
+    N.B: Run in worker processes, so must not use any state from the parent process.
+    returns list of output paths
+    """
+    output_path_list = []
+    for polarisation in sorted(scene['input_path_dict'].keys()):
+        input_path = scene['input_path_dict'][polarisation]
+        input_dataset = gdal.Open(input_path)
+        assert input_dataset, 'Unable to open dataset %s' % input_path
+
+        db_path, lee_path = get_output_paths(input_path, scene['obs_date'], output_dir)
+        db_dataset = create_output_dataset(db_path, input_dataset)
+        lee_dataset = create_output_dataset(lee_path, input_dataset)
+        for band_number in range(1, input_dataset.RasterCount + 1):
+            input_band = input_dataset.GetRasterBand(band_number)
+            db_band = db_dataset.GetRasterBand(band_number)
+            lee_band = lee_dataset.GetRasterBand(band_number)
+
+            def read_window(row_start, row_end):
+                return input_band.ReadAsArray(0, row_start, input_dataset.RasterXSize, row_end - row_start)
+
+            def write_window(row_start, db_array, lee_array):
+                db_band.WriteArray(db_array, 0, row_start)
+                lee_band.WriteArray(lee_array, 0, row_start)
+
+            filter_windows(read_window, write_window, input_dataset.RasterYSize,
+                           kernel_size, noise_sigma, mult_mean, block_rows)
+            db_band.SetNoDataValue(numpy.nan)
+            lee_band.SetNoDataValue(numpy.nan)
+
+        db_dataset.FlushCache()
+        lee_dataset.FlushCache()
+        db_dataset = lee_dataset = None # Close datasets to write headers
+        logger.info('Finished writing %s and %s', db_path, lee_path)
+        output_path_list += [db_path, lee_path]
+    return output_path_list
+
+
+def convert_scenes(scene_list, output_dir, workers=None, **filter_kwargs):
+    """
+    Runs convert_scene() for every scene in scene_list in a pool of workers processes
+    returns list of scenes which failed
+    """
+    failed_scene_list = []
+    with ProcessPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+        future_dict = dict([(executor.submit(convert_scene, scene, output_dir, **filter_kwargs), scene)
+                            for scene in scene_list])
+        for future in as_completed(future_dict):
+            scene = future_dict[future]
+            if future.exception():
+                logger.error('Unable to convert %s: %s', ', '.join(sorted(scene['input_path_dict'].values())), future.exception())
+                failed_scene_list.append(scene)
+    return failed_scene_list
+
+
+if __name__ == '__main__':
+    def lee_filter_reference(data_array, kernel_size, noise_sigma, mult_mean):
+        """Pixel by pixel Lee filter to check lee_filter() and filter_windows() against"""
+        rows, cols = data_array.shape
+        half_kernel = kernel_size // 2
+        filtered_array = numpy.empty((rows, cols), dtype=numpy.float64)
+        filtered_array[:] = numpy.nan
+        for row in range(rows):
+            for col in range(cols):
+                if numpy.isnan(data_array[row, col]):
+                    continue
+                window_array = data_array[max(row - half_kernel, 0):row + half_kernel + 1,
+                                          max(col - half_kernel, 0):col + half_kernel + 1].astype(numpy.float64)
+                window_array = window_array[~numpy.isnan(window_array)]
+                mean = window_array.mean()
+                variance = window_array.var()
+                signal_mean = mean / mult_mean
+                signal_variance = max((variance + mean * mean) / (noise_sigma ** 2 + mult_mean ** 2) - signal_mean ** 2, 0.0)
+                denominator = mult_mean ** 2 * signal_variance + signal_mean ** 2 * noise_sigma ** 2
+                weight = mult_mean * signal_variance / denominator if denominator > 0 else 0.0
+                filtered_array[row, col] = signal_mean + weight * (data_array[row, col] - mult_mean * signal_mean)
+        return filtered_array
+
+    def self_check():
+        """Checks the windowed, vectorised filter against lee_filter_reference() on synthetic amplitudes"""
+        random_state = numpy.random.RandomState(0)
+        # Speckled amplitudes over a field of patches, with a no-data border and scattered zeros
+        amplitude_array = (numpy.repeat(numpy.repeat(random_state.randint(500, 8000, (8, 8)), 10, axis=0), 10, axis=1)[:73, :61] *
+                           random_state.gamma(4.0, 0.25, (73, 61))).astype(numpy.uint16)
+        amplitude_array[:, :4] = 0
+        amplitude_array[random_state.random_sample(amplitude_array.shape) < 0.01] = 0
+
+        reference_db_array = numpy.where(amplitude_array > 0,
+                                         10 * numpy.log10(numpy.maximum(amplitude_array, 1) / 10000.0), numpy.nan)
+        for kernel_size in [3, 5, 11]:
+            for noise_sigma, mult_mean in [(NOISE_SIGMA, MULT_MEAN), (0.5, 1.5)]:
+                reference_lee_array = lee_filter_reference(reference_db_array, kernel_size, noise_sigma, mult_mean)
+                for block_rows in [1, 7, 100]:
+                    db_array = numpy.empty(amplitude_array.shape, dtype=numpy.float32)
+                    lee_array = numpy.empty(amplitude_array.shape, dtype=numpy.float32)
+
+                    def write_window(row_start, db_window, lee_window):
+                        db_array[row_start:row_start + db_window.shape[0]] = db_window
+                        lee_array[row_start:row_start + lee_window.shape[0]] = lee_window
+
+                    filter_windows(lambda row_start, row_end: amplitude_array[row_start:row_end], write_window,
+                                   amplitude_array.shape[0], kernel_size, noise_sigma, mult_mean, block_rows)
+                    assert numpy.allclose(db_array, reference_db_array, rtol=1e-6, atol=1e-5, equal_nan=True), 'dB differs from reference'
+                    assert numpy.allclose(lee_array, reference_lee_array, rtol=1e-5, atol=1e-4, equal_nan=True), \
+                        'Lee filter (%d x %d, sigma %g, mean %g, %d rows) differs from reference' % (kernel_size, kernel_size, noise_sigma, mult_mean, block_rows)
+                logger.info('Lee filter %d x %d, sigma %g, mean %g matches reference, max difference %g',
+                            kernel_size, kernel_size, noise_sigma, mult_mean, numpy.nanmax(numpy.abs(lee_array - reference_lee_array)))
+
+    def parse_args():
+        arg_parser = argparse.ArgumentParser(description='Converts ALOS PALSAR HH and HV amplitude scenes to decibels and applies a Lee filter')
+        arg_parser.add_argument('base_dir', nargs='?', help='Directory searched for scene directories containing IMG-HH*.5GUA, IMG-HV*.5GUA and summary.txt')
+        arg_parser.add_argument('output_dir', nargs='?', help='Directory for dB and Lee filtered Envi files')
+        arg_parser.add_argument('--workers', dest='workers', type=int, default=None,
+                                help='Number of worker processes (default: number of CPUs)')
+        arg_parser.add_argument('--kernel-size', dest='kernel_size', type=int, default=KERNEL_SIZE,
+                                help='Lee filter window size (default: %d)' % KERNEL_SIZE)
+        arg_parser.add_argument('--sigma', dest='noise_sigma', type=float, default=NOISE_SIGMA,
+                                help='Standard deviation of multiplicative noise (default: %g)' % NOISE_SIGMA)
+        arg_parser.add_argument('--mult-mean', dest='mult_mean', type=float, default=MULT_MEAN,
+                                help='Mean of multiplicative noise (default: %g)' % MULT_MEAN)
+        arg_parser.add_argument('--block-rows', dest='block_rows', type=int, default=BLOCK_ROWS,
+                                help='Rows processed at a time (default: %d)' % BLOCK_ROWS)
+        arg_parser.add_argument('--self-check', dest='self_check', action='store_true', default=False,
+                                help='Check the filter against a pixel by pixel reference on synthetic data and exit')
+        args = arg_parser.parse_args()
+
+        if not args.self_check:
+            assert args.base_dir and args.output_dir, 'Base and output directories must be specified'
+        assert args.kernel_size % 2 == 1, 'Kernel size must be odd'
+        return args
+
+    # Main function starts here
+    args = parse_args()
+    if args.self_check:
+        self_check()
+        sys.exit(0)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    scene_list = find_scenes(args.base_dir)
+    logger.info('Converting %d scenes in %s', len(scene_list), args.base_dir)
+    failed_scene_list = convert_scenes(scene_list, args.output_dir, args.workers,
+                                       kernel_size=args.kernel_size, noise_sigma=args.noise_sigma,
+                                       mult_mean=args.mult_mean, block_rows=args.block_rows)
+    if failed_scene_list:
+        logger.error('%d scenes failed', len(failed_scene_list))
+        sys.exit(1)
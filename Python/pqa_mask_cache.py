@@ -0,0 +1,225 @@
+'''
+Created on 16/10/2026
+
+Cache of bit-packed PQA masks shared between stackers
+'''
+import os
+import sys
+import logging
+import hashlib
+import tempfile
+import numpy
+from collections import OrderedDict
+
+UNPACK_ROWS = 256 # Rows of a packed mask unpacked at a time by PackedMask.apply()
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+class PackedMask(object):
+    """
+    Boolean (row, col) mask held as numpy.packbits() of each row, one eighth of the size
+    of the boolean array. Slicing rows returns a PackedMask view without unpacking.
+    """
+    def __init__(self, packed_array, shape):
+        assert packed_array.ndim == 2 and packed_array.shape[0] == shape[0], 'Packed array does not match shape'
+        self.packed_array = packed_array
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_array(cls, mask_array):
+        """Returns a PackedMask of the boolean 2D array mask_array"""
+        return cls(numpy.packbits(mask_array, axis=1), mask_array.shape)
+
+    @property
+    def nbytes(self):
+        return self.packed_array.nbytes
+
+    def __getitem__(self, row_slice):
+        assert isinstance(row_slice, slice), 'PackedMask can only be sliced by rows'
+        packed_array = self.packed_array[row_slice]
+        return PackedMask(packed_array, (packed_array.shape[0], self.shape[1]))
+
+    def unpack(self, row_start=0, row_end=None):
+        """Returns the boolean mask for rows row_start to row_end"""
+        return numpy.unpackbits(self.packed_array[row_start:row_end], axis=1)[:, :self.shape[1]].view(numpy.bool_)
+
+    def apply(self, data_array, no_data_value):
+        """
+        Sets data_array to no_data_value wherever the mask is False, unpacking only
+        UNPACK_ROWS rows of the mask at a time.
+        """
+        assert data_array.shape == self.shape, 'Mask shape %s does not match data shape %s' % (self.shape, data_array.shape)
+        for row_start in range(0, self.shape[0], UNPACK_ROWS):
+            row_end = min(row_start + UNPACK_ROWS, self.shape[0])
+            bad_pixel_mask = self.unpack(row_start, row_end)
+            numpy.logical_not(bad_pixel_mask, out=bad_pixel_mask)
+            data_array[row_start:row_end][bad_pixel_mask] = no_data_value
+
+
+class PQAMaskCache(object):
+    """
+    Cache of PQA masks as PackedMask objects, keyed by PQA dataset path, modification time,
+    size, mask shape and the mask parameters. Masks are held in memory with least-recently-used eviction
+    once max_bytes is exceeded and, if cache_dir is specified, also saved there as .npy files
+    which are memory-mapped when read, so that other processes and stackers can share them.
+    """
+    def __init__(self, max_bytes=0, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._mask_dict = OrderedDict() # PackedMask objects keyed by cache key, least recently used first
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def get_key(pqa_dataset_path, mask_shape, mask_kwargs):
+        """Returns the cache key for the PQA dataset, mask shape and mask parameters"""
+        pqa_stat = os.stat(pqa_dataset_path)
+        key_string = '%s %r %d %r %r' % (os.path.abspath(pqa_dataset_path), pqa_stat.st_mtime, pqa_stat.st_size,
+                                         tuple(mask_shape), sorted(mask_kwargs.items()))
+        return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+    def get_mask(self, pqa_dataset_path, mask_shape, mask_function, **mask_kwargs):
+        """
+        Returns a PackedMask of (row, col) mask_shape for pqa_dataset_path, calling
+        mask_function(pqa_dataset_path, **mask_kwargs) to make the boolean mask if it is not cached.
+        mask_kwargs must include every parameter which changes the mask, including any for which
+        mask_function has a default, because they are part of the key of masks shared in cache_dir.
+        """
+        mask_shape = tuple(mask_shape)
+        key = self.get_key(pqa_dataset_path, mask_shape, mask_kwargs)
+
+        packed_mask = self._mask_dict.pop(key, None)
+        if packed_mask is not None:
+            self.hits += 1
+            self._mask_dict[key] = packed_mask # Most recently used - its bytes are already counted
+            return packed_mask
+
+        packed_mask = self._load(key, mask_shape)
+        if packed_mask is None:
+            self.misses += 1
+            packed_mask = PackedMask.from_array(mask_function(pqa_dataset_path, **mask_kwargs))
+            assert packed_mask.shape == mask_shape, 'PQA mask shape %s is not %s' % (packed_mask.shape, mask_shape)
+            self._save(key, packed_mask)
+        else:
+            self.hits += 1
+            logger.debug('Using cached PQA mask for %s', pqa_dataset_path)
+
+        self._remember(key, packed_mask)
+        return packed_mask
+
+    def _remember(self, key, packed_mask):
+        """Adds packed_mask to the in-memory cache as the most recently used and evicts older masks"""
+        if key in self._mask_dict:
+            self._cached_bytes -= self._mask_dict.pop(key).nbytes
+
+        self._mask_dict[key] = packed_mask
+        self._cached_bytes += packed_mask.nbytes
+
+        while self._mask_dict and self._cached_bytes > self.max_bytes:
+            _key, evicted_mask = self._mask_dict.popitem(last=False)
+            self._cached_bytes -= evicted_mask.nbytes
+
+    def get_mask_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _load(self, key, mask_shape):
+        """Returns a memory-mapped PackedMask from cache_dir, or None if there isn't one"""
+        if not self.cache_dir:
+            return None
+
+        # The mask shape is part of the key, so the file name is known without listing cache_dir
+        try:
+            packed_array = numpy.load(self.get_mask_path(key), mmap_mode='r')
+        except IOError:
+            return None
+        return PackedMask(packed_array, mask_shape)
+
+    def _save(self, key, packed_mask):
+        """Saves packed_mask to cache_dir if there is one"""
+        if not self.cache_dir:
+            return
+
+        mask_path = self.get_mask_path(key)
+
+        # Write to a temporary file and rename it so other processes never see a partial file
+        temp_fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                numpy.save(temp_file, packed_mask.packed_array)
+            os.rename(temp_path, mask_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.debug('Saved PQA mask %s', mask_path)
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+
+    arg_parser = argparse.ArgumentParser(description='Check PQAMaskCache eviction, sharing and keys')
+    arg_parser.add_argument('--rows', type=int, default=100, help='Rows in synthetic masks (default: 100)')
+    arg_parser.add_argument('--cols', type=int, default=90, help='Columns in synthetic masks (default: 90)')
+    args = arg_parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        mask_shape = (args.rows, args.cols)
+        pqa_path_list = []
+        for pqa_index in range(4):
+            pqa_path_list.append(os.path.join(cache_dir, 'pqa_%d.tif' % pqa_index))
+            open(pqa_path_list[-1], 'w').close()
+
+        def make_mask(pqa_dataset_path, dilation=3):
+            random_state = numpy.random.RandomState(pqa_path_list.index(pqa_dataset_path) * 10 + dilation)
+            return random_state.random_sample(mask_shape) < 0.7
+
+        mask_bytes = PackedMask.from_array(make_mask(pqa_path_list[0])).nbytes
+
+        # Room for three masks - repeated hits must neither grow the cached bytes nor evict live masks
+        mask_cache = PQAMaskCache(max_bytes=3 * mask_bytes)
+        for pqa_dataset_path in pqa_path_list[:3]:
+            mask_cache.get_mask(pqa_dataset_path, mask_shape, make_mask, dilation=3)
+        for _ in range(5):
+            for pqa_dataset_path in pqa_path_list[:3]:
+                mask_cache.get_mask(pqa_dataset_path, mask_shape, make_mask, dilation=3)
+        assert (mask_cache.misses, mask_cache.hits) == (3, 15), 'Hits evicted cached masks'
+        assert mask_cache._cached_bytes == 3 * mask_bytes == sum([packed_mask.nbytes for packed_mask in mask_cache._mask_dict.values()]), \
+            'Cached bytes %d do not match cached masks' % mask_cache._cached_bytes
+
+        # A fourth mask evicts only the least recently used one
+        mask_cache.get_mask(pqa_path_list[0], mask_shape, make_mask, dilation=3)
+        mask_cache.get_mask(pqa_path_list[3], mask_shape, make_mask, dilation=3)
+        assert len(mask_cache._mask_dict) == 3 and mask_cache._cached_bytes == 3 * mask_bytes, 'Eviction failed'
+        mask_cache.get_mask(pqa_path_list[0], mask_shape, make_mask, dilation=3)
+        assert mask_cache.misses == 4, 'Most recently used mask was evicted'
+
+        # Masks are shared through cache_dir, and different mask parameters are different masks
+        shared_cache_dir = os.path.join(cache_dir, 'shared')
+        PQAMaskCache(cache_dir=shared_cache_dir).get_mask(pqa_path_list[1], mask_shape, make_mask, dilation=3)
+        mask_cache = PQAMaskCache(cache_dir=shared_cache_dir)
+        packed_mask = mask_cache.get_mask(pqa_path_list[1], mask_shape, make_mask, dilation=3)
+        assert (mask_cache.misses, mask_cache.hits) == (0, 1), 'Mask was not read from cache_dir'
+        assert (packed_mask.unpack() == make_mask(pqa_path_list[1])).all(), 'Shared mask differs'
+        packed_mask = mask_cache.get_mask(pqa_path_list[1], mask_shape, make_mask, dilation=1)
+        assert mask_cache.misses == 1, 'Mask made with other parameters was used'
+        assert (packed_mask.unpack() == make_mask(pqa_path_list[1], dilation=1)).all(), 'Mask with other parameters differs'
+
+        logger.info('PQAMaskCache checks passed')
+    finally:
+        shutil.rmtree(cache_dir)
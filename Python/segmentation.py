@@ -0,0 +1,591 @@
+'''
+Created on 16/10/2026
+
+Segmentation of NBAR and index tiles by k-means classification and clumping, in place of the
+RSGISLib XML workflows in RSGISLIB/seg_kmeansclassi.xml and RSGISLIB/seg_test1.xml:
+kmeanscentres -> labelsfromclusters -> clump -> rmsmallclumps -> clump -> meanimg
+'''
+import os
+import sys
+import logging
+import argparse
+import multiprocessing
+import numpy
+from osgeo import gdal
+from concurrent.futures import ProcessPoolExecutor
+
+NUM_CLUSTERS = 60 # Defaults from RSGISLIB/seg_kmeansclassi.xml
+MAX_ITERATIONS = 40
+CLUSTER_MOVE = 10.0
+SUBSAMPLE = 4 # From RSGISLIB/seg_test1.xml, as seg_kmeansclassi.xml doesn't subsample
+MIN_SIZE = 80
+MAX_SPECTRAL_DIST = 200.0
+BATCH_SIZE = 10000 # Pixel samples in each k-means update
+BLOCK_ROWS = 512 # Rows read, classified and clumped at a time
+DISTANCE_PIXELS = 65536 # Pixels for which distances to all centres are calculated at a time
+FORMAT = 'GTiff'
+FORMAT_OPTIONS = 'COMPRESS=LZW,BIGTIFF=YES'
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+def read_window(dataset, band_list, row_start, row_end):
+    """
+    Returns (data_array, valid_mask) for rows row_start to row_end of the one-based bands in
+    band_list, where data_array is float32 (band, row, col) and valid_mask is False wherever any
+    band has its no-data value or is NaN
+    """
+    data_array = numpy.empty((len(band_list), row_end - row_start, dataset.RasterXSize), dtype=numpy.float32)
+    valid_mask = numpy.ones((row_end - row_start, dataset.RasterXSize), dtype=numpy.bool_)
+    for band_position, band_number in enumerate(band_list):
+        band = dataset.GetRasterBand(band_number)
+        band.ReadAsArray(0, row_start, dataset.RasterXSize, row_end - row_start, buf_obj=data_array[band_position])
+        valid_mask &= ~numpy.isnan(data_array[band_position])
+        if band.GetNoDataValue() is not None:
+            valid_mask &= (data_array[band_position] != band.GetNoDataValue())
+    return data_array, valid_mask
+
+
+def get_roots(parent_array):
+    """Returns the root of every element of a union-find parent array, by pointer jumping"""
+    while True:
+        grandparent_array = parent_array[parent_array]
+        if numpy.array_equal(grandparent_array, parent_array):
+            return parent_array
+        parent_array = grandparent_array
+
+
+def union_pairs(parent_array, a_array, b_array):
+    """
+    Joins the sets of a_array[i] and b_array[i] for every i in the union-find parent_array,
+    always making the lower root the root of the joined set.
+    returns array of the root of every element
+    """
+    root_array = get_roots(parent_array)
+    while True:
+        root_a_array = root_array[a_array]
+        root_b_array = root_array[b_array]
+        unjoined_mask = root_a_array != root_b_array
+        if not unjoined_mask.any():
+            return root_array
+        root_a_array = root_a_array[unjoined_mask]
+        root_b_array = root_b_array[unjoined_mask]
+        a_array = a_array[unjoined_mask] # Only pairs not yet joined need checking again
+        b_array = b_array[unjoined_mask]
+        # Hook each higher root to the lowest root it is paired with, then flatten the trees
+        numpy.minimum.at(root_array, numpy.maximum(root_a_array, root_b_array), numpy.minimum(root_a_array, root_b_array))
+        root_array = get_roots(root_array)
+
+
+def get_sequential_labels(root_array, valid_mask):
+    """
+    Returns array of labels from 1 for the sets of a union-find root_array, numbered in order of
+    their first element, with 0 for invalid elements, and the number of sets
+    """
+    root_mask = (root_array == numpy.arange(root_array.size)) & valid_mask
+    sequence_array = numpy.cumsum(root_mask).astype(numpy.int32)
+    label_array = sequence_array[root_array]
+    label_array[~valid_mask] = 0
+    return label_array, int(sequence_array[-1]) if sequence_array.size else 0
+
+
+def get_neighbour_pairs(label_array, connectivity=4):
+    """
+    Returns (a_array, b_array) of the flat indices of each pair of neighbouring pixels with the
+    same non-zero label in the 2D label_array, for 4 or 8 connectivity
+    """
+    rows, cols = label_array.shape
+    index_array = numpy.arange(rows * cols).reshape((rows, cols))
+    offset_list = [(0, 1), (1, 0)] + ([(1, 1), (1, -1)] if connectivity == 8 else [])
+    a_list = []
+    b_list = []
+    for row_offset, col_offset in offset_list:
+        a_slice = (slice(0, rows - row_offset), slice(max(-col_offset, 0), cols - max(col_offset, 0)))
+        b_slice = (slice(row_offset, rows), slice(max(col_offset, 0), cols - max(-col_offset, 0)))
+        pair_mask = (label_array[a_slice] == label_array[b_slice]) & (label_array[a_slice] != 0)
+        a_list.append(index_array[a_slice][pair_mask])
+        b_list.append(index_array[b_slice][pair_mask])
+    return numpy.concatenate(a_list), numpy.concatenate(b_list)
+
+
+def label_components(class_array, connectivity=4):
+    """
+    Returns (clump_array, clump_count) where clump_array numbers the connected regions of equal
+    non-zero values of class_array from 1 in raster order of their first pixel, with 0 where
+    class_array is 0
+    """
+    a_array, b_array = get_neighbour_pairs(class_array, connectivity)
+    root_array = union_pairs(numpy.arange(class_array.size), a_array, b_array)
+    clump_array, clump_count = get_sequential_labels(root_array, class_array.ravel() != 0)
+    return clump_array.reshape(class_array.shape), clump_count
+
+
+class MiniBatchKMeans(object):
+    """
+    K-means clustering updated one batch of samples at a time (Sculley 2010), so that the image
+    never has to be held in memory. Each centre is the running mean of the samples assigned to it.
+    Initial centres are chosen from the first batch by k-means++ seeding, which unlike the random
+    samples of RSGISLib initmethod="random" rarely leaves two centres in one cluster.
+    """
+    def __init__(self, num_clusters=NUM_CLUSTERS, seed=0):
+        self.num_clusters = num_clusters
+        self.random_state = numpy.random.RandomState(seed)
+        self.centre_array = None
+        self.count_array = numpy.zeros(num_clusters, dtype=numpy.float64)
+
+    def predict(self, sample_array):
+        """Returns the index of the nearest centre to each row of the (sample, band) sample_array"""
+        label_array = numpy.empty(sample_array.shape[0], dtype=numpy.int32)
+        centre_norm_array = (self.centre_array * self.centre_array).sum(axis=1)
+        for sample_start in range(0, sample_array.shape[0], DISTANCE_PIXELS):
+            sample_end = min(sample_start + DISTANCE_PIXELS, sample_array.shape[0])
+            # Squared distance less the squared norm of each sample, which doesn't change the nearest centre
+            distance_array = centre_norm_array - 2.0 * numpy.dot(sample_array[sample_start:sample_end], self.centre_array.T)
+            label_array[sample_start:sample_end] = numpy.argmin(distance_array, axis=1)
+        return label_array
+
+    def init_centres(self, sample_array):
+        """
+        Chooses initial centres from the (sample, band) sample_array by k-means++ seeding: each
+        centre is a random sample, chosen with probability proportional to its squared distance
+        from the nearest centre already chosen
+        """
+        assert sample_array.shape[0] >= self.num_clusters, 'First batch must have at least one sample per cluster'
+        self.centre_array = numpy.empty((self.num_clusters, sample_array.shape[1]), dtype=numpy.float64)
+        self.centre_array[0] = sample_array[self.random_state.randint(sample_array.shape[0])]
+        min_distance_array = ((sample_array - self.centre_array[0]) ** 2).sum(axis=1)
+        for centre_index in range(1, self.num_clusters):
+            distance_sum = min_distance_array.sum()
+            if distance_sum > 0:
+                sample_index = numpy.searchsorted(numpy.cumsum(min_distance_array), self.random_state.random_sample() * distance_sum)
+                sample_index = min(sample_index, sample_array.shape[0] - 1)
+            else: # Fewer distinct samples than clusters
+                sample_index = self.random_state.randint(sample_array.shape[0])
+            self.centre_array[centre_index] = sample_array[sample_index]
+            numpy.minimum(min_distance_array, ((sample_array - self.centre_array[centre_index]) ** 2).sum(axis=1), out=min_distance_array)
+
+    def partial_fit(self, sample_array):
+        """Updates the centres with the (sample, band) sample_array"""
+        sample_array = sample_array.astype(numpy.float64)
+        if self.centre_array is None:
+            self.init_centres(sample_array)
+
+        label_array = self.predict(sample_array)
+        batch_count_array = numpy.bincount(label_array, minlength=self.num_clusters).astype(numpy.float64)
+        self.count_array += batch_count_array
+        updated_mask = batch_count_array > 0
+        for band_index in range(sample_array.shape[1]):
+            batch_sum_array = numpy.bincount(label_array, weights=sample_array[:, band_index], minlength=self.num_clusters)
+            self.centre_array[updated_mask, band_index] += ((batch_sum_array[updated_mask] -
+                                                             batch_count_array[updated_mask] * self.centre_array[updated_mask, band_index]) /
+                                                            self.count_array[updated_mask])
+
+    def fit(self, iter_samples, max_iterations=MAX_ITERATIONS, cluster_move=CLUSTER_MOVE, batch_size=BATCH_SIZE):
+        """
+        Fits the centres to the sample arrays yielded by iter_samples(), a function which is called
+        once per pass over the image and must yield (sample, band) arrays. Stops after max_iterations
+        passes or once no centre moves further than cluster_move in a pass.
+        """
+        for iteration in range(max_iterations):
+            start_centre_array = None if self.centre_array is None else self.centre_array.copy()
+            pending_list = []
+            pending_count = 0
+            for sample_array in iter_samples():
+                pending_list.append(sample_array)
+                pending_count += sample_array.shape[0]
+                if pending_count >= max(batch_size, self.num_clusters):
+                    self.partial_fit(numpy.concatenate(pending_list))
+                    pending_list = []
+                    pending_count = 0
+            if pending_list and (self.centre_array is not None or pending_count >= self.num_clusters):
+                self.partial_fit(numpy.concatenate(pending_list))
+            assert self.centre_array is not None, 'Fewer valid samples than clusters'
+
+            if start_centre_array is not None:
+                max_move = numpy.sqrt(((self.centre_array - start_centre_array) ** 2).sum(axis=1)).max()
+                logger.debug('K-means pass %d: centres moved by up to %g', iteration + 1, max_move)
+                if max_move < cluster_move:
+                    break
+            self.count_array[:] = 0 # Each pass is a fresh running mean from the current centres
+        logger.info('K-means finished after %d passes', iteration + 1)
+        return self.centre_array
+
+
+def classify_and_clump_block(image_path, band_list, centre_array, row_start, row_end, connectivity=4):
+    """
+    Process pool entry point which assigns every valid pixel of rows row_start to row_end to its
+    nearest centre and numbers the connected regions of each class within the block.
+    returns (class_array, clump_array, clump_count), where class_array has classes from 1 and 0 for no data
+    """
+    dataset = gdal.Open(image_path)
+    assert dataset, 'Unable to open dataset %s' % image_path
+    data_array, valid_mask = read_window(dataset, band_list, row_start, row_end)
+
+    kmeans = MiniBatchKMeans(centre_array.shape[0])
+    kmeans.centre_array = centre_array
+    class_array = numpy.zeros(valid_mask.shape, dtype=numpy.uint16)
+    class_array[valid_mask] = kmeans.predict(data_array[:, valid_mask].T) + 1
+
+    clump_array, clump_count = label_components(class_array, connectivity)
+    return class_array, clump_array, clump_count
+
+
+def merge_block_clumps(class_array, clump_array, block_start_list, connectivity=4):
+    """
+    Joins the clumps of blocks of rows starting at block_start_list which touch across block
+    boundaries. clump_array must number the clumps of all blocks uniquely, from 1.
+    returns array of the root clump of each clump number
+    """
+    a_list = []
+    b_list = []
+    col_offset_list = [0] + ([1, -1] if connectivity == 8 else [])
+    for block_start in block_start_list[1:]:
+        for col_offset in col_offset_list:
+            cols = class_array.shape[1]
+            upper_slice = slice(max(-col_offset, 0), cols - max(col_offset, 0))
+            lower_slice = slice(max(col_offset, 0), cols - max(-col_offset, 0))
+            upper_class_array = class_array[block_start - 1, upper_slice]
+            lower_class_array = class_array[block_start, lower_slice]
+            pair_mask = (upper_class_array == lower_class_array) & (upper_class_array != 0)
+            a_list.append(clump_array[block_start - 1, upper_slice][pair_mask])
+            b_list.append(clump_array[block_start, lower_slice][pair_mask])
+
+    root_array = numpy.arange(clump_array.max() + 1)
+    if a_list:
+        root_array = union_pairs(root_array, numpy.concatenate(a_list), numpy.concatenate(b_list))
+    return root_array
+
+
+def get_unique_pairs(a_array, b_array):
+    """Returns (a_array, b_array) of the distinct pairs of different values, ordered so that a < b"""
+    a_array, b_array = numpy.minimum(a_array, b_array).astype(numpy.int64), numpy.maximum(a_array, b_array).astype(numpy.int64)
+    pair_mask = a_array != b_array
+    key_base = int(b_array.max()) + 1 if b_array.size else 1
+    key_array = numpy.unique(a_array[pair_mask] * key_base + b_array[pair_mask]) # One sortable key per pair
+    return key_array // key_base, key_array % key_base
+
+
+def get_clump_adjacency(clump_array, block_rows=BLOCK_ROWS, connectivity=4):
+    """
+    Returns (a_array, b_array) of each pair of different non-zero clumps which share an edge, or also
+    a corner for 8 connectivity, a < b
+    """
+    cols = clump_array.shape[1]
+    offset_list = [(0, 1), (1, 0)] + ([(1, 1), (1, -1)] if connectivity == 8 else [])
+    a_list = []
+    b_list = []
+    for row_start in range(0, clump_array.shape[0], block_rows):
+        window_array = clump_array[row_start:min(row_start + block_rows + 1, clump_array.shape[0])] # Overlap one row
+        for row_offset, col_offset in offset_list:
+            a_array = window_array[0:window_array.shape[0] - row_offset, max(-col_offset, 0):cols - max(col_offset, 0)]
+            b_array = window_array[row_offset:, max(col_offset, 0):cols - max(-col_offset, 0)]
+            pair_mask = (a_array != b_array) & (a_array != 0) & (b_array != 0)
+            a_array, b_array = get_unique_pairs(a_array[pair_mask], b_array[pair_mask])
+            a_list.append(a_array)
+            b_list.append(b_array)
+    return get_unique_pairs(numpy.concatenate(a_list), numpy.concatenate(b_list))
+
+
+def eliminate_small_clumps(sum_array, count_array, a_array, b_array, min_size=MIN_SIZE, max_spectral_dist=MAX_SPECTRAL_DIST):
+    """
+    Merges every clump of fewer than min_size pixels into the neighbouring clump with the nearest
+    mean spectrum and repeats until no more clumps can be merged, as RSGISLib rmsmallclumps. Small
+    clumps are only merged into neighbours with means closer than max_spectral_dist, so some may be
+    left smaller than min_size. With max_spectral_dist None, only clumps with no neighbours are.
+    sum_array holds the (clump, band) sums of pixel values and count_array the pixel count of each
+    clump, including clump 0 for no data, which is never merged.
+    a_array and b_array are the pairs of adjacent clumps from get_clump_adjacency().
+    returns (root_array, sum_array, count_array) - the clump each clump is merged into and the sums and
+    counts of the merged clumps
+    """
+    root_array = numpy.arange(count_array.size)
+    while a_array.size:
+        mean_array = sum_array / numpy.maximum(count_array, 1)[:, numpy.newaxis]
+        distance_array = numpy.sqrt(((mean_array[a_array] - mean_array[b_array]) ** 2).sum(axis=1))
+
+        # Candidate merges of each small clump in both directions, nearest first
+        small_mask = count_array < min_size
+        from_array = numpy.concatenate([a_array[small_mask[a_array]], b_array[small_mask[b_array]]])
+        to_array = numpy.concatenate([b_array[small_mask[a_array]], a_array[small_mask[b_array]]])
+        merge_distance_array = numpy.concatenate([distance_array[small_mask[a_array]], distance_array[small_mask[b_array]]])
+        merge_mask = merge_distance_array < (numpy.inf if max_spectral_dist is None else max_spectral_dist)
+        if not merge_mask.any():
+            break
+        from_array = from_array[merge_mask]
+        to_array = to_array[merge_mask]
+        order_array = numpy.lexsort((merge_distance_array[merge_mask], from_array))
+        _from_array, first_index_array = numpy.unique(from_array[order_array], return_index=True)
+        merge_index_array = order_array[first_index_array]
+
+        merge_root_array = union_pairs(numpy.arange(count_array.size), from_array[merge_index_array], to_array[merge_index_array])
+        root_array = merge_root_array[root_array]
+        count_array = numpy.bincount(merge_root_array, weights=count_array, minlength=count_array.size)
+        sum_array = numpy.stack([numpy.bincount(merge_root_array, weights=sum_array[:, band_index], minlength=count_array.size)
+                                 for band_index in range(sum_array.shape[1])], axis=1)
+
+        # Adjacency of the merged clumps
+        a_array, b_array = get_unique_pairs(merge_root_array[a_array], merge_root_array[b_array])
+    return root_array, sum_array, count_array
+
+
+def create_output_dataset(output_path, dataset, band_count, gdal_dtype, file_format=FORMAT, format_options=FORMAT_OPTIONS):
+    gdal_driver = gdal.GetDriverByName(file_format)
+    output_dataset = gdal_driver.Create(output_path, dataset.RasterXSize, dataset.RasterYSize, band_count, gdal_dtype,
+                                        format_options.split(',') if format_options else [])
+    assert output_dataset, 'Unable to create output dataset %s' % output_path
+    output_dataset.SetGeoTransform(dataset.GetGeoTransform())
+    output_dataset.SetProjection(dataset.GetProjection())
+    return output_dataset
+
+
+def segment_image(image_path, output_prefix, band_list=None, num_clusters=NUM_CLUSTERS, max_iterations=MAX_ITERATIONS,
+                  cluster_move=CLUSTER_MOVE, subsample=SUBSAMPLE, min_size=MIN_SIZE, max_spectral_dist=MAX_SPECTRAL_DIST,
+                  connectivity=4, workers=None, block_rows=BLOCK_ROWS, seed=0, file_format=FORMAT, format_options=FORMAT_OPTIONS):
+    """
+    Segments the bands in band_list (default all) of image_path and writes
+    <output_prefix>_classes, the k-means class of each pixel, <output_prefix>_segments, the segment
+    of each pixel numbered from 1, and <output_prefix>_segment_means, the mean of each band over each
+    segment, with the extension of file_format.
+
+    Only block_rows rows of image bands are held in memory at a time. The class and segment images
+    for the whole image are held in memory as 16-bit and 32-bit integers.
+    K-means centres are fitted to a random 1 in subsample of the valid pixels, read in windows.
+    Blocks of rows are then classified and clumped in a pool of workers processes and clumps
+    touching across block boundaries are joined.
+    returns dict of output paths keyed by 'classes', 'segments' and 'segment_means'
+    """
+    dataset = gdal.Open(image_path)
+    assert dataset, 'Unable to open dataset %s' % image_path
+    band_list = band_list or list(range(1, dataset.RasterCount + 1))
+    extension = {'GTiff': '.tif', 'HFA': '.img', 'ENVI': ''}.get(file_format, '')
+    output_path_dict = dict([(output_name, '%s_%s%s' % (output_prefix, output_name, extension))
+                             for output_name in ['classes', 'segments', 'segment_means']])
+    block_start_list = list(range(0, dataset.RasterYSize, block_rows))
+    random_state = numpy.random.RandomState(seed)
+
+    def iter_samples():
+        for row_start in block_start_list:
+            data_array, valid_mask = read_window(dataset, band_list, row_start, min(row_start + block_rows, dataset.RasterYSize))
+            valid_mask &= random_state.random_sample(valid_mask.shape) < 1.0 / subsample
+            yield data_array[:, valid_mask].T
+
+    kmeans = MiniBatchKMeans(num_clusters, seed)
+    centre_array = kmeans.fit(iter_samples, max_iterations, cluster_move)
+
+    class_array = numpy.zeros((dataset.RasterYSize, dataset.RasterXSize), dtype=numpy.uint16)
+    clump_array = numpy.zeros((dataset.RasterYSize, dataset.RasterXSize), dtype=numpy.int32)
+    clump_offset = 0
+    with ProcessPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+        future_list = [executor.submit(classify_and_clump_block, image_path, band_list, centre_array,
+                                       row_start, min(row_start + block_rows, dataset.RasterYSize), connectivity)
+                       for row_start in block_start_list]
+        for row_start, future in zip(block_start_list, future_list):
+            block_class_array, block_clump_array, block_clump_count = future.result()
+            row_end = row_start + block_class_array.shape[0]
+            class_array[row_start:row_end] = block_class_array
+            clump_array[row_start:row_end] = numpy.where(block_clump_array, block_clump_array + clump_offset, 0)
+            clump_offset += block_clump_count
+
+    # Join clumps across blocks and number them from 1
+    root_array = merge_block_clumps(class_array, clump_array, block_start_list, connectivity)
+    sequence_array, clump_count = get_sequential_labels(root_array, numpy.arange(root_array.size) != 0)
+    clump_array = sequence_array[clump_array]
+    logger.info('%d clumps in %d classes', clump_count, num_clusters)
+
+    # Band sums and pixel counts of each clump for merging small clumps and mean images
+    count_array = numpy.bincount(clump_array.ravel(), minlength=clump_count + 1).astype(numpy.float64)
+    sum_array = numpy.zeros((clump_count + 1, len(band_list)), dtype=numpy.float64)
+    for row_start in block_start_list:
+        row_end = min(row_start + block_rows, dataset.RasterYSize)
+        data_array, _valid_mask = read_window(dataset, band_list, row_start, row_end)
+        for band_index in range(len(band_list)):
+            sum_array[:, band_index] += numpy.bincount(clump_array[row_start:row_end].ravel(), weights=data_array[band_index].ravel(),
+                                                       minlength=clump_count + 1)
+
+    a_array, b_array = get_clump_adjacency(clump_array, block_rows, connectivity)
+    root_array, sum_array, count_array = eliminate_small_clumps(sum_array, count_array, a_array, b_array, min_size, max_spectral_dist)
+
+    # Number the remaining segments from 1
+    sequence_array, segment_count = get_sequential_labels(root_array, numpy.arange(root_array.size) != 0)
+    segment_root_array = numpy.flatnonzero((root_array == numpy.arange(root_array.size)) & (numpy.arange(root_array.size) != 0))
+    mean_array = sum_array[segment_root_array] / count_array[segment_root_array][:, numpy.newaxis]
+    logger.info('%d segments after merging clumps smaller than %d pixels', segment_count, min_size)
+
+    class_dataset = create_output_dataset(output_path_dict['classes'], dataset, 1, gdal.GDT_UInt16, file_format, format_options)
+    segment_dataset = create_output_dataset(output_path_dict['segments'], dataset, 1, gdal.GDT_UInt32, file_format, format_options)
+    mean_dataset = create_output_dataset(output_path_dict['segment_means'], dataset, len(band_list), gdal.GDT_Float32, file_format, format_options)
+    mean_array = numpy.concatenate([numpy.zeros((1, len(band_list))), mean_array]).astype(numpy.float32) # Segment 0 is no data
+    for row_start in block_start_list:
+        row_end = min(row_start + block_rows, dataset.RasterYSize)
+        segment_window_array = sequence_array[clump_array[row_start:row_end]]
+        class_dataset.GetRasterBand(1).WriteArray(class_array[row_start:row_end], 0, row_start)
+        segment_dataset.GetRasterBand(1).WriteArray(segment_window_array.astype(numpy.uint32), 0, row_start)
+        for band_index in range(len(band_list)):
+            mean_window_array = mean_array[segment_window_array, band_index]
+            mean_window_array[segment_window_array == 0] = numpy.nan
+            mean_dataset.GetRasterBand(band_index + 1).WriteArray(mean_window_array, 0, row_start)
+
+    class_dataset.GetRasterBand(1).SetNoDataValue(0)
+    segment_dataset.GetRasterBand(1).SetNoDataValue(0)
+    for band_index in range(len(band_list)):
+        mean_dataset.GetRasterBand(band_index + 1).SetNoDataValue(numpy.nan)
+    for output_dataset in [class_dataset, segment_dataset, mean_dataset]:
+        output_dataset.FlushCache()
+
+    logger.info('Finished writing %s', ', '.join(sorted(output_path_dict.values())))
+    return output_path_dict
+
+
+if __name__ == '__main__':
+    def label_components_reference(class_array, connectivity):
+        """Flood fill in raster order to check label_components() and merge_block_clumps() against"""
+        rows, cols = class_array.shape
+        label_array = numpy.zeros((rows, cols), dtype=numpy.int32)
+        offset_list = [(0, 1), (1, 0), (0, -1), (-1, 0)] + ([(1, 1), (1, -1), (-1, 1), (-1, -1)] if connectivity == 8 else [])
+        label_count = 0
+        for row in range(rows):
+            for col in range(cols):
+                if class_array[row, col] == 0 or label_array[row, col]:
+                    continue
+                label_count += 1
+                label_array[row, col] = label_count
+                pixel_list = [(row, col)]
+                while pixel_list:
+                    pixel_row, pixel_col = pixel_list.pop()
+                    for row_offset, col_offset in offset_list:
+                        neighbour_row, neighbour_col = pixel_row + row_offset, pixel_col + col_offset
+                        if (0 <= neighbour_row < rows and 0 <= neighbour_col < cols and not label_array[neighbour_row, neighbour_col] and
+                                class_array[neighbour_row, neighbour_col] == class_array[row, col]):
+                            label_array[neighbour_row, neighbour_col] = label_count
+                            pixel_list.append((neighbour_row, neighbour_col))
+        return label_array, label_count
+
+    def self_check():
+        """Checks clumping, block merging, small clump elimination and k-means on synthetic data"""
+        random_state = numpy.random.RandomState(0)
+        class_array = numpy.repeat(numpy.repeat(random_state.randint(0, 4, (20, 18)), 3, axis=0), 3, axis=1)
+        class_array[random_state.random_sample(class_array.shape) < 0.15] = random_state.randint(0, 4)
+        for connectivity in [4, 8]:
+            reference_array, reference_count = label_components_reference(class_array, connectivity)
+            clump_array, clump_count = label_components(class_array, connectivity)
+            assert clump_count == reference_count and numpy.array_equal(clump_array, reference_array), 'Clumps differ from flood fill'
+
+            for block_rows in [1, 4, 25]:
+                block_start_list = list(range(0, class_array.shape[0], block_rows))
+                block_clump_array = numpy.zeros(class_array.shape, dtype=numpy.int32)
+                clump_offset = 0
+                for row_start in block_start_list:
+                    window_clump_array, window_clump_count = label_components(class_array[row_start:row_start + block_rows], connectivity)
+                    block_clump_array[row_start:row_start + block_rows] = numpy.where(window_clump_array, window_clump_array + clump_offset, 0)
+                    clump_offset += window_clump_count
+                root_array = merge_block_clumps(class_array, block_clump_array, block_start_list, connectivity)
+                sequence_array, clump_count = get_sequential_labels(root_array, numpy.arange(root_array.size) != 0)
+                assert clump_count == reference_count and numpy.array_equal(sequence_array[block_clump_array], reference_array), \
+                    'Clumps from %d-row blocks differ from flood fill' % block_rows
+            logger.info('%d-connected clumping matches flood fill: %d clumps', connectivity, reference_count)
+
+            # Adjacency from blocks of rows matches all pairs of neighbouring pixels
+            neighbour_clump_array = label_components(class_array, 4)[0]
+            pair_set = set()
+            for row_offset, col_offset in [(0, 1), (1, 0)] + ([(1, 1), (1, -1)] if connectivity == 8 else []):
+                for row in range(class_array.shape[0] - row_offset):
+                    for col in range(max(-col_offset, 0), class_array.shape[1] - max(col_offset, 0)):
+                        a, b = neighbour_clump_array[row, col], neighbour_clump_array[row + row_offset, col + col_offset]
+                        if a and b and a != b:
+                            pair_set.add((min(a, b), max(a, b)))
+            a_array, b_array = get_clump_adjacency(neighbour_clump_array, 7, connectivity)
+            assert set(zip(a_array.tolist(), b_array.tolist())) == pair_set, '%d-connected clump adjacency differs' % connectivity
+
+        # Every clump is either big enough or has no neighbour close enough
+        data_array = random_state.normal(class_array * 100.0, 10.0)
+        clump_array, clump_count = label_components(class_array, 4)
+        count_array = numpy.bincount(clump_array.ravel(), minlength=clump_count + 1).astype(numpy.float64)
+        sum_array = numpy.bincount(clump_array.ravel(), weights=data_array.ravel(), minlength=clump_count + 1)[:, numpy.newaxis]
+        a_array, b_array = get_clump_adjacency(clump_array, 7)
+        root_array, merged_sum_array, merged_count_array_returned = eliminate_small_clumps(sum_array, count_array, a_array, b_array, 20, 150.0)
+        merged_clump_array = root_array[clump_array]
+        merged_count_array = numpy.bincount(merged_clump_array.ravel(), minlength=clump_count + 1)
+        assert numpy.array_equal(merged_count_array, merged_count_array_returned), 'Merged counts differ'
+        mean_array = numpy.bincount(merged_clump_array.ravel(), weights=data_array.ravel(), minlength=clump_count + 1) / numpy.maximum(merged_count_array, 1)
+        a_array, b_array = get_clump_adjacency(merged_clump_array, 7)
+        for a, b in zip(a_array, b_array):
+            for small, other in [(a, b), (b, a)]:
+                assert merged_count_array[small] >= 20 or abs(mean_array[small] - mean_array[other]) >= 150.0, \
+                    'Small clump %d left next to similar clump %d' % (small, other)
+        assert numpy.allclose(merged_sum_array[:, 0], numpy.bincount(merged_clump_array.ravel(), weights=data_array.ravel(), minlength=clump_count + 1)), \
+            'Merged sums differ'
+        logger.info('Small clump elimination: %d clumps merged into %d', clump_count, len(numpy.unique(merged_clump_array[merged_clump_array > 0])))
+
+        # With no distance limit, every small clump with a neighbour is merged
+        a_array, b_array = get_clump_adjacency(clump_array, 7)
+        root_array, _merged_sum_array, merged_count_array = eliminate_small_clumps(sum_array, count_array, a_array, b_array, 20, None)
+        a_array, b_array = get_clump_adjacency(root_array[clump_array], 7)
+        assert a_array.size and (merged_count_array[a_array] >= 20).all() and (merged_count_array[b_array] >= 20).all(), \
+            'Small clumps left with neighbours'
+
+        # Well separated clusters are found from streamed batches
+        true_centre_array = numpy.array([[0.0, 0.0], [1000.0, 0.0], [0.0, 1000.0], [1000.0, 1000.0]])
+        sample_array = (true_centre_array[random_state.randint(0, 4, 40000)] + random_state.normal(0.0, 50.0, (40000, 2)))
+        kmeans = MiniBatchKMeans(4, seed=1)
+        centre_array = kmeans.fit(lambda: (sample_array[sample_start:sample_start + 5000] for sample_start in range(0, 40000, 5000)),
+                                  cluster_move=0.1, batch_size=2000)
+        centre_error = numpy.abs(numpy.sort(centre_array, axis=0) - numpy.sort(true_centre_array, axis=0)).max()
+        assert centre_error < 5.0, 'K-means centres differ from true centres by %g' % centre_error
+        logger.info('Mini-batch k-means centres within %.1f of true centres', centre_error)
+
+    def parse_args():
+        arg_parser = argparse.ArgumentParser(description='Segments an image by k-means classification, clumping and merging small clumps')
+        arg_parser.add_argument('image_path', nargs='?', help='Image to segment, e.g. an NBAR or index tile')
+        arg_parser.add_argument('output_prefix', nargs='?', help='Prefix of output files')
+        arg_parser.add_argument('--bands', dest='band_list', default=None,
+                                help='Comma-separated list of one-based bands to use (default: all)')
+        arg_parser.add_argument('--clusters', dest='num_clusters', type=int, default=NUM_CLUSTERS,
+                                help='Number of k-means clusters (default: %d)' % NUM_CLUSTERS)
+        arg_parser.add_argument('--max-iterations', dest='max_iterations', type=int, default=MAX_ITERATIONS,
+                                help='Maximum passes over the image for k-means (default: %d)' % MAX_ITERATIONS)
+        arg_parser.add_argument('--cluster-move', dest='cluster_move', type=float, default=CLUSTER_MOVE,
+                                help='K-means stops when no centre moves further than this in a pass (default: %g)' % CLUSTER_MOVE)
+        arg_parser.add_argument('--subsample', dest='subsample', type=int, default=SUBSAMPLE,
+                                help='Use 1 in this many pixels for k-means (default: %d)' % SUBSAMPLE)
+        arg_parser.add_argument('--min-size', dest='min_size', type=int, default=MIN_SIZE,
+                                help='Minimum segment size in pixels (default: %d)' % MIN_SIZE)
+        arg_parser.add_argument('--max-spectral-dist', dest='max_spectral_dist', type=float, default=MAX_SPECTRAL_DIST,
+                                help='Only merge small clumps into neighbours with means closer than this, '
+                                'which can leave clumps smaller than --min-size - inf for no limit (default: %g)' % MAX_SPECTRAL_DIST)
+        arg_parser.add_argument('--connectivity', dest='connectivity', type=int, choices=[4, 8], default=4,
+                                help='Pixel connectivity of clumps (default: 4)')
+        arg_parser.add_argument('--workers', dest='workers', type=int, default=None,
+                                help='Number of worker processes (default: number of CPUs)')
+        arg_parser.add_argument('--block-rows', dest='block_rows', type=int, default=BLOCK_ROWS,
+                                help='Rows processed at a time (default: %d)' % BLOCK_ROWS)
+        arg_parser.add_argument('--format', dest='file_format', default=FORMAT,
+                                help='GDAL format of outputs (default: %s)' % FORMAT)
+        arg_parser.add_argument('--self-check', dest='self_check', action='store_true', default=False,
+                                help='Check the algorithms on synthetic data and exit')
+        args = arg_parser.parse_args()
+
+        if not args.self_check:
+            assert args.image_path and args.output_prefix, 'Image and output prefix must be specified'
+        if args.band_list:
+            args.band_list = [int(band_number) for band_number in args.band_list.split(',')]
+        return args
+
+    # Main function starts here
+    args = parse_args()
+    if args.self_check:
+        self_check()
+        sys.exit(0)
+
+    segment_image(args.image_path, args.output_prefix, args.band_list, args.num_clusters, args.max_iterations,
+                  args.cluster_move, args.subsample, args.min_size, args.max_spectral_dist, args.connectivity,
+                  args.workers, args.block_rows, file_format=args.file_format,
+                  format_options=FORMAT_OPTIONS if args.file_format == FORMAT else None)
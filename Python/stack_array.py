@@ -0,0 +1,449 @@
+'''
+Created on 16/10/2026
+
+Lazy (time, row, col) array view of a temporal stack of tiles
+'''
+import os
+import re
+import sys
+import logging
+import argparse
+import threading
+import numpy
+from datetime import datetime
+from collections import OrderedDict
+from xml.etree import ElementTree
+from osgeo import gdal, gdal_array
+from concurrent.futures import ThreadPoolExecutor
+
+# Date and satellite of datacube tile file names, e.g. LS7_ETM_NDVI_150_-025_2000-02-09T23-46-12.722217.tif
+TILE_NAME_REGEX = re.compile('^(\w+?)_(\w+?)_.+_(\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}(?:\.\d+)?)')
+MAX_OPEN_DATASETS = 32 # Datasets kept open by each reader thread
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+def get_vrt_tile_info_list(vrt_path):
+    """
+    Returns a list of tile info dicts for the bands of a VRT stack file, with 'tile_pathname',
+    'tile_layer' and 'nodata_value' taken from the VRT and 'satellite_tag', 'sensor_name' and
+    'start_datetime' from the datacube file name of each tile where it has one
+    """
+    tile_info_list = []
+    for vrt_band in ElementTree.parse(vrt_path).getroot().findall('VRTRasterBand'):
+        source = vrt_band.find('SimpleSource')
+        if source is None:
+            source = vrt_band.find('ComplexSource')
+        assert source is not None, 'No source for band %s of %s' % (vrt_band.get('band'), vrt_path)
+
+        source_filename = source.find('SourceFilename')
+        tile_path = source_filename.text
+        if source_filename.get('relativeToVRT') == '1':
+            tile_path = os.path.join(os.path.dirname(os.path.abspath(vrt_path)), tile_path)
+
+        no_data_element = vrt_band.find('NoDataValue')
+        tile_info = {'tile_pathname': tile_path,
+                     'tile_layer': int(source.findtext('SourceBand', '1')),
+                     'nodata_value': float(no_data_element.text) if no_data_element is not None else None,
+                     'satellite_tag': None,
+                     'sensor_name': None,
+                     'start_datetime': None}
+
+        tile_name_match = TILE_NAME_REGEX.match(os.path.basename(tile_path))
+        if tile_name_match:
+            tile_info['satellite_tag'], tile_info['sensor_name'], datetime_string = tile_name_match.groups()
+            tile_info['start_datetime'] = datetime.strptime(datetime_string.split('.')[0], '%Y-%m-%dT%H-%M-%S')
+            if '.' in datetime_string:
+                tile_info['start_datetime'] = tile_info['start_datetime'].replace(microsecond=int(datetime_string.split('.')[1].ljust(6, '0')[:6]))
+        tile_info_list.append(tile_info)
+    return tile_info_list
+
+
+class BlockCache(object):
+    """
+    Thread-safe cache of arrays keyed by (tile path, layer, block row, block col), with
+    least-recently-used eviction once max_bytes is exceeded
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._block_dict = OrderedDict() # Block arrays keyed by block key, least recently used first
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached block for key or None"""
+        with self._lock:
+            block_array = self._block_dict.pop(key, None)
+            if block_array is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._block_dict[key] = block_array # Most recently used
+            return block_array
+
+    def put(self, key, block_array):
+        with self._lock:
+            if key in self._block_dict:
+                self._cached_bytes -= self._block_dict.pop(key).nbytes
+            self._block_dict[key] = block_array
+            self._cached_bytes += block_array.nbytes
+
+            while self._block_dict and self._cached_bytes > self.max_bytes:
+                _key, evicted_array = self._block_dict.popitem(last=False)
+                self._cached_bytes -= evicted_array.nbytes
+
+
+class StackWindow(object):
+    """
+    Result of slicing a StackArray - the data read and the tile info dicts of its acquisitions,
+    in time order
+    """
+    def __init__(self, data, tile_info_list, nodata_value):
+        self.data = data
+        self.tile_info_list = tile_info_list
+        self.nodata_value = nodata_value
+
+    @property
+    def datetimes(self):
+        return [tile_info['start_datetime'] for tile_info in self.tile_info_list]
+
+    @property
+    def satellite_tags(self):
+        return [tile_info['satellite_tag'] for tile_info in self.tile_info_list]
+
+    def get_masked_array(self):
+        """Returns data as a numpy.ma.MaskedArray with no-data values masked"""
+        if self.nodata_value is None:
+            return numpy.ma.masked_array(self.data)
+        if numpy.isnan(self.nodata_value):
+            return numpy.ma.masked_invalid(self.data)
+        return numpy.ma.masked_equal(self.data, self.nodata_value)
+
+
+class StackArray(object):
+    """
+    Lazy (time, row, col) view of the tiles of a temporal stack, as listed in a stack_list from
+    the stack_info_dict of IndexStacker or in a VRT stack file. Slicing with integers and slices,
+    e.g. stack_array[t0:t1, y0:y1, x0:x1] or stack_array[:, row, col], or with a list of layer
+    indices on the time axis, reads only the GDAL blocks covering the window from each tile,
+    in a pool of threads, and returns a StackWindow. Blocks are kept in a BlockCache of
+    cache_mb MB so that neighbouring and repeated reads don't decode them again.
+    Each thread keeps at most max_open_datasets tiles open, closing the least recently used,
+    so that a long stack doesn't run out of file handles. close() closes them all.
+    """
+    def __init__(self, tile_info_list, workers=4, cache_mb=64, max_open_datasets=MAX_OPEN_DATASETS):
+        assert tile_info_list, 'No tiles in stack'
+        assert max_open_datasets > 0, 'At least one dataset must be kept open'
+        self.tile_info_list = sorted(tile_info_list, key=lambda tile_info: tile_info['start_datetime'] or datetime.min)
+        self.block_cache = BlockCache(int(cache_mb * 1024 * 1024))
+        self.max_open_datasets = max_open_datasets
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._thread_local = threading.local() # Datasets open in each thread, because GDAL datasets can't be shared
+        self._dataset_dict_list = [] # The dataset dict of every thread, for close()
+        self._dataset_dict_lock = threading.Lock()
+
+        dataset = self._open_dataset(self.tile_info_list[0]['tile_pathname'])
+        band = dataset.GetRasterBand(self.tile_info_list[0]['tile_layer'])
+        self.shape = (len(self.tile_info_list), dataset.RasterYSize, dataset.RasterXSize)
+        self.dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        self.nodata_value = self.tile_info_list[0].get('nodata_value')
+        if self.nodata_value is None:
+            self.nodata_value = band.GetNoDataValue()
+        self.geotransform = dataset.GetGeoTransform()
+        self.projection = dataset.GetProjection()
+
+    @classmethod
+    def from_vrt(cls, vrt_path, **kwargs):
+        """Returns a StackArray of the tiles in a VRT stack file"""
+        return cls(get_vrt_tile_info_list(vrt_path), **kwargs)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """Stops the reader threads and closes all datasets they have open"""
+        self._executor.shutdown(wait=True)
+        with self._dataset_dict_lock:
+            for dataset_dict in self._dataset_dict_list:
+                dataset_dict.clear() # Datasets are closed when no longer referenced
+            self._dataset_dict_list = []
+
+    @property
+    def datetimes(self):
+        return [tile_info['start_datetime'] for tile_info in self.tile_info_list]
+
+    def get_pixel(self, x, y):
+        """Returns (row, col) of the pixel containing the point x, y in the stack's coordinate system"""
+        return (int((y - self.geotransform[3]) / self.geotransform[5]),
+                int((x - self.geotransform[0]) / self.geotransform[1]))
+
+    @property
+    def open_dataset_count(self):
+        """Number of datasets currently held open by the reader threads"""
+        with self._dataset_dict_lock:
+            return sum([len(dataset_dict) for dataset_dict in self._dataset_dict_list])
+
+    def _open_dataset(self, tile_path):
+        dataset = gdal.Open(tile_path)
+        assert dataset, 'Unable to open dataset %s' % tile_path
+        return dataset
+
+    def _get_dataset(self, tile_path):
+        """Returns the dataset for tile_path open in the current thread, from its LRU of open datasets"""
+        dataset_dict = getattr(self._thread_local, 'dataset_dict', None)
+        if dataset_dict is None:
+            dataset_dict = self._thread_local.dataset_dict = OrderedDict() # Least recently used first
+            with self._dataset_dict_lock:
+                self._dataset_dict_list.append(dataset_dict)
+        dataset = dataset_dict.pop(tile_path, None)
+        if dataset is None:
+            dataset = self._open_dataset(tile_path)
+            while len(dataset_dict) >= self.max_open_datasets:
+                dataset_dict.popitem(last=False) # Closes the least recently used dataset
+        dataset_dict[tile_path] = dataset # Most recently used
+        return dataset
+
+    def read_layer_window(self, layer_index, row_start, row_end, col_start, col_end):
+        """
+        Returns the (row, col) array for rows row_start to row_end and columns col_start to col_end
+        of layer layer_index, assembled from cached GDAL blocks. Missing blocks are read in one call.
+        """
+        tile_info = self.tile_info_list[layer_index]
+        band = self._get_dataset(tile_info['tile_pathname']).GetRasterBand(tile_info['tile_layer'])
+        block_cols, block_rows = band.GetBlockSize()
+
+        block_row_range = range(row_start // block_rows, (row_end - 1) // block_rows + 1)
+        block_col_range = range(col_start // block_cols, (col_end - 1) // block_cols + 1)
+        block_dict = {} # Block arrays keyed by (block row, block col)
+        missing_block_list = []
+        for block_row in block_row_range:
+            for block_col in block_col_range:
+                block_array = self.block_cache.get((tile_info['tile_pathname'], tile_info['tile_layer'], block_row, block_col))
+                if block_array is None:
+                    missing_block_list.append((block_row, block_col))
+                else:
+                    block_dict[(block_row, block_col)] = block_array
+
+        if missing_block_list:
+            # Read the rectangle of blocks enclosing all missing blocks
+            read_row_start = min([block_row for block_row, _block_col in missing_block_list]) * block_rows
+            read_row_end = min((max([block_row for block_row, _block_col in missing_block_list]) + 1) * block_rows, band.YSize)
+            read_col_start = min([block_col for _block_row, block_col in missing_block_list]) * block_cols
+            read_col_end = min((max([block_col for _block_row, block_col in missing_block_list]) + 1) * block_cols, band.XSize)
+            read_array = band.ReadAsArray(read_col_start, read_row_start,
+                                          read_col_end - read_col_start, read_row_end - read_row_start)
+            assert read_array is not None, 'Unable to read layer %d of %s' % (tile_info['tile_layer'], tile_info['tile_pathname'])
+
+            for block_row, block_col in missing_block_list:
+                block_array = read_array[block_row * block_rows - read_row_start:(block_row + 1) * block_rows - read_row_start,
+                                         block_col * block_cols - read_col_start:(block_col + 1) * block_cols - read_col_start].copy()
+                block_dict[(block_row, block_col)] = block_array
+                self.block_cache.put((tile_info['tile_pathname'], tile_info['tile_layer'], block_row, block_col), block_array)
+
+        layer_array = numpy.empty((row_end - row_start, col_end - col_start), dtype=self.dtype)
+        for (block_row, block_col), block_array in block_dict.items():
+            block_row_start = block_row * block_rows
+            block_col_start = block_col * block_cols
+            # Intersection of block and window
+            intersect_row_start = max(row_start, block_row_start)
+            intersect_row_end = min(row_end, block_row_start + block_array.shape[0])
+            intersect_col_start = max(col_start, block_col_start)
+            intersect_col_end = min(col_end, block_col_start + block_array.shape[1])
+            layer_array[intersect_row_start - row_start:intersect_row_end - row_start,
+                        intersect_col_start - col_start:intersect_col_end - col_start] = block_array[intersect_row_start - block_row_start:intersect_row_end - block_row_start,
+                                                                                                    intersect_col_start - block_col_start:intersect_col_end - block_col_start]
+        return layer_array
+
+    def _get_axis_index(self, key, axis):
+        """Returns (start, stop, step, squeeze) for an integer or slice key on axis 1 or 2"""
+        axis_size = self.shape[axis]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(axis_size)
+            assert step > 0, 'Negative steps are not supported'
+            return start, max(start, stop), step, False
+
+        index = int(key)
+        if index < 0:
+            index += axis_size
+        if not 0 <= index < axis_size:
+            raise IndexError('Index %d is out of range for axis %d with size %d' % (key, axis, axis_size))
+        return index, index + 1, 1, True
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        assert len(key) <= 3, 'Too many indices for (time, row, col) stack'
+        key = key + (slice(None),) * (3 - len(key))
+
+        # Time axis
+        time_key = key[0]
+        squeeze_time = False
+        if isinstance(time_key, slice):
+            layer_index_list = list(range(*time_key.indices(self.shape[0])))
+        elif isinstance(time_key, (list, tuple, numpy.ndarray)):
+            layer_index_list = [int(layer_index) for layer_index in time_key]
+        else:
+            layer_index_list = [int(time_key)]
+            squeeze_time = True
+
+        for layer_position, layer_index in enumerate(layer_index_list):
+            if not -self.shape[0] <= layer_index < self.shape[0]:
+                raise IndexError('Index %d is out of range for time axis with size %d' % (layer_index, self.shape[0]))
+            layer_index_list[layer_position] = layer_index % self.shape[0]
+
+        row_start, row_end, row_step, squeeze_row = self._get_axis_index(key[1], 1)
+        col_start, col_end, col_step, squeeze_col = self._get_axis_index(key[2], 2)
+
+        data = numpy.empty((len(layer_index_list),
+                            len(range(row_start, row_end, row_step)),
+                            len(range(col_start, col_end, col_step))), dtype=self.dtype)
+        if data.size:
+            def read_layer(layer_position):
+                data[layer_position] = self.read_layer_window(layer_index_list[layer_position],
+                                                              row_start, row_end, col_start, col_end)[::row_step, ::col_step]
+
+            for _result in self._executor.map(read_layer, range(len(layer_index_list))):
+                pass # Raises any exception from the read
+
+        if squeeze_col:
+            data = data[:, :, 0]
+        if squeeze_row:
+            data = data[:, 0]
+        if squeeze_time:
+            data = data[0]
+        return StackWindow(data, [self.tile_info_list[layer_index] for layer_index in layer_index_list], self.nodata_value)
+
+
+if __name__ == '__main__':
+    class FakeBand(object):
+        """Band of a FakeDataset, read through ReadAsArray() like a GDAL band with small blocks"""
+        def __init__(self, layer_array, block_size):
+            self.layer_array = layer_array
+            self.block_size = block_size
+            self.DataType = gdal_array.NumericTypeCodeToGDALTypeCode(layer_array.dtype.type)
+            self.YSize, self.XSize = layer_array.shape
+
+        def GetBlockSize(self):
+            return list(self.block_size)
+
+        def GetNoDataValue(self):
+            return -999
+
+        def ReadAsArray(self, xoff, yoff, win_xsize, win_ysize):
+            assert xoff % self.block_size[0] == 0 and yoff % self.block_size[1] == 0, 'Read is not aligned to blocks'
+            return self.layer_array[yoff:yoff + win_ysize, xoff:xoff + win_xsize].copy()
+
+    class FakeDataset(object):
+        """In-memory stand-in for a GDAL dataset of one layer, counting how many are open"""
+        open_count = 0
+
+        def __init__(self, layer_array, block_size):
+            self.band = FakeBand(layer_array, block_size)
+            self.RasterYSize, self.RasterXSize = layer_array.shape
+            FakeDataset.open_count += 1
+
+        def __del__(self):
+            FakeDataset.open_count -= 1
+
+        def GetRasterBand(self, band_number):
+            assert band_number == 1, 'Fake datasets have one band'
+            return self.band
+
+        def GetGeoTransform(self):
+            return (150.0, 0.00025, 0.0, -25.0, 0.0, -0.00025)
+
+        def GetProjection(self):
+            return ''
+
+    def self_check():
+        """Checks slicing against numpy indexing, and the limit on open datasets, on fake tiles with small blocks"""
+        random_state = numpy.random.RandomState(0)
+        data_array = random_state.randint(-1000, 1000, (40, 37, 29)).astype(numpy.int16)
+        tile_info_list = [{'tile_pathname': 'LS5_TM_NDVI_150_-025_%d-01-01T00-00-00.tif' % (1987 + layer_index), 'tile_layer': 1,
+                           'nodata_value': -999, 'satellite_tag': 'LS5', 'sensor_name': 'TM',
+                           'start_datetime': datetime(1987 + layer_index, 1, 1)} for layer_index in range(data_array.shape[0])]
+
+        class FakeStackArray(StackArray):
+            def _open_dataset(self, tile_path):
+                return FakeDataset(data_array[int(os.path.basename(tile_path).split('_')[4][:4]) - 1987], (8, 5))
+
+        key_list = [(slice(None), 5, 7),
+                    (slice(None), slice(3, 17), slice(2, 28)),
+                    (slice(2, 30, 3), slice(0, 37, 4), slice(None, None, 2)),
+                    (7,),
+                    (-1, -1, -1),
+                    ([0, 39, 5], slice(30, 37), 0),
+                    (slice(None), slice(10, 10), slice(None)),
+                    (slice(5, 15), 36, slice(20, 100))]
+        for max_open_datasets in [1, 3, 100]:
+            with FakeStackArray(tile_info_list, workers=3, cache_mb=0.01, max_open_datasets=max_open_datasets) as stack_array:
+                assert stack_array.shape == data_array.shape and stack_array.dtype == data_array.dtype, 'Stack shape or type differs'
+                for _repeat in range(2): # Second time partly from the block cache
+                    for key in key_list:
+                        stack_window = stack_array[key]
+                        reference_array = data_array[key]
+                        assert stack_window.data.shape == reference_array.shape and numpy.array_equal(stack_window.data, reference_array), \
+                            'Slice %r differs from numpy indexing' % (key,)
+                        assert len(stack_window.tile_info_list) == len(numpy.arange(data_array.shape[0])[key[0]].reshape((-1,))), \
+                            'Slice %r has the wrong tile info' % (key,)
+                        assert stack_array.open_dataset_count <= 3 * max_open_datasets, \
+                            '%d datasets open for %d threads of %d' % (stack_array.open_dataset_count, 3, max_open_datasets)
+            assert stack_array.open_dataset_count == 0 and FakeDataset.open_count == 0, \
+                '%d datasets still open after close()' % FakeDataset.open_count
+            logger.info('Slices match numpy indexing with %d datasets open per thread, block cache hits %d, misses %d',
+                        max_open_datasets, stack_array.block_cache.hits, stack_array.block_cache.misses)
+
+    def parse_args():
+        arg_parser = argparse.ArgumentParser(description='Reads the time series of a pixel or window from a VRT stack file')
+        arg_parser.add_argument('vrt_path', nargs='?', help='VRT stack file')
+        arg_parser.add_argument('--pixel', dest='pixel', default=None,
+                                help='Print the time series of the pixel "row,col"')
+        arg_parser.add_argument('--window', dest='window', default=None,
+                                help='Print the mean of each acquisition for the window "row_start,row_end,col_start,col_end"')
+        arg_parser.add_argument('--workers', dest='workers', type=int, default=4,
+                                help='Number of reader threads (default: 4)')
+        arg_parser.add_argument('--self-check', dest='self_check', action='store_true', default=False,
+                                help='Check slicing against numpy indexing on fake tiles and exit')
+        args = arg_parser.parse_args()
+
+        if not args.self_check:
+            assert args.vrt_path, 'VRT stack file must be specified'
+        return args
+
+    # Main function starts here
+    args = parse_args()
+    if args.self_check:
+        self_check()
+        sys.exit(0)
+
+    with StackArray.from_vrt(args.vrt_path, workers=args.workers) as stack_array:
+        logger.info('%s: %d acquisitions of %d x %d %s', args.vrt_path, stack_array.shape[0],
+                    stack_array.shape[2], stack_array.shape[1], stack_array.dtype)
+        if args.pixel:
+            row, col = [int(value) for value in args.pixel.split(',')]
+            stack_window = stack_array[:, row, col]
+            for tile_info, value in zip(stack_window.tile_info_list, stack_window.data):
+                logger.info('%s %s %s', tile_info['start_datetime'], tile_info['satellite_tag'], value)
+        if args.window:
+            row_start, row_end, col_start, col_end = [int(value) for value in args.window.split(',')]
+            stack_window = stack_array[:, row_start:row_end, col_start:col_end]
+            for tile_info, layer_array in zip(stack_window.tile_info_list, stack_window.get_masked_array()):
+                logger.info('%s %s %s', tile_info['start_datetime'], tile_info['satellite_tag'], layer_array.mean())
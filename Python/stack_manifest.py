@@ -0,0 +1,91 @@
+'''
+Created on 16/10/2026
+
+Manifest of derived outputs for incremental rebuilds of temporal stacks
+'''
+import os
+import sys
+import logging
+import sqlite3
+import hashlib
+
+MANIFEST_FILENAME = 'stack_manifest.sqlite'
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+class StackManifest(object):
+    """
+    SQLite database kept in an output directory which records, for every output file created
+    there, a fingerprint of everything the output was made from: the path, modification time
+    and size of each input file and a definition string covering the calculation and the
+    code version. An output only needs to be rebuilt when its fingerprint changes, which can
+    be checked without opening the output itself.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self._connection = None
+        self._connection_pid = None
+
+    @property
+    def connection(self):
+        """SQLite connection for this process, created on first use"""
+        # Connections can't be shared with forked worker processes
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.manifest_path, timeout=60)
+            self._connection_pid = os.getpid()
+            self._connection.execute('create table if not exists output (' +
+                                     'output_path text primary key, ' +
+                                     'fingerprint text not null)')
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def fingerprint(input_path_list, definition):
+        """
+        Returns a hex digest of the path, modification time and size of each file in
+        input_path_list and the definition string. Missing input files are included by name only.
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(('%s\n' % definition).encode('utf-8'))
+        for input_path in input_path_list:
+            try:
+                input_stat = os.stat(input_path)
+                sha1.update(('%s %r %d\n' % (input_path, input_stat.st_mtime, input_stat.st_size)).encode('utf-8'))
+            except OSError:
+                sha1.update(('%s missing\n' % input_path).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def get_fingerprint(self, output_path):
+        """Returns the fingerprint recorded for output_path, or None if there is no record"""
+        row = self.connection.execute('select fingerprint from output where output_path = ?',
+                                      (output_path,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def is_current(self, output_path, fingerprint):
+        """Returns True if output_path exists and was recorded with the specified fingerprint"""
+        return self.get_fingerprint(output_path) == fingerprint and os.path.exists(output_path)
+
+    def record(self, output_path, fingerprint):
+        """Records output_path as having been created with the specified fingerprint"""
+        self.connection.execute('insert or replace into output (output_path, fingerprint) values (?, ?)',
+                                (output_path, fingerprint))
+        self.connection.commit()
+        logger.debug('Recorded %s in manifest %s', output_path, self.manifest_path)
+
+    def forget(self, output_path):
+        """Removes any record of output_path, so that it is not taken as current if rewriting it is interrupted"""
+        self.connection.execute('delete from output where output_path = ?', (output_path,))
+        self.connection.commit()
@@ -0,0 +1,195 @@
+'''
+Created on 16/10/2026
+
+Opt-in per-stage timing, I/O and memory profile of a stacking run
+'''
+import os
+import sys
+import json
+import logging
+import resource
+import threading
+from timeit import default_timer
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+def get_cpu_seconds(include_children=False):
+    """
+    Returns user + system CPU time of this process (all threads), plus that of its terminated
+    child processes which have been waited for if include_children
+    """
+    process_times = os.times()
+    return sum(process_times[:4] if include_children else process_times[:2])
+
+
+def get_peak_rss_mb():
+    """Returns the peak resident set size of this process in MB since it started or since reset_peak_rss()"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # ru_maxrss is in kB on Linux
+
+
+def get_children_peak_rss_mb():
+    """Returns the largest peak resident set size in MB of any terminated child process so far"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of this process to its current resident set size (Linux only).
+    returns True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class NullStage(object):
+    """Context manager which records nothing, returned by StageProfiler.stage() when disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+class ProfiledStage(object):
+    """Context manager which adds its wall and CPU time to a StageProfiler on exit"""
+    def __init__(self, profiler, stage_name, output_tag):
+        self.profiler = profiler
+        self.stage_name = stage_name
+        self.output_tag = output_tag
+
+    def __enter__(self):
+        self.start_seconds = default_timer()
+        self.start_cpu_seconds = get_cpu_seconds()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_time(self.stage_name, self.output_tag,
+                               default_timer() - self.start_seconds,
+                               get_cpu_seconds() - self.start_cpu_seconds)
+        return False
+
+
+class StageProfiler(object):
+    """
+    Records calls, wall time, CPU time and bytes read and written for named stages, optionally
+    per output tag (index), together with event counters and the peak RSS of each process.
+    Stages may be nested, so the time of an enclosing stage includes its inner stages. CPU time
+    is that of the whole process, so it includes other threads running at the same time.
+
+    A disabled profiler does nothing: stage() returns a shared no-op context manager and the
+    other methods return immediately.
+
+    Worker processes can send get_state() back to be combined with merge_state().
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._stage_dict = {} # [calls, wall_seconds, cpu_seconds, bytes_read, bytes_written] keyed by (stage_name, output_tag)
+        self._counter_dict = {}
+        self._peak_rss_dict = {} # Peak RSS in MB of worker processes keyed by process id
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self._stage_dict = {}
+        self._counter_dict = {}
+        self._peak_rss_dict = {}
+
+    def stage(self, stage_name, output_tag=None):
+        """Returns a context manager which records the time spent in it against stage_name and output_tag"""
+        if not self.enabled:
+            return NULL_STAGE
+        return ProfiledStage(self, stage_name, output_tag)
+
+    def _get_record(self, stage_name, output_tag):
+        return self._stage_dict.setdefault((stage_name, output_tag), [0, 0.0, 0.0, 0, 0])
+
+    def add_time(self, stage_name, output_tag, wall_seconds, cpu_seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            stage_record = self._get_record(stage_name, output_tag)
+            stage_record[0] += 1
+            stage_record[1] += wall_seconds
+            stage_record[2] += cpu_seconds
+
+    def add_bytes(self, stage_name, output_tag=None, bytes_read=0, bytes_written=0):
+        if not self.enabled:
+            return
+        with self._lock:
+            stage_record = self._get_record(stage_name, output_tag)
+            stage_record[3] += bytes_read
+            stage_record[4] += bytes_written
+
+    def count(self, counter_name, increment=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counter_dict[counter_name] = self._counter_dict.get(counter_name, 0) + increment
+
+    def get_state(self):
+        """Returns the picklable state of this profiler for merge_state()"""
+        return {'stages': list(self._stage_dict.items()),
+                'counters': dict(self._counter_dict),
+                'peak_rss_mb': {os.getpid(): get_peak_rss_mb()}}
+
+    def merge_state(self, state):
+        """Adds the state from get_state() of another profiler (e.g. in a worker process) to this one"""
+        if not self.enabled or not state:
+            return
+        with self._lock:
+            for stage_key, other_record in state['stages']:
+                stage_record = self._get_record(*stage_key)
+                for value_index in range(len(stage_record)):
+                    stage_record[value_index] += other_record[value_index]
+            for counter_name, increment in state['counters'].items():
+                self._counter_dict[counter_name] = self._counter_dict.get(counter_name, 0) + increment
+            for process_id, peak_rss_mb in state['peak_rss_mb'].items():
+                self._peak_rss_dict[process_id] = max(self._peak_rss_dict.get(process_id, 0.0), peak_rss_mb)
+
+    def get_profile(self):
+        """
+        Returns a dict of stage totals, with per-index totals under 'indices' for stages recorded
+        with an output tag, event counters and peak RSS in MB of this and each worker process.
+        """
+        field_names = ['calls', 'wall_seconds', 'cpu_seconds', 'bytes_read', 'bytes_written']
+        stage_profile_dict = {}
+        for (stage_name, output_tag), stage_record in sorted(self._stage_dict.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            stage_profile = stage_profile_dict.setdefault(stage_name, dict([(field_name, 0) for field_name in field_names]))
+            for field_name, value in zip(field_names, stage_record):
+                stage_profile[field_name] += value
+            if output_tag is not None:
+                stage_profile.setdefault('indices', {})[output_tag] = dict(zip(field_names, stage_record))
+
+        peak_rss_dict = dict([(str(process_id), peak_rss_mb) for process_id, peak_rss_mb in self._peak_rss_dict.items()])
+        peak_rss_dict[str(os.getpid())] = get_peak_rss_mb()
+        return {'stages': stage_profile_dict,
+                'counters': dict(self._counter_dict),
+                'peak_rss_mb': peak_rss_dict}
+
+    def write(self, profile_path):
+        """Writes get_profile() to profile_path as JSON and logs a summary"""
+        profile = self.get_profile()
+        with open(profile_path, 'w') as profile_file:
+            json.dump(profile, profile_file, indent=1, sort_keys=True)
+
+        for stage_name in sorted(profile['stages'].keys()):
+            stage_profile = profile['stages'][stage_name]
+            logger.info('%-12s %6d calls %10.1fs wall %10.1fs CPU %10.1fMB read %10.1fMB written',
+                        stage_name, stage_profile['calls'], stage_profile['wall_seconds'], stage_profile['cpu_seconds'],
+                        stage_profile['bytes_read'] / 1048576.0, stage_profile['bytes_written'] / 1048576.0)
+        logger.info('Profile written to %s', profile_path)
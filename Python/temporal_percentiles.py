@@ -0,0 +1,417 @@
+'''
+Created on 16/10/2026
+
+Per-pixel temporal percentiles of a stack file within a memory budget
+'''
+import sys
+import math
+import logging
+import numpy
+from osgeo import gdal, gdal_array
+
+PERCENTILE_LIST = [50, 10, 90] # Median first, as written to the output bands
+HISTOGRAM_BINS = 256 # Default number of bins per pixel for histogram percentiles
+SEARCH_PIXELS = 4096 # Pixels of cumulative histograms searched at a time, bounding the comparison temporary
+RANGE_SAMPLE_SIZE = 1000000 # Values sampled from a stack to find its histogram range
+RANGE_CLIP_PERCENTILE = 0.1 # Percent of sampled values at each end left outside the histogram range, in the overflow bins
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+def get_valid_mask(data_array, no_data_value):
+    """Returns a boolean array which is False for no data values and non-finite values (NaN and inf) in data_array"""
+    if data_array.dtype.kind == 'f':
+        valid_mask = numpy.isfinite(data_array)
+    else:
+        valid_mask = numpy.ones(data_array.shape, dtype=numpy.bool_)
+    if no_data_value is not None and not numpy.isnan(no_data_value):
+        valid_mask &= (data_array != no_data_value)
+    return valid_mask
+
+
+def get_band_name(percentile):
+    if percentile == 50:
+        return 'Median'
+    return 'Percentile %g' % percentile
+
+
+def get_sample_range(layer_iterator, no_data_value, sample_stride=1, clip_percentile=RANGE_CLIP_PERCENTILE):
+    """
+    Returns the (min, max) histogram range of the layers from layer_iterator: the clip_percentile
+    and 100 - clip_percentile percentiles of every sample_stride-th valid value, so that a few
+    outliers don't stretch the bins. Returns (0, 0) if there are no valid values.
+    """
+    sample_list = []
+    position = 0 # Of the first value of each layer in all the values read
+    for layer_array in layer_iterator:
+        sample_array = layer_array.reshape((-1,))[(-position) % sample_stride::sample_stride]
+        sample_list.append(sample_array[get_valid_mask(sample_array, no_data_value)])
+        position += layer_array.size
+    sample_array = numpy.concatenate(sample_list) if sample_list else numpy.zeros((0,))
+    if not sample_array.size: # No valid data
+        return (0, 0)
+    value_min, value_max = numpy.percentile(sample_array.astype(numpy.float64), [clip_percentile, 100 - clip_percentile])
+    return (float(value_min), float(value_max))
+
+
+def interpolate_order_statistics(get_order_statistic, count, percentile_list, no_data_value):
+    """
+    Returns a float32 (percentile, pixel) array of percentiles using numpy's default linear
+    interpolation between the order statistics either side. get_order_statistic(order_array)
+    must return the value of the zero-based order statistic order_array of each pixel.
+    Pixels with no valid values are set to no_data_value.
+    """
+    percentile_array = numpy.empty((len(percentile_list), count.shape[0]), dtype=numpy.float32)
+    last_order = numpy.maximum(count - 1, 0)
+    for percentile_index, percentile in enumerate(percentile_list):
+        position = last_order * (percentile / 100.0)
+        lower_order = numpy.floor(position).astype(numpy.int64)
+        upper_order = numpy.minimum(lower_order + 1, last_order)
+        lower_value = get_order_statistic(lower_order)
+        upper_value = get_order_statistic(upper_order)
+        percentile_array[percentile_index] = lower_value + (upper_value - lower_value) * (position - lower_order)
+        percentile_array[percentile_index][count == 0] = no_data_value
+    return percentile_array
+
+
+def exact_bytes_per_pixel(layers, itemsize):
+    """
+    Returns the memory per pixel needed by calc_percentiles_exact() for a window of layers values
+    of itemsize bytes: the window itself, its float32 pixel-major copy and two boolean no data masks,
+    and the per-pixel count, index and interpolation arrays
+    """
+    return layers * (itemsize + 6) + 128
+
+
+def calc_percentiles_exact(stack_array, no_data_value, percentile_list=PERCENTILE_LIST):
+    """
+    Returns a float32 (percentile, row, col) array of the exact percentiles over the first
+    axis of the (layer, row, col) stack_array, excluding no_data_value, by sorting each pixel.
+    """
+    layers, rows, cols = stack_array.shape
+    # Pixel-major so that each pixel's values are contiguous for sorting. No data sorts last as NaN
+    sort_array = numpy.empty((rows * cols, layers), dtype=numpy.float32)
+    sort_array[...] = stack_array.reshape((layers, rows * cols)).T
+    sort_array[~get_valid_mask(sort_array, no_data_value)] = numpy.nan
+    count = (~numpy.isnan(sort_array)).sum(axis=1)
+    sort_array.sort(axis=1)
+
+    pixel_index = numpy.arange(rows * cols)
+    percentile_array = interpolate_order_statistics(lambda order_array: sort_array[pixel_index, order_array],
+                                                    count, percentile_list, no_data_value)
+    return percentile_array.reshape((len(percentile_list), rows, cols))
+
+
+class HistogramPercentiles(object):
+    """
+    Fixed-bin histogram of each pixel over a time series of (row, col) layers added one at a
+    time, so memory depends on the number of bins rather than the number of layers.
+    Percentiles are interpolated within the bin containing each order statistic, assuming
+    values are spread evenly across the bin. The error is therefore less than one bin width,
+    and integer data with bins one unit wide gives exact percentiles.
+    Values outside value_range are counted in an overflow bin at each end, and percentiles
+    falling in an overflow bin are clipped to value_range. Non-finite values are ignored.
+
+    get_percentiles() makes the histograms cumulative in place, so no more layers can be
+    added after it has been called.
+    """
+    def __init__(self, shape, value_range, no_data_value, integer=True, bins=HISTOGRAM_BINS, max_layers=65535):
+        self.shape = tuple(shape)
+        self.no_data_value = no_data_value
+        self.integer = integer
+        self.value_min = float(value_range[0])
+        self.value_max = float(value_range[1])
+        if integer:
+            # Bins cover whole numbers of integer values
+            self.bin_width = max(int(math.ceil((value_range[1] - value_range[0] + 1) / float(bins))), 1)
+            self.bins = int(math.ceil((value_range[1] - value_range[0] + 1) / float(self.bin_width)))
+        else:
+            self.bin_width = (value_range[1] - value_range[0]) / float(bins) or 1.0
+            self.bins = bins
+        count_dtype = numpy.uint16 if max_layers <= numpy.iinfo(numpy.uint16).max else numpy.uint32
+        # Overflow bins below and above value_range either side of the bins
+        self.count_array = numpy.zeros((self.shape[0] * self.shape[1], self.bins + 2), dtype=count_dtype)
+        self._pixel_index = numpy.arange(self.shape[0] * self.shape[1])
+        self._cumulative = False
+
+    @staticmethod
+    def bytes_per_pixel(bins=HISTOGRAM_BINS, max_layers=65535):
+        """
+        Returns the memory needed per pixel: the counts, which become the cumulative counts in
+        place, and the per-pixel index, order and value arrays of add_layer() and get_percentiles()
+        """
+        return (bins + 2) * (2 if max_layers <= 65535 else 4) + 104
+
+    @staticmethod
+    def fixed_bytes(bins=HISTOGRAM_BINS):
+        """Returns the memory needed regardless of the number of pixels, for searching SEARCH_PIXELS at a time"""
+        return SEARCH_PIXELS * (bins + 10)
+
+    def add_layer(self, layer_array):
+        """Adds one (row, col) layer to the histograms"""
+        assert not self._cumulative, 'Layers cannot be added after get_percentiles()'
+        layer_array = layer_array.reshape((-1,))
+        valid_mask = get_valid_mask(layer_array, self.no_data_value)
+        value_array = layer_array[valid_mask]
+        bin_array = numpy.floor((value_array - self.value_min) / self.bin_width).astype(numpy.int64)
+        bin_array += 1 # After the lower overflow bin
+        numpy.clip(bin_array, 1, self.bins, out=bin_array)
+        bin_array[value_array < self.value_min] = 0
+        bin_array[value_array > self.value_max] = self.bins + 1
+        # Each pixel has one value per layer so there are no repeated (pixel, bin) pairs
+        self.count_array[self._pixel_index[valid_mask], bin_array] += 1
+
+    def get_percentiles(self, percentile_list=PERCENTILE_LIST):
+        """Returns a float32 (percentile, row, col) array of percentiles of the layers added"""
+        if not self._cumulative:
+            numpy.cumsum(self.count_array, axis=1, out=self.count_array)
+            self._cumulative = True
+        cumulative_array = self.count_array
+        count = cumulative_array[:, -1].astype(numpy.int64)
+        # Integer values in a bin run from its first to its last integer, not its upper edge
+        value_spread = self.bin_width - 1 if self.integer else self.bin_width
+
+        def get_order_statistic(order_array):
+            # The first bin whose cumulative count exceeds the order
+            bin_array = numpy.empty(order_array.shape, dtype=numpy.int64)
+            for pixel_start in range(0, order_array.shape[0], SEARCH_PIXELS):
+                pixel_slice = slice(pixel_start, pixel_start + SEARCH_PIXELS)
+                bin_array[pixel_slice] = (cumulative_array[pixel_slice] <= order_array[pixel_slice, numpy.newaxis]).sum(axis=1)
+            numpy.minimum(bin_array, self.bins + 1, out=bin_array)
+            count_before = numpy.where(bin_array > 0, cumulative_array[self._pixel_index, bin_array - 1], 0).astype(numpy.float64)
+            count_in_bin = numpy.maximum(cumulative_array[self._pixel_index, bin_array] - count_before, 1)
+            value_array = (self.value_min + self.bin_width * (bin_array - 1) +
+                           value_spread * (order_array - count_before + 0.5) / count_in_bin)
+            # Overflow bins have no spread of values to interpolate within
+            return numpy.clip(value_array, self.value_min, self.value_max, out=value_array)
+
+        percentile_array = interpolate_order_statistics(get_order_statistic, count, percentile_list, self.no_data_value)
+        return percentile_array.reshape((len(percentile_list),) + self.shape)
+
+
+class TemporalPercentiles(object):
+    """
+    Calculates per-pixel percentiles over all layers of a stack file, excluding no data,
+    in windows of whole rows sized to keep within max_memory_mb. The method is one of:
+        'exact' - sort every pixel's time series (memory grows with the number of layers)
+        'histogram' - HistogramPercentiles with the specified number of bins
+        'auto' - whichever of the two needs less memory per pixel
+    """
+    def __init__(self, percentile_list=PERCENTILE_LIST, max_memory_mb=256, method='auto', bins=HISTOGRAM_BINS):
+        assert method in ['auto', 'exact', 'histogram'], 'Invalid percentile method %s' % method
+        self.percentile_list = list(percentile_list)
+        self.max_memory_mb = max_memory_mb
+        self.method = method
+        self.bins = bins
+
+    def get_method(self, layers, itemsize):
+        """Returns 'exact' or 'histogram' for the method of this object"""
+        if self.method != 'auto':
+            return self.method
+        if exact_bytes_per_pixel(layers, itemsize) <= HistogramPercentiles.bytes_per_pixel(self.bins, layers):
+            return 'exact'
+        return 'histogram'
+
+    def get_window_rows(self, rows, cols, bytes_per_pixel, fixed_bytes=0):
+        """
+        Returns the number of whole rows which can be processed within max_memory_mb, with
+        bytes_per_pixel for each pixel of the window and the percentile output, plus fixed_bytes
+        """
+        window_rows = int((self.max_memory_mb * 1024 * 1024 - fixed_bytes) // (cols * (bytes_per_pixel + 4 * len(self.percentile_list))))
+        assert window_rows, 'Memory budget of %sMB is too small for one row' % self.max_memory_mb
+        return min(window_rows, rows)
+
+    def get_value_range(self, stack_dataset, no_data_value, window_rows, integer=False):
+        """
+        Returns the (min, max) histogram range of the valid values in stack_dataset from
+        get_sample_range() of about RANGE_SAMPLE_SIZE values, widened to whole numbers if integer
+        """
+        layers, rows, cols = stack_dataset.RasterCount, stack_dataset.RasterYSize, stack_dataset.RasterXSize
+
+        def iter_layers():
+            for band_index in range(layers):
+                band = stack_dataset.GetRasterBand(band_index + 1)
+                for row_start in range(0, rows, window_rows):
+                    yield band.ReadAsArray(0, row_start, cols, min(window_rows, rows - row_start))
+
+        value_min, value_max = get_sample_range(iter_layers(), no_data_value,
+                                                max(layers * rows * cols // RANGE_SAMPLE_SIZE, 1))
+        if integer:
+            return (int(math.floor(value_min)), int(math.ceil(value_max)))
+        return (value_min, value_max)
+
+    def calc(self, stack_dataset_path, percentile_dataset_path, no_data_value, value_range=None):
+        """
+        Writes a float32 Envi file percentile_dataset_path with one band per percentile of
+        the layers of stack_dataset_path. value_range is the (min, max) of valid values for
+        histogram percentiles. If None, it is found by get_value_range() in a first pass over
+        the stack, leaving outliers in the overflow bins.
+        """
+        stack_dataset = gdal.Open(stack_dataset_path)
+        assert stack_dataset, 'Unable to open stack file %s' % stack_dataset_path
+        layers = stack_dataset.RasterCount
+        rows, cols = stack_dataset.RasterYSize, stack_dataset.RasterXSize
+        dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(stack_dataset.GetRasterBand(1).DataType))
+
+        method = self.get_method(layers, dtype.itemsize)
+        if method == 'exact':
+            window_rows = self.get_window_rows(rows, cols, exact_bytes_per_pixel(layers, dtype.itemsize))
+        else:
+            window_rows = self.get_window_rows(rows, cols, HistogramPercentiles.bytes_per_pixel(self.bins, layers),
+                                               HistogramPercentiles.fixed_bytes(self.bins))
+            if value_range is None:
+                value_range = self.get_value_range(stack_dataset, no_data_value, window_rows, integer=(dtype.kind in 'iu'))
+        logger.info('Calculating %s percentiles of %d layers in %s in windows of %d rows',
+                    method, layers, stack_dataset_path, window_rows)
+
+        gdal_driver = gdal.GetDriverByName('ENVI')
+        percentile_dataset = gdal_driver.Create(percentile_dataset_path, cols, rows, len(self.percentile_list), gdal.GDT_Float32)
+        assert percentile_dataset, 'Unable to create percentile dataset %s' % percentile_dataset_path
+        percentile_dataset.SetGeoTransform(stack_dataset.GetGeoTransform())
+        percentile_dataset.SetProjection(stack_dataset.GetProjection())
+
+        for row_start in range(0, rows, window_rows):
+            window_size = min(window_rows, rows - row_start)
+            if method == 'exact':
+                percentile_array = calc_percentiles_exact(stack_dataset.ReadAsArray(0, row_start, cols, window_size).reshape((layers, window_size, cols)),
+                                                          no_data_value, self.percentile_list)
+            else:
+                histogram = HistogramPercentiles((window_size, cols), value_range, no_data_value,
+                                                 integer=(dtype.kind in 'iu'), bins=self.bins, max_layers=layers)
+                for band_index in range(layers):
+                    histogram.add_layer(stack_dataset.GetRasterBand(band_index + 1).ReadAsArray(0, row_start, cols, window_size))
+                percentile_array = histogram.get_percentiles(self.percentile_list)
+                histogram = None # Free memory before the next window
+
+            for percentile_index in range(len(self.percentile_list)):
+                percentile_dataset.GetRasterBand(percentile_index + 1).WriteArray(percentile_array[percentile_index], 0, row_start)
+
+        for percentile_index, percentile in enumerate(self.percentile_list):
+            percentile_band = percentile_dataset.GetRasterBand(percentile_index + 1)
+            percentile_band.SetDescription(get_band_name(percentile))
+            if no_data_value is not None:
+                percentile_band.SetNoDataValue(no_data_value)
+        percentile_dataset.SetMetadata({'source_dataset': stack_dataset_path,
+                                        'percentile_method': method})
+        percentile_dataset.FlushCache()
+        logger.info('Finished writing percentiles to %s', percentile_dataset_path)
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    arg_parser = argparse.ArgumentParser(description='Check exact and histogram percentiles against numpy.nanpercentile()')
+    arg_parser.add_argument('--layers', type=int, default=60, help='Layers in synthetic stack (default: 60)')
+    arg_parser.add_argument('--rows', type=int, default=100, help='Rows in synthetic stack (default: 100)')
+    arg_parser.add_argument('--cols', type=int, default=120, help='Columns in synthetic stack (default: 120)')
+    args = arg_parser.parse_args()
+
+    random_state = numpy.random.RandomState(0)
+    for no_data_value, stack_array in [(-32768, random_state.randint(-10000, 10001, size=(args.layers, args.rows, args.cols)).astype(numpy.int16)),
+                                       (numpy.nan, random_state.gamma(2.0, 0.5, size=(args.layers, args.rows, args.cols)).astype(numpy.float32))]:
+        stack_array[random_state.random_sample(stack_array.shape) < 0.4] = no_data_value
+        stack_array[:, :3, :3] = no_data_value # Never valid
+        stack_array[:-1, 3:6, :3] = no_data_value # One valid value
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # All-NaN pixels
+            reference_array = numpy.nanpercentile(numpy.where(get_valid_mask(stack_array, no_data_value), stack_array, numpy.nan).astype(numpy.float64),
+                                                  PERCENTILE_LIST, axis=0)
+        reference_array[numpy.isnan(reference_array)] = no_data_value
+
+        exact_array = calc_percentiles_exact(stack_array, no_data_value)
+        assert numpy.allclose(exact_array, reference_array, rtol=1e-6, atol=1e-3, equal_nan=True), 'Exact percentiles differ from numpy'
+        logger.info('%s exact percentiles match', stack_array.dtype)
+
+        valid_array = stack_array[get_valid_mask(stack_array, no_data_value)]
+        value_range = (valid_array.min(), valid_array.max())
+        integer = stack_array.dtype.kind in 'iu'
+        for bins in ([int(value_range[1] - value_range[0] + 1)] if integer else []) + [HISTOGRAM_BINS, 64]:
+            histogram = HistogramPercentiles(stack_array.shape[1:], value_range, no_data_value, integer=integer, bins=bins)
+            for layer_array in stack_array:
+                histogram.add_layer(layer_array)
+            histogram_array = histogram.get_percentiles()
+            # Bins one integer wide are exact
+            tolerance = 1e-3 if integer and histogram.bin_width == 1 else histogram.bin_width
+            assert numpy.allclose(histogram_array, reference_array, rtol=0, atol=tolerance, equal_nan=True), \
+                'Histogram percentiles with %d bins differ from numpy by more than one bin width' % bins
+            logger.info('%s histogram percentiles with %d bins (width %g) within %g of numpy, %g on average',
+                        stack_array.dtype, histogram.bins, histogram.bin_width,
+                        numpy.nanmax(numpy.abs(histogram_array - reference_array)),
+                        numpy.nanmean(numpy.abs(histogram_array - reference_array)))
+
+    # Infinite values (e.g. SLAVI where B3 + B5 == 0) are ignored and an outlier is left in the
+    # overflow bins rather than stretching the bins of a range found from the stack
+    stack_array = random_state.gamma(2.0, 0.5, size=(args.layers, args.rows, args.cols)).astype(numpy.float32)
+    stack_array[random_state.random_sample(stack_array.shape) < 0.01] = numpy.inf
+    stack_array[0, 0, 0] = -numpy.inf
+    stack_array[0, 10, 10] = 5000.0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        reference_array = numpy.nanpercentile(numpy.where(numpy.isfinite(stack_array), stack_array, numpy.nan), PERCENTILE_LIST, axis=0)
+    value_range = get_sample_range(iter(stack_array), numpy.nan, sample_stride=7)
+    assert value_range[1] < 100, 'Outlier stretches the histogram range to %r' % (value_range,)
+    histogram = HistogramPercentiles(stack_array.shape[1:], value_range, numpy.nan, integer=False)
+    for layer_array in stack_array:
+        histogram.add_layer(layer_array)
+    histogram_array = histogram.get_percentiles()
+    exact_array = calc_percentiles_exact(stack_array, numpy.nan)
+    assert numpy.isfinite(histogram_array).all() and numpy.isfinite(exact_array).all(), 'Infinite values give non-finite percentiles'
+    assert numpy.allclose(exact_array, reference_array, rtol=1e-6, atol=1e-3), 'Exact percentiles with infinite values differ from numpy'
+    # Percentiles beyond the range (in the overflow bins) are clipped to it, so only check within it
+    in_range_mask = (reference_array >= value_range[0]) & (reference_array <= value_range[1])
+    assert numpy.allclose(histogram_array[in_range_mask], reference_array[in_range_mask], rtol=0, atol=histogram.bin_width), \
+        'Histogram percentiles with infinite values and an outlier differ from numpy by more than one bin width'
+    assert numpy.abs(histogram_array - reference_array).max() < value_range[1] - value_range[0], 'Clipped percentiles out of range'
+    logger.info('Histogram range %.3f to %.3f ignores infinite values and an outlier: percentiles within %g of numpy',
+                value_range[0], value_range[1], numpy.abs(histogram_array - reference_array)[in_range_mask].max())
+
+    # A histogram window sized by get_window_rows() stays within the memory budget
+    try:
+        import tracemalloc
+    except ImportError: # Python 2
+        tracemalloc = None
+        logger.warning('tracemalloc not available - memory budget check skipped')
+    if tracemalloc:
+        layers, cols = 60, 2000
+        temporal_percentiles = TemporalPercentiles(max_memory_mb=16, method='histogram')
+        window_rows = temporal_percentiles.get_window_rows(10000, cols, HistogramPercentiles.bytes_per_pixel(HISTOGRAM_BINS, layers),
+                                                           HistogramPercentiles.fixed_bytes(HISTOGRAM_BINS))
+        layer_list = [random_state.randint(-10000, 10001, size=(window_rows, cols)).astype(numpy.int16) for _ in range(layers)]
+        tracemalloc.start()
+        histogram = HistogramPercentiles((window_rows, cols), (-10000, 10000), -32768, bins=HISTOGRAM_BINS, max_layers=layers)
+        for layer_array in layer_list:
+            histogram.add_layer(layer_array.copy()) # A new array for each layer, as from ReadAsArray()
+        percentile_array = histogram.get_percentiles()
+        _current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert peak_bytes <= temporal_percentiles.max_memory_mb * 1024 * 1024, \
+            'Window of %d rows used %.1fMB, more than the %gMB budget' % (window_rows, peak_bytes / 1048576.0, temporal_percentiles.max_memory_mb)
+        logger.info('Histogram window of %d rows used %.1fMB of %gMB budget',
+                    window_rows, peak_bytes / 1048576.0, temporal_percentiles.max_memory_mb)
+
+        # Likewise an exact window, including the window read from the stack
+        for layers in [4, 60]:
+            temporal_percentiles = TemporalPercentiles(max_memory_mb=16, method='exact')
+            window_rows = temporal_percentiles.get_window_rows(10000, cols, exact_bytes_per_pixel(layers, 2))
+            stack_array = random_state.randint(-10000, 10001, size=(layers, window_rows, cols)).astype(numpy.int16)
+            stack_array[random_state.random_sample(stack_array.shape) < 0.3] = -32768
+            tracemalloc.start()
+            percentile_array = calc_percentiles_exact(stack_array.copy(), -32768) # A new array, as from ReadAsArray()
+            _current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert peak_bytes <= temporal_percentiles.max_memory_mb * 1024 * 1024, \
+                'Exact window of %d rows of %d layers used %.1fMB, more than the %gMB budget' % (window_rows, layers, peak_bytes / 1048576.0,
+                                                                                                 temporal_percentiles.max_memory_mb)
+            logger.info('Exact window of %d rows of %d layers used %.1fMB of %gMB budget',
+                        window_rows, layers, peak_bytes / 1048576.0, temporal_percentiles.max_memory_mb)
@@ -0,0 +1,610 @@
+'''
+Created on 16/10/2026
+
+Streaming temporal summary statistics which can be extended one acquisition at a time
+'''
+import os
+import re
+import sys
+import json
+import fcntl
+import logging
+import numpy
+from datetime import datetime
+from osgeo import gdal
+
+STATS_ACCUMULATOR_VERSION = '2' # Change whenever the state layout or update changes so that existing state is rebuilt
+STATS_BAND_NAMES = ['Sum', 'Valid Observations', 'Mean', 'Variance', 'Standard Deviation',
+                    'Skewness', 'Kurtosis', 'Max', 'Min']
+PROVENANCE_BAND_NAMES = ['Datetime Provenance', 'Satellite Provenance'] # Of the max, as for provenance=True in temporal_stats_numexpr_module
+PROVENANCE_EPOCH = datetime(1970, 1, 1) # Datetime Provenance is in days since this
+FREQUENCY_BAND_NAMES = ['Wet Observations', 'Clear Observations', 'Wet Frequency']
+FREQUENCY_NO_DATA_VALUE = -1 # Wet Frequency with no clear observations
+READ_ROWS = 512 # Rows read at a time when adding a dataset or writing stats
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Set top level standard output
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_formatter = logging.Formatter('%(message)s')
+console_handler.setFormatter(console_formatter)
+
+logger = logging.getLogger(__name__)
+if not logger.level:
+    logger.setLevel(logging.DEBUG) # Default logging level for all modules
+    logger.addHandler(console_handler)
+
+
+def get_provenance_days(datetime_string):
+    """Returns the Datetime Provenance value of an acquisition datetime string in DATETIME_FORMAT"""
+    time_delta = datetime.strptime(datetime_string, DATETIME_FORMAT) - PROVENANCE_EPOCH
+    return time_delta.days + time_delta.seconds / 86400.0 + time_delta.microseconds / 86400000000.0
+
+
+def get_provenance_satellite(satellite_tag, no_data_value):
+    """Returns the Satellite Provenance value of a satellite tag such as LS7, or no_data_value without a number"""
+    satellite_match = re.search(r'\d+', satellite_tag or '')
+    return float(satellite_match.group()) if satellite_match else no_data_value
+
+
+class TemporalStatsAccumulator(object):
+    """
+    Per-pixel count, mean and second to fourth central moments (Welford's online update
+    extended to higher moments), min, and max with the acquisition it came from, for a time
+    series of (row, col) layers with no data values excluded.
+
+    State is kept as memory-mapped .npy files in state_dir together with the list of
+    acquisitions already added, so that a new acquisition can be added to existing
+    statistics without reading any earlier data. Each accumulator holds an exclusive lock
+    on its state_dir from opening until close(), so other processes wait rather than
+    share (or truncate) the memory-mapped state. Acquisitions may be added in any order;
+    ties for the max go to the earliest acquisition, as for numpy.argmax() over the stack.
+
+    Order statistics (median, quantiles) can't be accumulated this way and are not provided,
+    and nor is the geometric mean, so write_stats() has only the bands of
+    temporal_stats_numexpr_module named in STATS_BAND_NAMES and PROVENANCE_BAND_NAMES.
+    The provenance bands are the datetime (in days since PROVENANCE_EPOCH) and the satellite
+    (the number of its tag, e.g. 7 for LS7) of the acquisition of the max.
+
+    The state takes get_state_bytes_per_pixel() bytes per pixel (48, or 732MB for a
+    4000 x 4000 tile), of which 16 are the third and fourth moments for Skewness and Kurtosis.
+    """
+    STATE_ARRAYS = [('count', numpy.int32, 0),
+                    ('mean', numpy.float64, 0),
+                    ('m2', numpy.float64, 0),
+                    ('m3', numpy.float64, 0),
+                    ('m4', numpy.float64, 0),
+                    ('min', numpy.float32, numpy.inf),
+                    ('max', numpy.float32, -numpy.inf),
+                    ('max_index', numpy.int32, -1)] # List of (name, dtype, initial value) tuples
+
+    def __init__(self, state_dir, shape, no_data_value, definition=''):
+        self.state_dir = state_dir
+        self.shape = tuple(shape)
+        self.no_data_value = no_data_value
+        self.definition = '%s %s no data %r' % (STATS_ACCUMULATOR_VERSION, definition, no_data_value)
+        self.output_no_data_value = no_data_value # No data value of the bands written by write_stats()
+        self.acquisition_list = [] # List of dicts with 'key', 'datetime' and 'satellite_tag' in the order added
+        self._array_dict = {}
+        self._date_rank_array = numpy.zeros((0,), dtype=numpy.int32)
+        self._provenance_array = numpy.zeros((len(PROVENANCE_BAND_NAMES), 0), dtype=numpy.float64)
+        self._lock_file = None
+
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        self._lock()
+        if not self._load():
+            self.reset()
+
+    @classmethod
+    def get_state_bytes_per_pixel(cls):
+        """Returns the size in bytes of the state kept for each pixel"""
+        return sum([numpy.dtype(dtype).itemsize for _array_name, dtype, _initial_value in cls.STATE_ARRAYS])
+
+    @property
+    def acquisitions_path(self):
+        return os.path.join(self.state_dir, 'acquisitions.json')
+
+    @property
+    def dirty_path(self):
+        return os.path.join(self.state_dir, 'dirty')
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.state_dir, 'lock')
+
+    def _lock(self):
+        """Takes the exclusive lock on state_dir, waiting for any other process holding it to close()"""
+        self._lock_file = open(self.lock_path, 'a')
+        try: # lockf() rather than flock() so that forked pool workers don't inherit the lock
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.info('Waiting for statistics state in %s to be released', self.state_dir)
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX)
+
+    def close(self):
+        """Unmaps the state and releases the lock on state_dir. Changes not saved with save() are left to be rebuilt"""
+        self._array_dict = {}
+        if self._lock_file:
+            self._lock_file.close() # Releases the lock
+            self._lock_file = None
+
+    def _load(self):
+        """
+        Opens existing state, returning False if there is none or it can't be used. This is called
+        with the lock held, so a dirty state was left by a process which failed before save().
+        """
+        if not os.path.exists(self.acquisitions_path):
+            return False
+        if os.path.exists(self.dirty_path):
+            logger.info('Statistics state in %s was not saved - rebuilding', self.state_dir)
+            return False
+
+        with open(self.acquisitions_path) as acquisitions_file:
+            state_info = json.load(acquisitions_file)
+        if state_info['definition'] != self.definition or tuple(state_info['shape']) != self.shape:
+            logger.info('Statistics state in %s is out of date', self.state_dir)
+            return False
+
+        for array_name, _dtype, _initial_value in self.STATE_ARRAYS:
+            self._array_dict[array_name] = numpy.load(os.path.join(self.state_dir, array_name + '.npy'), mmap_mode='r+')
+        self.acquisition_list = state_info['acquisition_list']
+        self._update_date_ranks()
+        logger.debug('Opened statistics state in %s with %d acquisitions', self.state_dir, len(self.acquisition_list))
+        return True
+
+    def reset(self):
+        """Discards all accumulated statistics. The lock is held, so no other process has the state mapped"""
+        self._set_dirty()
+        self._array_dict = {}
+        for array_name, dtype, initial_value in self.STATE_ARRAYS:
+            state_array = numpy.lib.format.open_memmap(os.path.join(self.state_dir, array_name + '.npy'),
+                                                       mode='w+', dtype=dtype, shape=self.shape)
+            state_array[...] = initial_value
+            self._array_dict[array_name] = state_array
+        self.acquisition_list = []
+        self._update_date_ranks()
+        logger.debug('Reset statistics state in %s', self.state_dir)
+
+    def save(self):
+        """Writes the state to disk. Until this is called, a crash leaves the state to be rebuilt"""
+        for state_array in self._array_dict.values():
+            state_array.flush()
+
+        temp_path = self.acquisitions_path + '.tmp'
+        with open(temp_path, 'w') as acquisitions_file:
+            json.dump({'definition': self.definition,
+                       'shape': list(self.shape),
+                       'acquisition_list': self.acquisition_list}, acquisitions_file, indent=1)
+        os.rename(temp_path, self.acquisitions_path)
+
+        if os.path.exists(self.dirty_path):
+            os.remove(self.dirty_path)
+
+    def _set_dirty(self):
+        """Marks the state on disk as incomplete before it is modified"""
+        if not os.path.exists(self.dirty_path):
+            open(self.dirty_path, 'w').close()
+
+    def _update_date_ranks(self):
+        """Sets the layer index in date order and the provenance band values of each acquisition"""
+        date_order = sorted(range(len(self.acquisition_list)),
+                            key=lambda acquisition_index: (self.acquisition_list[acquisition_index]['datetime'],
+                                                           self.acquisition_list[acquisition_index]['key']))
+        self._date_rank_array = numpy.zeros((len(self.acquisition_list),), dtype=numpy.int32)
+        self._date_rank_array[date_order] = numpy.arange(len(date_order), dtype=numpy.int32)
+        self._provenance_array = numpy.array([[get_provenance_days(acquisition['datetime']) for acquisition in self.acquisition_list],
+                                              [get_provenance_satellite(acquisition['satellite_tag'], self.no_data_value)
+                                               for acquisition in self.acquisition_list]],
+                                             dtype=numpy.float64).reshape((len(PROVENANCE_BAND_NAMES), len(self.acquisition_list)))
+
+    def has_acquisition(self, key):
+        return key in [acquisition['key'] for acquisition in self.acquisition_list]
+
+    def get_layer_list(self):
+        """Returns the list of acquisition dicts in date (layer) order"""
+        return sorted(self.acquisition_list, key=lambda acquisition: (acquisition['datetime'], acquisition['key']))
+
+    def begin_acquisition(self, key, acquisition_datetime, satellite_tag=None):
+        """
+        Adds an acquisition to be supplied by add_block() and returns its index for that call.
+        Every row of the acquisition must be added before save() is called.
+        """
+        assert not self.has_acquisition(key), 'Acquisition %s has already been added' % key
+        self._set_dirty()
+        self.acquisition_list.append({'key': key,
+                                      'datetime': acquisition_datetime.strftime(DATETIME_FORMAT),
+                                      'satellite_tag': satellite_tag})
+        self._update_date_ranks()
+        return len(self.acquisition_list) - 1
+
+    def add_block(self, acquisition_index, data_array, row_start=0):
+        """Adds the (row, col) data_array for rows starting at row_start of an acquisition"""
+        assert data_array.shape[1] == self.shape[1], 'Block width does not match statistics'
+        row_slice = slice(row_start, row_start + data_array.shape[0])
+
+        if self.no_data_value is None:
+            valid_mask = numpy.ones(data_array.shape, dtype=numpy.bool_)
+        elif numpy.isnan(self.no_data_value):
+            valid_mask = ~numpy.isnan(data_array)
+        else:
+            valid_mask = (data_array != self.no_data_value)
+        if not valid_mask.any():
+            return
+
+        self._set_dirty()
+        value_array = data_array[valid_mask].astype(numpy.float64)
+        state_dict = dict((array_name, state_array[row_slice]) for array_name, state_array in self._array_dict.items())
+
+        # Welford update with higher moments (Terriberry) for a single new value per pixel
+        previous_count = state_dict['count'][valid_mask].astype(numpy.float64)
+        count = previous_count + 1
+        m2 = state_dict['m2'][valid_mask]
+        m3 = state_dict['m3'][valid_mask]
+        delta = value_array - state_dict['mean'][valid_mask]
+        delta_n = delta / count
+        delta_n2 = delta_n * delta_n
+        term1 = delta * delta_n * previous_count
+
+        state_dict['mean'][valid_mask] += delta_n
+        state_dict['m4'][valid_mask] += (term1 * delta_n2 * (count * count - 3 * count + 3) +
+                                         6 * delta_n2 * m2 - 4 * delta_n * m3)
+        state_dict['m3'][valid_mask] = m3 + term1 * delta_n * (count - 2) - 3 * delta_n * m2
+        state_dict['m2'][valid_mask] = m2 + term1
+        state_dict['count'][valid_mask] = count
+
+        state_dict['min'][valid_mask] = numpy.fmin(state_dict['min'][valid_mask], value_array)
+
+        # Replace the max where this acquisition is greater, or equal and earlier
+        max_array = state_dict['max'][valid_mask]
+        max_index_array = state_dict['max_index'][valid_mask]
+        replace_mask = (value_array > max_array)
+        replace_mask |= ((value_array == max_array) &
+                         (self._date_rank_array[numpy.maximum(max_index_array, 0)] > self._date_rank_array[acquisition_index]))
+        max_array[replace_mask] = value_array[replace_mask]
+        max_index_array[replace_mask] = acquisition_index
+        state_dict['max'][valid_mask] = max_array
+        state_dict['max_index'][valid_mask] = max_index_array
+
+    def add_dataset(self, key, acquisition_datetime, satellite_tag, dataset_path, band_number=1):
+        """Adds an acquisition by reading band band_number of dataset_path"""
+        dataset = gdal.Open(dataset_path)
+        assert dataset, 'Unable to open dataset %s' % dataset_path
+        assert (dataset.RasterYSize, dataset.RasterXSize) == self.shape, 'Dataset %s does not match statistics' % dataset_path
+        band = dataset.GetRasterBand(band_number)
+
+        acquisition_index = self.begin_acquisition(key, acquisition_datetime, satellite_tag)
+        for row_start in range(0, self.shape[0], READ_ROWS):
+            rows = min(READ_ROWS, self.shape[0] - row_start)
+            self.add_block(acquisition_index, band.ReadAsArray(0, row_start, self.shape[1], rows), row_start)
+        logger.debug('Added layer %d of %s to statistics in %s', band_number, dataset_path, self.state_dir)
+
+    def get_stats(self, row_start=0, row_end=None, provenance=True, ddof=0):
+        """
+        Returns a float32 (band, row, col) array of the statistics named in STATS_BAND_NAMES
+        (and PROVENANCE_BAND_NAMES if provenance is True) for rows row_start to row_end.
+        Pixels without enough valid observations for a statistic are set to no_data_value.
+        """
+        row_slice = slice(row_start, row_end)
+        count = self._array_dict['count'][row_slice].astype(numpy.float64)
+        mean = numpy.array(self._array_dict['mean'][row_slice])
+        m2 = numpy.array(self._array_dict['m2'][row_slice])
+        m3 = numpy.array(self._array_dict['m3'][row_slice])
+        m4 = numpy.array(self._array_dict['m4'][row_slice])
+
+        band_list = []
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            variance = m2 / (count - ddof)
+            band_list += [numpy.where(count > 0, mean * count, self.no_data_value),
+                          count,
+                          numpy.where(count > 0, mean, self.no_data_value),
+                          numpy.where(count > ddof, variance, self.no_data_value),
+                          numpy.where(count > ddof, numpy.sqrt(variance), self.no_data_value),
+                          numpy.where(m2 > 0, numpy.sqrt(count) * m3 / m2 ** 1.5, self.no_data_value),
+                          numpy.where(m2 > 0, count * m4 / (m2 * m2) - 3, self.no_data_value),
+                          numpy.where(count > 0, self._array_dict['max'][row_slice], self.no_data_value),
+                          numpy.where(count > 0, self._array_dict['min'][row_slice], self.no_data_value)]
+
+        if provenance:
+            max_index_array = self._array_dict['max_index'][row_slice]
+            for provenance_values in self._provenance_array:
+                band_list.append(numpy.where(max_index_array >= 0,
+                                             provenance_values[numpy.maximum(max_index_array, 0)],
+                                             self.no_data_value))
+
+        return numpy.array(band_list, dtype=numpy.float32)
+
+    def get_band_names(self, provenance=True):
+        """Returns the names of the bands returned by get_stats()"""
+        return STATS_BAND_NAMES + (PROVENANCE_BAND_NAMES if provenance else [])
+
+    def write_stats(self, stats_dataset_path, geotransform=None, projection=None, provenance=True, ddof=0):
+        """
+        Writes the statistics to a new Envi file with each band named as in get_band_names().
+        Bands hold the same values as those of the same name from temporal_stats_numexpr_module.
+        """
+        band_names = self.get_band_names(provenance)
+        gdal_driver = gdal.GetDriverByName('ENVI')
+        stats_dataset = gdal_driver.Create(stats_dataset_path, self.shape[1], self.shape[0], len(band_names), gdal.GDT_Float32)
+        assert stats_dataset, 'Unable to create stats dataset %s' % stats_dataset_path
+        if geotransform:
+            stats_dataset.SetGeoTransform(geotransform)
+        if projection:
+            stats_dataset.SetProjection(projection)
+
+        for row_start in range(0, self.shape[0], READ_ROWS):
+            row_end = min(row_start + READ_ROWS, self.shape[0])
+            stats_array = self.get_stats(row_start, row_end, provenance, ddof)
+            for band_index in range(len(band_names)):
+                stats_dataset.GetRasterBand(band_index + 1).WriteArray(stats_array[band_index], 0, row_start)
+
+        for band_index, band_name in enumerate(band_names):
+            stats_band = stats_dataset.GetRasterBand(band_index + 1)
+            stats_band.SetDescription(band_name)
+            if self.output_no_data_value is not None:
+                stats_band.SetNoDataValue(self.output_no_data_value)
+
+        stats_dataset.FlushCache()
+        logger.info('Finished writing statistics for %d acquisitions to %s', len(self.acquisition_list), stats_dataset_path)
+
+
+class BlockBuffer(object):
+    """
+    Copies of the blocks of one acquisition passed to add_block(), for a process which doesn't
+    hold the accumulator (e.g. a pool worker) to return to the one which does for merge_into().
+    """
+    def __init__(self):
+        self.block_list = [] # List of (row_start, data_array) tuples in the order added
+
+    def add_block(self, acquisition_index, data_array, row_start=0):
+        """Keeps a copy of the (row, col) data_array for rows starting at row_start. acquisition_index is ignored"""
+        self.block_list.append((row_start, numpy.array(data_array))) # Copy because callers reuse their buffers
+
+    def merge_into(self, accumulator, acquisition_index):
+        """Adds the blocks to the acquisition of accumulator begun with begin_acquisition()"""
+        for row_start, data_array in self.block_list:
+            accumulator.add_block(acquisition_index, data_array, row_start)
+
+
+class WaterFrequencyAccumulator(TemporalStatsAccumulator):
+    """
+    Per-pixel count of wet and of clear (not no data) observations for a time series of
+    (row, col) water classification layers, kept in state_dir in the same way as the
+    statistics of a TemporalStatsAccumulator so that acquisitions can be added one at a time.
+
+    write_stats() writes the bands named in FREQUENCY_BAND_NAMES, with the wet frequency
+    (wet / clear count) set to FREQUENCY_NO_DATA_VALUE where there are no clear observations.
+    """
+    STATE_ARRAYS = [('wet_count', numpy.int32, 0),
+                    ('clear_count', numpy.int32, 0)] # List of (name, dtype, initial value) tuples
+
+    def __init__(self, state_dir, shape, no_data_value, definition='', wet_value=1):
+        TemporalStatsAccumulator.__init__(self, state_dir, shape, no_data_value, '%s wet %r' % (definition, wet_value))
+        self.wet_value = wet_value
+        self.output_no_data_value = FREQUENCY_NO_DATA_VALUE
+
+    def add_block(self, acquisition_index, data_array, row_start=0):
+        """Adds the (row, col) data_array for rows starting at row_start of an acquisition"""
+        assert data_array.shape[1] == self.shape[1], 'Block width does not match statistics'
+        row_slice = slice(row_start, row_start + data_array.shape[0])
+
+        self._set_dirty()
+        wet_count = self._array_dict['wet_count'][row_slice]
+        clear_count = self._array_dict['clear_count'][row_slice]
+        numpy.add(wet_count, data_array == self.wet_value, out=wet_count, casting='unsafe')
+        if self.no_data_value is None:
+            clear_count += 1
+        else:
+            numpy.add(clear_count, data_array != self.no_data_value, out=clear_count, casting='unsafe')
+
+    def get_band_names(self, provenance=True):
+        """Returns the names of the bands returned by get_stats(). There are no provenance bands"""
+        return FREQUENCY_BAND_NAMES
+
+    def get_stats(self, row_start=0, row_end=None, provenance=True, ddof=0):
+        """
+        Returns a float32 (band, row, col) array of the bands named in FREQUENCY_BAND_NAMES for
+        rows row_start to row_end. provenance and ddof are ignored.
+        """
+        row_slice = slice(row_start, row_end)
+        wet_count = self._array_dict['wet_count'][row_slice].astype(numpy.float32)
+        clear_count = self._array_dict['clear_count'][row_slice].astype(numpy.float32)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            frequency = numpy.where(clear_count > 0, wet_count / clear_count, FREQUENCY_NO_DATA_VALUE)
+        return numpy.array([wet_count, clear_count, frequency], dtype=numpy.float32)
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    import shutil
+    import tempfile
+    from datetime import timedelta
+
+    def calc_stats_per_stack(stack_array, no_data_value, layer_datetime_list, layer_satellite_list, ddof=0):
+        """Reference implementation over a whole (layer, row, col) stack in the order of STATS_BAND_NAMES + PROVENANCE_BAND_NAMES"""
+        valid_mask = (stack_array != no_data_value)
+        data_array = numpy.where(valid_mask, stack_array, numpy.nan).astype(numpy.float64)
+        count = valid_mask.sum(axis=0).astype(numpy.float64)
+        max_layer_array = numpy.argmax(numpy.where(valid_mask, data_array, -numpy.inf), axis=0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mean = numpy.nansum(data_array, axis=0) / count
+            deviation = data_array - mean
+            m2 = numpy.nansum(deviation ** 2, axis=0)
+            m3 = numpy.nansum(deviation ** 3, axis=0)
+            m4 = numpy.nansum(deviation ** 4, axis=0)
+            band_list = [numpy.nansum(data_array, axis=0), count, mean, m2 / (count - ddof), numpy.sqrt(m2 / (count - ddof)),
+                         numpy.sqrt(count) * m3 / m2 ** 1.5, count * m4 / (m2 * m2) - 3,
+                         numpy.nanmax(numpy.where(valid_mask, data_array, -numpy.inf), axis=0),
+                         numpy.nanmin(numpy.where(valid_mask, data_array, numpy.inf), axis=0),
+                         numpy.array([(layer_datetime - PROVENANCE_EPOCH).total_seconds() / 86400.0
+                                      for layer_datetime in layer_datetime_list])[max_layer_array],
+                         numpy.array([int(satellite_tag[2:]) for satellite_tag in layer_satellite_list])[max_layer_array]]
+        return band_list, count, m2
+
+    def try_lock(lock_path):
+        """Exits with status 1 if the lock taken by TemporalStatsAccumulator on lock_path is held by another process"""
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                sys.exit(1)
+
+    def check_stats_module_parity(stack_array, no_data_value, accumulator, work_dir, stats_module_dir):
+        """
+        Compares every band written by accumulator.write_stats() with the band of the same name
+        written by temporal_stats_numexpr_module for stack_array as an Envi file with the layer
+        names of IndexStacker, including the provenance bands, the order of the bands and their
+        no data values. Raises ImportError if temporal_stats_numexpr_module is missing.
+        """
+        sys.path.append(stats_module_dir)
+        try:
+            import temporal_stats_numexpr_module
+        except ImportError:
+            raise ImportError('temporal_stats_numexpr_module not found in %s - it is needed for the parity check (--stats-module-dir)'
+                              % stats_module_dir)
+
+        stack_path = os.path.join(work_dir, 'stack_envi')
+        stack_dataset = gdal.GetDriverByName('ENVI').Create(stack_path, stack_array.shape[2], stack_array.shape[1],
+                                                            stack_array.shape[0], gdal.GDT_Int16)
+        for layer_index, acquisition in enumerate(accumulator.get_layer_list()):
+            stack_band = stack_dataset.GetRasterBand(layer_index + 1)
+            stack_band.WriteArray(stack_array[layer_index])
+            stack_band.SetNoDataValue(no_data_value)
+            stack_band.SetDescription('Band_%d %s-%s %s' % (layer_index + 1, acquisition['satellite_tag'],
+                                                            SENSOR_NAMES[acquisition['satellite_tag']],
+                                                            datetime.strptime(acquisition['datetime'], DATETIME_FORMAT).isoformat()))
+        stack_dataset.FlushCache()
+        stack_dataset = None
+
+        module_stats_path = os.path.join(work_dir, 'module_stats_envi')
+        temporal_stats_numexpr_module.main(stack_path, module_stats_path, noData=no_data_value, provenance=True)
+        accumulator_stats_path = os.path.join(work_dir, 'accumulator_stats_envi')
+        accumulator.write_stats(accumulator_stats_path, provenance=True)
+
+        module_dataset = gdal.Open(module_stats_path)
+        accumulator_dataset = gdal.Open(accumulator_stats_path)
+        module_band_names = [module_dataset.GetRasterBand(band_index + 1).GetDescription()
+                             for band_index in range(module_dataset.RasterCount)]
+        module_band_index_list = []
+        for band_index, band_name in enumerate(accumulator.get_band_names(provenance=True)):
+            assert band_name in module_band_names, '%s is not one of the temporal_stats_numexpr_module bands %s' % (band_name, module_band_names)
+            module_band_index_list.append(module_band_names.index(band_name))
+            module_band = module_dataset.GetRasterBand(module_band_index_list[-1] + 1)
+            accumulator_band = accumulator_dataset.GetRasterBand(band_index + 1)
+            module_array = module_band.ReadAsArray().astype(numpy.float64)
+            accumulator_array = accumulator_band.ReadAsArray().astype(numpy.float64)
+
+            module_no_data_value = module_band.GetNoDataValue()
+            if module_no_data_value is None or numpy.isnan(module_no_data_value):
+                module_valid_mask = ~numpy.isnan(module_array)
+            else:
+                module_valid_mask = (module_array != module_no_data_value)
+            accumulator_valid_mask = (accumulator_array != accumulator_band.GetNoDataValue())
+            assert (module_valid_mask == accumulator_valid_mask).all(), '%s no data differs from temporal_stats_numexpr_module' % band_name
+            assert numpy.allclose(accumulator_array[accumulator_valid_mask], module_array[module_valid_mask], rtol=1e-4, atol=1e-3), \
+                '%s differs from temporal_stats_numexpr_module' % band_name
+            logger.info('%s matches temporal_stats_numexpr_module', band_name)
+        assert module_band_index_list == sorted(module_band_index_list), 'Bands are not in temporal_stats_numexpr_module order'
+
+    arg_parser = argparse.ArgumentParser(description='Check TemporalStatsAccumulator against whole-stack statistics')
+    arg_parser.add_argument('--layers', type=int, default=40, help='Acquisitions in synthetic stack (default: 40)')
+    arg_parser.add_argument('--rows', type=int, default=300, help='Rows in synthetic stack (default: 300)')
+    arg_parser.add_argument('--cols', type=int, default=200, help='Columns in synthetic stack (default: 200)')
+    arg_parser.add_argument('--stats-module-dir', dest='stats_module_dir',
+                            default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stats'),
+                            help='Directory of temporal_stats_numexpr_module for the parity check (default: stats next to this file)')
+    args = arg_parser.parse_args()
+
+    SENSOR_NAMES = {'LS5': 'TM', 'LS7': 'ETM+', 'LS8': 'OLI'}
+    no_data_value = -32768
+    random_state = numpy.random.RandomState(0)
+    stack_array = random_state.randint(-2000, 9000, size=(args.layers, args.rows, args.cols)).astype(numpy.int16)
+    stack_array[random_state.random_sample(stack_array.shape) < 0.3] = no_data_value
+    stack_array[:, :5, :5] = no_data_value # Never valid
+    stack_array[:, 5:10, :5] = 1234 # Constant, so ties for min and max
+    base_datetime = datetime(2000, 1, 1, 0, 0, 5, 123)
+    layer_datetime_list = [base_datetime + timedelta(days=16 * layer_index) for layer_index in range(args.layers)]
+    layer_satellite_list = [['LS5', 'LS7', 'LS8'][layer_index % 3] for layer_index in range(args.layers)]
+    layer_key_list = ['%s %d' % (layer_satellite_list[layer_index], layer_index) for layer_index in range(args.layers)]
+
+    state_dir = tempfile.mkdtemp()
+    try:
+        # Add acquisitions out of date order in row blocks, saving and reopening part way through
+        layer_order = random_state.permutation(args.layers)
+        accumulator = TemporalStatsAccumulator(state_dir, (args.rows, args.cols), no_data_value, 'check')
+        for order_index, layer_index in enumerate(layer_order):
+            if order_index == args.layers // 2:
+                accumulator.save()
+                accumulator.close()
+                accumulator = TemporalStatsAccumulator(state_dir, (args.rows, args.cols), no_data_value, 'check')
+            acquisition_index = accumulator.begin_acquisition(layer_key_list[layer_index], layer_datetime_list[layer_index],
+                                                              layer_satellite_list[layer_index])
+            for row_start in range(0, args.rows, 128):
+                accumulator.add_block(acquisition_index, stack_array[layer_index, row_start:row_start + 128], row_start)
+        accumulator.save()
+
+        stats_array = accumulator.get_stats()
+        reference_list, count, m2 = calc_stats_per_stack(stack_array, no_data_value, layer_datetime_list, layer_satellite_list)
+        for band_index, band_name in enumerate(STATS_BAND_NAMES + PROVENANCE_BAND_NAMES):
+            if band_name == 'Valid Observations':
+                valid_mask = numpy.ones(count.shape, dtype=numpy.bool_)
+            elif band_name in ['Skewness', 'Kurtosis']:
+                valid_mask = m2 > 0
+            else:
+                valid_mask = count > 0
+            assert (stats_array[band_index][~valid_mask] == no_data_value).all(), '%s no data differs' % band_name
+            assert numpy.allclose(stats_array[band_index][valid_mask], reference_list[band_index][valid_mask],
+                                  rtol=1e-5, atol=1e-3), '%s differs from whole-stack statistics' % band_name
+            logger.info('%s matches', band_name)
+
+        assert [acquisition['key'] for acquisition in accumulator.get_layer_list()] == layer_key_list
+
+        # Another process can't take the lock on the state until close()
+        lock_process = multiprocessing.Process(target=try_lock, args=(accumulator.lock_path,))
+        lock_process.start()
+        lock_process.join()
+        assert lock_process.exitcode == 1, 'Statistics state is not locked'
+
+        # Blocks collected by BlockBuffer (as returned by pool workers) and merged give the same statistics
+        merged_accumulator = TemporalStatsAccumulator(os.path.join(state_dir, 'merged'), (args.rows, args.cols), no_data_value, 'check')
+        for layer_index in layer_order:
+            block_buffer = BlockBuffer()
+            for row_start in range(0, args.rows, 100):
+                block_buffer.add_block(None, stack_array[layer_index, row_start:row_start + 100], row_start)
+            block_buffer.merge_into(merged_accumulator,
+                                     merged_accumulator.begin_acquisition(layer_key_list[layer_index], layer_datetime_list[layer_index],
+                                                                          layer_satellite_list[layer_index]))
+        assert numpy.array_equal(merged_accumulator.get_stats(), stats_array), 'Statistics merged from BlockBuffer differ'
+        logger.info('Statistics merged from BlockBuffer match')
+
+        check_stats_module_parity(stack_array, no_data_value, accumulator, state_dir, args.stats_module_dir)
+
+        # Water frequency from a 0 (dry) / 1 (wet) / 3 (no data) stack, adding half the acquisitions after reopening
+        water_stack_array = random_state.randint(0, 2, size=stack_array.shape).astype(numpy.uint8)
+        water_stack_array[stack_array == no_data_value] = 3
+        frequency_state_dir = os.path.join(state_dir, 'frequency')
+        accumulator = WaterFrequencyAccumulator(frequency_state_dir, (args.rows, args.cols), 3, 'check')
+        for layer_index in range(args.layers):
+            if layer_index == args.layers // 2:
+                accumulator.save()
+                accumulator.close()
+                accumulator = WaterFrequencyAccumulator(frequency_state_dir, (args.rows, args.cols), 3, 'check')
+            acquisition_index = accumulator.begin_acquisition('LS5 %d' % layer_index,
+                                                              base_datetime + timedelta(days=16 * layer_index), 'LS5')
+            for row_start in range(0, args.rows, 128):
+                accumulator.add_block(acquisition_index, water_stack_array[layer_index, row_start:row_start + 128], row_start)
+        accumulator.save()
+
+        frequency_array = accumulator.get_stats()
+        wet_count = (water_stack_array == 1).sum(axis=0)
+        clear_count = (water_stack_array != 3).sum(axis=0)
+        assert (frequency_array[0] == wet_count).all(), 'Wet Observations differ from whole-stack count'
+        assert (frequency_array[1] == clear_count).all(), 'Clear Observations differ from whole-stack count'
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            assert numpy.allclose(frequency_array[2], numpy.where(clear_count > 0, wet_count / clear_count.astype(numpy.float64),
+                                                                  FREQUENCY_NO_DATA_VALUE)), 'Wet Frequency differs'
+        logger.info('Water frequency matches')
+    finally:
+        shutil.rmtree(state_dir)